@@ -1,11 +1,32 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from typing import Optional
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from routes import api, response, vault
 from config import CORS_ORIGINS, RATE_LIMIT
+from auth.check_key import get_auth_cache_stats, invalidate_api_token
+from auth.admin import check_admin
+from services.routing import get_routing_stats, invalidate_routing
+from providers.client_pool import get_client_pool
+from services.usage import get_usage_counter
+from auth.log import get_log_writer
+from utils.log_policy import get_payload_policy
+from utils.token_counter import get_token_cache_stats
+from services.cache import get_cache_stats
+from services.cache_policy import get_cache_policy
+from services.cache_refresh import get_cache_refresher
+from services.semantic_index import get_semantic_index
+from services.lexical_index import get_lexical_index
+from services.cache_feed import get_cache_feed
+from services.ingestion import shutdown_ingestion_pool
+from services.ingestion_jobs import get_ingestion_queue
+from services.embeddings import get_embedding_service
+from services.cache_lifecycle import get_cache_lifecycle
+from services.coalescer import get_coalescer
 
 # Initialize rate limiter
 limiter = Limiter(key_func=get_remote_address)
@@ -64,3 +85,73 @@ async def root():
 @app.get("/health")
 async def health():
     return {"status": "ok"}
+
+@app.on_event("startup")
+async def startup():
+    get_usage_counter().start()
+    get_log_writer().start()
+    get_semantic_index().start()
+    get_lexical_index().start()
+    get_cache_feed().start()
+    await get_embedding_service().start()
+    get_cache_lifecycle().start()
+    get_ingestion_queue().start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await get_ingestion_queue().stop()
+    await get_usage_counter().stop()
+    await get_log_writer().stop()
+    await get_cache_lifecycle().stop()
+    await get_cache_feed().stop()
+    await get_semantic_index().stop()
+    await get_embedding_service().stop()
+    await get_client_pool().close()
+    shutdown_ingestion_pool()
+
+@app.get("/stats")
+async def stats(request: Request):
+    """In-process cache and pipeline counters for monitoring."""
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    return {
+        "auth_cache": get_auth_cache_stats(),
+        "routing": get_routing_stats(),
+        "upstream_clients": get_client_pool().stats(),
+        "usage_counters": get_usage_counter().stats(),
+        "request_logs": get_log_writer().stats(),
+        "log_payloads": get_payload_policy().stats(),
+        "token_counts": get_token_cache_stats(),
+        "response_cache": get_cache_stats(),
+        "cache_policy": get_cache_policy().stats(),
+        "cache_refresh": get_cache_refresher().stats(),
+        "coalescing": get_coalescer().stats(),
+        "ingestion_jobs": get_ingestion_queue().stats(),
+    }
+
+
+class InvalidateRequest(BaseModel):
+    token: Optional[str] = None
+    user_id: Optional[str] = None
+
+
+@app.post("/admin/invalidate")
+async def invalidate(req: InvalidateRequest, request: Request):
+    """
+    Drop cached auth and routing data, e.g. right after a token or provider
+    key was revoked. Only affects this process; other workers pick the
+    change up within AUTH_CACHE_TTL / ROUTING_CACHE_TTL.
+    """
+    denied = check_admin(request)
+    if denied is not None:
+        return denied
+    if req.token is None and req.user_id is None:
+        invalidate_api_token()
+        invalidate_routing()
+    else:
+        if req.token is not None:
+            invalidate_api_token(req.token)
+        if req.user_id is not None:
+            invalidate_routing(req.user_id)
+    return {"status": "ok"}
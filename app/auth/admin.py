@@ -0,0 +1,29 @@
+"""
+Access check for operational endpoints (/stats, /admin/*).
+
+With ADMIN_API_KEY set, requests must send it as a bearer token. Without
+it, only clients connecting from the loopback interface are let in; behind
+a reverse proxy that is the proxy itself, so set ADMIN_API_KEY there.
+"""
+from config import ADMIN_API_KEY
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from typing import Optional
+import hmac
+
+_LOOPBACK = ("127.0.0.1", "::1", "localhost")
+
+
+def check_admin(request: Request) -> Optional[JSONResponse]:
+    """None if the request may use admin endpoints, otherwise the error response."""
+    if ADMIN_API_KEY:
+        authorization = request.headers.get("authorization") or ""
+        token = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else ""
+        if token and hmac.compare_digest(token.encode(), ADMIN_API_KEY.encode()):
+            return None
+    elif request.client is not None and request.client.host in _LOOPBACK:
+        return None
+    return JSONResponse(
+        status_code=403,
+        content={"error": {"message": "Forbidden", "type": "invalid_request_error", "code": "forbidden"}}
+    )
@@ -1,11 +1,39 @@
 from config import supabase_admin as supabase
+from config import AUTH_CACHE_TTL, AUTH_CACHE_NEGATIVE_TTL, AUTH_CACHE_MAX_ENTRIES
 from exceptions import InvalidAPIKeyError
+from utils.ttl_cache import TTLCache
 from typing import Optional
+import hashlib
 import logging
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# API token -> user_id cache. Stores None for tokens known to be invalid
+# (negative entries) so repeated bad tokens don't hit the database either.
+_auth_cache = TTLCache(maxsize=AUTH_CACHE_MAX_ENTRIES, ttl=AUTH_CACHE_TTL)
+
+
+def _auth_cache_key(api_key: str) -> str:
+    """Hash tokens so raw secrets are never kept as cache keys."""
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def invalidate_api_token(api_key: Optional[str] = None) -> None:
+    """
+    Drop a token from the auth cache, e.g. after it has been revoked.
+    Clears the whole cache when no token is given.
+    """
+    if api_key is None:
+        _auth_cache.clear()
+    else:
+        _auth_cache.pop(_auth_cache_key(api_key))
+
+
+def get_auth_cache_stats() -> dict:
+    """Return hit/miss counters for the auth cache."""
+    return _auth_cache.stats()
+
 
 def fetch_userid(api_key: str) -> str:
     """
@@ -20,6 +48,13 @@ def fetch_userid(api_key: str) -> str:
     Raises:
         InvalidAPIKeyError: If the API key is invalid or not found
     """
+    cache_key = _auth_cache_key(api_key)
+    cached = _auth_cache.get(cache_key, default=False)
+    if cached is None:
+        raise InvalidAPIKeyError("Invalid API Key")
+    if cached:
+        return cached
+
     try:
         # Try direct query first
         response = (
@@ -31,10 +66,13 @@ def fetch_userid(api_key: str) -> str:
         )
         
         if response.data:
-            return response.data[0]['user_id']
+            user_id = response.data[0]['user_id']
+            _auth_cache.set(cache_key, user_id)
+            return user_id
         
-        # If no result, raise error immediately
+        # If no result, remember the miss briefly and raise immediately
         logger.warning(f"Invalid API Key attempt: {api_key[:8]}...")
+        _auth_cache.set(cache_key, None, ttl=AUTH_CACHE_NEGATIVE_TTL)
         raise InvalidAPIKeyError("Invalid API Key")
         
     except InvalidAPIKeyError:
@@ -77,12 +115,13 @@ def fetch_api_keys(user_id: str, provider_id: str) -> list:
         return []
 
 
-def fetch_all_providers_with_keys(user_id: str) -> dict:
+def fetch_all_providers_with_keys(user_id: str, raise_errors: bool = False) -> dict:
     """
     Fetch all providers with their API keys for a user, grouped by provider.
     
     Args:
         user_id: The user's ID
+        raise_errors: Raise database errors instead of returning {}
         
     Returns:
         Dictionary mapping provider_id to list of API key records
@@ -90,7 +129,7 @@ def fetch_all_providers_with_keys(user_id: str) -> dict:
     try:
         response = (
             supabase.table("api_keys")
-            .select("*, providers(id, name, base_url)")
+            .select("*, providers(id, name, base_url, user_id)")
             .eq("user_id", user_id)
             .eq("is_active", True)
             .execute()
@@ -113,10 +152,26 @@ def fetch_all_providers_with_keys(user_id: str) -> dict:
         return providers_dict
         
     except Exception as e:
+        if raise_errors:
+            raise
         logger.error(f"Error fetching all providers with keys: {e}")
         return {}
 
 
+def fetch_user_providers(user_id: str) -> list:
+    """
+    Fetch the providers a user defined themselves, with or without keys.
+    Database errors are raised.
+    """
+    response = (
+        supabase.table("providers")
+        .select("id, name, base_url, user_id")
+        .eq("user_id", user_id)
+        .execute()
+    )
+    return response.data or []
+
+
 def increment_usage_count(api_key_id: str) -> None:
     """Increment the usage count for an API key."""
     try:
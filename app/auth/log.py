@@ -1,10 +1,340 @@
 from config import supabase_admin as supabase
+from config import (
+    LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_QUEUE_MAX, LOG_DROP_POLICY,
+    LOG_SPILL_PATH, LOG_SPILL_MAX_BYTES
+)
+from utils.log_policy import get_payload_policy
 from datetime import datetime, timezone
+from typing import List, Optional
+import asyncio
+import json
 import logging
+import os
+import time
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+
+def _is_rejection(e: Exception) -> bool:
+    """
+    True if the database refused the rows themselves (bad values, constraint
+    violations, unknown columns), so writing them again can't succeed.
+    """
+    code = str(getattr(e, "code", None) or "")
+    # SQLSTATE classes 22 (data), 23 (integrity), 42 (syntax, undefined
+    # columns, privileges); PostgREST request and schema errors. PGRST0xx
+    # means the database couldn't be reached.
+    if code[:2] in ("22", "23", "42") and len(code) == 5:
+        return True
+    if code.startswith(("PGRST1", "PGRST2")):
+        return True
+    # No JSON body: the code is the HTTP status
+    return code.isdigit() and 400 <= int(code) < 500 and code not in ("408", "429")
+
+
+class RequestLogWriter:
+    """
+    Buffered writer for the request_logs table.
+
+    Rows are queued in memory and inserted in batches by a background task,
+    either when LOG_BATCH_SIZE rows are waiting or every LOG_FLUSH_INTERVAL
+    seconds. When the queue is full, LOG_DROP_POLICY decides what happens.
+    If Supabase is unreachable, batches are appended to a local spill file.
+    Once an insert succeeds again the file is moved aside (".replay") and
+    replayed one batch at a time, between live batches, so the queue keeps
+    moving. Rows the database rejects, and spill lines that can't be parsed,
+    are set aside in a ".rejected" file next to it instead of being retried.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_interval: float = LOG_FLUSH_INTERVAL,
+        max_queue: int = LOG_QUEUE_MAX,
+        drop_policy: str = LOG_DROP_POLICY,
+        spill_path: str = LOG_SPILL_PATH,
+        spill_max_bytes: int = LOG_SPILL_MAX_BYTES,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+        self.spill_path = spill_path
+        self.spill_max_bytes = spill_max_bytes
+        self.rejected_path = spill_path + ".rejected"
+        self.replay_path = spill_path + ".replay"
+        # Byte offset of the next row to replay, kept on disk so a restart
+        # doesn't replay rows twice
+        self._offset_path = self.replay_path + ".offset"
+        # Cleared when an insert fails; replay waits for a live insert then
+        self._replay_ok = True
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Batch being written, and rows collected but not yet handed off,
+        # when stop() cancels the flusher
+        self._writing: Optional[asyncio.Future] = None
+        self._unwritten: List[dict] = []
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.rejected = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self) -> None:
+        """Start the background flusher. Must be called from the event loop."""
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flusher and write out everything still queued."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        if self._writing is not None:
+            await self._writing
+            self._writing = None
+        rows, self._unwritten = self._unwritten, []
+        await self._write_batch(rows)
+        while not self._queue.empty():
+            await self._write_batch(self._drain(self.batch_size))
+
+    async def submit(self, row: dict) -> None:
+        """Queue a row for insertion, applying the drop policy when full."""
+        if not self._queue.full():
+            self._queue.put_nowait(row)
+            return
+
+        if self.drop_policy == "block":
+            # Backpressure: wait for the flusher to make room
+            await self._queue.put(row)
+        elif self.drop_policy == "drop_newest":
+            self.dropped += 1
+        else:
+            self._queue.get_nowait()
+            self._queue.put_nowait(row)
+            self.dropped += 1
+
+    def _drain(self, limit: int) -> List[dict]:
+        rows = []
+        while len(rows) < limit and not self._queue.empty():
+            rows.append(self._queue.get_nowait())
+        return rows
+
+    async def _run(self) -> None:
+        rows: List[dict] = []
+        try:
+            while True:
+                rows = [await self._wait_for_rows()]
+                deadline = time.monotonic() + self.flush_interval
+                while len(rows) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        rows.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+                    except asyncio.TimeoutError:
+                        break
+                    rows.extend(self._drain(self.batch_size - len(rows)))
+                batch, rows = rows, []
+                await self._shielded(self._write_batch(batch))
+                if self._replay_pending():
+                    await self._shielded(asyncio.to_thread(self._replay_slice))
+        finally:
+            # Written by stop()
+            self._unwritten = rows
+
+    async def _wait_for_rows(self) -> dict:
+        # Replay spilled rows while there is nothing live to write
+        while self._queue.empty() and self._replay_pending():
+            await self._shielded(asyncio.to_thread(self._replay_slice))
+        return await self._queue.get()
+
+    async def _shielded(self, aw) -> None:
+        # Shielded, so stop() can't interrupt a write half way
+        self._writing = asyncio.ensure_future(aw)
+        await asyncio.shield(self._writing)
+        self._writing = None
+
+    async def _write_batch(self, rows: List[dict]) -> None:
+        if not rows:
+            return
+        unwritten = await asyncio.to_thread(self._insert_valid, rows)
+        if unwritten:
+            logger.error(f"Spilling {len(unwritten)} request logs to disk")
+            self._replay_ok = False
+            await asyncio.to_thread(self._spill, unwritten)
+        else:
+            self._replay_ok = True
+
+    def _insert(self, rows: List[dict]) -> None:
+        supabase.table("request_logs").insert(rows).execute()
+        self.written += len(rows)
+        self.batches += 1
+
+    def _insert_valid(self, rows: List[dict]) -> List[dict]:
+        """
+        Insert rows, setting aside any the database rejects. Returns the rows
+        that failed for other reasons and are worth retrying.
+        """
+        try:
+            self._insert(rows)
+            return []
+        except Exception as e:
+            if not _is_rejection(e):
+                logger.error(f"Failed to write {len(rows)} request logs: {e}")
+                return rows
+            if len(rows) == 1:
+                logger.error(f"Request log rejected by the database, moved to {self.rejected_path}: {e}")
+                if self._append_spill(rows, self.rejected_path):
+                    self.rejected += 1
+                else:
+                    self.dropped += 1
+                return []
+        # Bisect to find the rejected rows and write the rest
+        half = len(rows) // 2
+        return self._insert_valid(rows[:half]) + self._insert_valid(rows[half:])
+
+    def _spill(self, rows: List[dict]) -> None:
+        if self._append_spill(rows):
+            self.spilled += len(rows)
+        else:
+            self.dropped += len(rows)
+
+    def _append_spill(self, rows: List[dict], path: Optional[str] = None) -> bool:
+        return self._append_lines([json.dumps(row, default=str) for row in rows], path or self.spill_path)
+
+    def _append_lines(self, lines: List[str], path: str) -> bool:
+        try:
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            if size >= self.spill_max_bytes:
+                logger.error(f"Log spill file {path} is full ({size} bytes), dropping {len(lines)} rows")
+                return False
+            with open(path, "a", encoding="utf-8") as f:
+                for line in lines:
+                    f.write(line + "\n")
+            return True
+        except OSError as e:
+            logger.error(f"Failed to spill request logs to {path}: {e}")
+            return False
+
+    def _replay_pending(self) -> bool:
+        if not self._replay_ok:
+            return False
+        return os.path.exists(self.replay_path) or os.path.exists(self.spill_path)
+
+    def _replay_offset(self) -> int:
+        try:
+            with open(self._offset_path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _replay_slice(self) -> None:
+        """Re-insert the next batch_size spilled rows."""
+        try:
+            if not os.path.exists(self.replay_path):
+                if not os.path.exists(self.spill_path):
+                    return
+                # New spills go to a fresh file while this one is replayed
+                if os.path.exists(self._offset_path):
+                    os.remove(self._offset_path)
+                os.replace(self.spill_path, self.replay_path)
+                offset = 0
+            else:
+                # Left over from an earlier replay (or process): finish it first
+                offset = self._replay_offset()
+            rows, unreadable = [], []
+            with open(self.replay_path, "rb") as f:
+                f.seek(offset)
+                while len(rows) < self.batch_size:
+                    line = f.readline()
+                    if not line:
+                        break
+                    offset += len(line)
+                    if not line.strip():
+                        continue
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        row = None
+                    if isinstance(row, dict):
+                        rows.append(row)
+                    else:
+                        # e.g. the last line of a file cut short by a crash
+                        unreadable.append(line.decode("utf-8", "replace").rstrip("\n"))
+                finished = offset >= os.fstat(f.fileno()).st_size
+        except OSError as e:
+            logger.error(f"Failed to read log spill file: {e}")
+            self._replay_ok = False
+            return
+
+        if unreadable:
+            logger.error(f"Moving {len(unreadable)} unreadable log spill lines to {self.rejected_path}")
+            if self._append_lines(unreadable, self.rejected_path):
+                self.rejected += len(unreadable)
+            else:
+                self.dropped += len(unreadable)
+
+        written = self.written
+        unwritten = self._insert_valid(rows) if rows else []
+        self.replayed += self.written - written
+        if unwritten:
+            logger.error("Log spill replay failed, will retry later")
+            self._replay_ok = False
+            if not self._append_spill(unwritten):
+                self.dropped += len(unwritten)
+
+        try:
+            if finished:
+                # Offset first: a crash in between replays rows again rather
+                # than skipping them
+                if os.path.exists(self._offset_path):
+                    os.remove(self._offset_path)
+                os.remove(self.replay_path)
+            else:
+                with open(self._offset_path, "w") as f:
+                    f.write(str(offset))
+        except OSError as e:
+            logger.error(f"Failed to record log spill replay progress: {e}")
+            self._replay_ok = False
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "rejected": self.rejected,
+            "drop_policy": self.drop_policy,
+        }
+
+
+_log_writer = None
+
+
+def get_log_writer() -> RequestLogWriter:
+    """Get or create the process-wide request log writer."""
+    global _log_writer
+    if _log_writer is None:
+        _log_writer = RequestLogWriter()
+    return _log_writer
+
+
 async def log_request(
     user_id: str,
     api_key: str,
@@ -26,7 +356,8 @@ async def log_request(
     is_cache_hit: bool = False
 ):
     """
-    Insert a log into the request_logs table.
+    Queue a log for the request_logs table.
+    Falls back to a direct insert when the buffered writer is not running.
     """
     # Split provider and model if combined
     provider_name, model_name = model.split(":", 1) if ":" in model else (provider, model)
@@ -34,6 +365,13 @@ async def log_request(
     # Current timestamp as ISO string
     timestamp = datetime.now(timezone.utc).isoformat()
 
+    # Sample, truncate, hash and/or compress payloads before storing them;
+    # a row keeps both payloads or neither
+    policy = get_payload_policy()
+    store = policy.should_store(user_id, status)
+    request_payload = policy.apply(request_payload, user_id, status, store)
+    response_payload = policy.apply(response_payload, user_id, status, store)
+
     log_data = {
         "user_id": user_id,
         "api_key": api_key,
@@ -57,11 +395,15 @@ async def log_request(
     }
 
     try:
-        supabase.table("request_logs").insert(log_data).execute()
+        writer = get_log_writer()
+        if writer.running:
+            await writer.submit(log_data)
+        else:
+            await asyncio.to_thread(supabase.table("request_logs").insert(log_data).execute)
         # Log successful requests at debug level, errors at warning level
         if status >= 400:
             logger.warning(f"Request failed - User: {user_id}, Provider: {provider_name}, Model: {model_name}, Status: {status}, Key: {key_name}")
         else:
             logger.debug(f"Request successful - User: {user_id}, Provider: {provider_name}, Model: {model_name}, Tokens: {total_tokens}, Key: {key_name}")
     except Exception as e:
-        logger.error(f"Failed to log request to database: {e}")
\ No newline at end of file
+        logger.error(f"Failed to log request to database: {e}")
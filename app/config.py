@@ -1,5 +1,6 @@
 from supabase import create_client
 from dotenv import load_dotenv
+import json
 import os
 import sys
 
@@ -52,3 +53,173 @@ CORS_ORIGINS = [origin.strip() for origin in CORS_ORIGINS if origin.strip()]
 
 # Rate limiting (requests per minute)
 RATE_LIMIT = int(os.getenv("RATE_LIMIT", "60"))
+
+# Bearer token for /stats and /admin/*; when unset they only answer loopback clients
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY", "")
+
+# Auth cache: API token -> user_id resolution (seconds / entries)
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_NEGATIVE_TTL = float(os.getenv("AUTH_CACHE_NEGATIVE_TTL", "30"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+# Routing snapshot: per-user provider/key table (seconds / users)
+ROUTING_CACHE_TTL = float(os.getenv("ROUTING_CACHE_TTL", "60"))
+ROUTING_CACHE_MAX_USERS = int(os.getenv("ROUTING_CACHE_MAX_USERS", "5000"))
+
+# Upstream HTTP client pool (shared across requests)
+UPSTREAM_MAX_CLIENTS = int(os.getenv("UPSTREAM_MAX_CLIENTS", "500"))
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+
+# Batched API key usage counters (seconds / distinct keys)
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+USAGE_MAX_PENDING_KEYS = int(os.getenv("USAGE_MAX_PENDING_KEYS", "10000"))
+
+# Buffered request_logs writer
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "2"))
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LOG_DROP_POLICY = os.getenv("LOG_DROP_POLICY", "drop_oldest")  # drop_oldest, drop_newest or block
+LOG_SPILL_PATH = os.getenv("LOG_SPILL_PATH", "/tmp/unio_request_logs.jsonl")
+LOG_SPILL_MAX_BYTES = int(os.getenv("LOG_SPILL_MAX_BYTES", str(100 * 1024 * 1024)))
+
+# request_logs payload policy (rates are 0.0-1.0, 0 disables a size limit)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))
+LOG_PAYLOAD_ERROR_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_ERROR_SAMPLE_RATE", "1.0"))
+LOG_PAYLOAD_STATUS_SAMPLE_RATES = json.loads(os.getenv("LOG_PAYLOAD_STATUS_SAMPLE_RATES", "{}"))
+LOG_PAYLOAD_USER_SAMPLE_RATES = json.loads(os.getenv("LOG_PAYLOAD_USER_SAMPLE_RATES", "{}"))
+LOG_PAYLOAD_MAX_FIELD_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_FIELD_CHARS", "4000"))
+LOG_PAYLOAD_HASH_MESSAGES = os.getenv("LOG_PAYLOAD_HASH_MESSAGES", "false").lower() == "true"
+LOG_PAYLOAD_COMPRESS_MIN_BYTES = int(os.getenv("LOG_PAYLOAD_COMPRESS_MIN_BYTES", "0"))
+
+# Token counting: memoized per-message counts; new messages adding up to
+# TOKEN_OFFLOAD_MIN_CHARS are batch-encoded off the event loop
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "50000"))
+TOKEN_OFFLOAD_MIN_CHARS = int(os.getenv("TOKEN_OFFLOAD_MIN_CHARS", "200000"))
+
+# In-memory L1 tier in front of the semantic_cache table
+CACHE_L1_TTL = float(os.getenv("CACHE_L1_TTL", "300"))
+CACHE_L1_MAX_ENTRIES = int(os.getenv("CACHE_L1_MAX_ENTRIES", "10000"))
+CACHE_L1_MAX_BYTES = int(os.getenv("CACHE_L1_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Local ANN index for semantic cache lookups (falls back to the
+# match_semantic_cache RPC until the index has loaded, and for partitions
+# that didn't fit)
+SEMANTIC_INDEX_ENABLED = os.getenv("SEMANTIC_INDEX_ENABLED", "true").lower() == "true"
+SEMANTIC_INDEX_DIR = os.getenv("SEMANTIC_INDEX_DIR", "/tmp/unio_semantic_index")
+SEMANTIC_INDEX_IVF_MIN_ENTRIES = int(os.getenv("SEMANTIC_INDEX_IVF_MIN_ENTRIES", "20000"))
+SEMANTIC_INDEX_NPROBE = int(os.getenv("SEMANTIC_INDEX_NPROBE", "8"))
+# Memory bound (~6 KB per 1536-dim entry); partitions that don't fit are
+# left to the RPC
+SEMANTIC_INDEX_MAX_ENTRIES = int(os.getenv("SEMANTIC_INDEX_MAX_ENTRIES", "100000"))
+SEMANTIC_INDEX_MAX_PARTITION_ENTRIES = int(os.getenv("SEMANTIC_INDEX_MAX_PARTITION_ENTRIES", "50000"))
+
+# How the local cache indexes pick up semantic_cache rows: the rows created
+# since the last pass every CACHE_INDEX_REFRESH_INTERVAL seconds (which also
+# bounds how long another instance's rows stay unseen), and a full reload
+# every CACHE_INDEX_REBUILD_INTERVAL seconds, which drops deleted rows
+CACHE_INDEX_REFRESH_INTERVAL = float(os.getenv("CACHE_INDEX_REFRESH_INTERVAL", os.getenv("SEMANTIC_INDEX_REFRESH_INTERVAL", "60")))
+CACHE_INDEX_REBUILD_INTERVAL = float(os.getenv("CACHE_INDEX_REBUILD_INTERVAL", "86400"))
+
+# Lexical (SimHash) pre-filter for semantic lookups, in Hamming distance out
+# of 64 bits: no stored prompt within LEXICAL_NEIGHBOUR_DISTANCE skips the
+# embedding, once the shadow checks have sampled LEXICAL_SKIP_MIN_SAMPLES
+# embedding-tier hits and measured a lexical recall of at least
+# LEXICAL_SKIP_MIN_RECALL over them. One within LEXICAL_NEAR_DUP_DISTANCE is only answered directly
+# when LEXICAL_NEAR_DUP_ANSWER is on and the shadow checks have measured a
+# near-duplicate precision of at least LEXICAL_NEAR_DUP_MIN_PRECISION
+LEXICAL_INDEX_ENABLED = os.getenv("LEXICAL_INDEX_ENABLED", "true").lower() == "true"
+LEXICAL_NEIGHBOUR_DISTANCE = int(os.getenv("LEXICAL_NEIGHBOUR_DISTANCE", "12"))
+LEXICAL_NEAR_DUP_DISTANCE = int(os.getenv("LEXICAL_NEAR_DUP_DISTANCE", "3"))
+LEXICAL_SHADOW_SAMPLE_RATE = float(os.getenv("LEXICAL_SHADOW_SAMPLE_RATE", "0.05"))
+LEXICAL_SKIP_MIN_RECALL = float(os.getenv("LEXICAL_SKIP_MIN_RECALL", "0.98"))
+LEXICAL_SKIP_MIN_SAMPLES = int(os.getenv("LEXICAL_SKIP_MIN_SAMPLES", "200"))
+LEXICAL_NEAR_DUP_ANSWER = os.getenv("LEXICAL_NEAR_DUP_ANSWER", "false").lower() == "true"
+LEXICAL_NEAR_DUP_MIN_PRECISION = float(os.getenv("LEXICAL_NEAR_DUP_MIN_PRECISION", "0.99"))
+LEXICAL_NEAR_DUP_MIN_SAMPLES = int(os.getenv("LEXICAL_NEAR_DUP_MIN_SAMPLES", "200"))
+
+# Embedding memo shared by the semantic cache and vault retrieval
+# (an empty path disables the on-disk snapshot)
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "20000"))
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "")
+
+# Embedding micro-batching: concurrent misses within the window share one
+# call, of at most EMBEDDING_BATCH_MAX_SIZE texts and (estimated)
+# EMBEDDING_BATCH_MAX_TOKENS tokens (0: no token cap)
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "64"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+
+# semantic_cache lifecycle: expiry, per-(user, model) quotas (0 disables a
+# limit) and background compaction (seconds / rows per batch)
+CACHE_TTL = float(os.getenv("CACHE_TTL", str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "5000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+CACHE_USER_QUOTAS = json.loads(os.getenv("CACHE_USER_QUOTAS", "{}"))
+CACHE_COMPACTION_INTERVAL = float(os.getenv("CACHE_COMPACTION_INTERVAL", "300"))
+CACHE_COMPACTION_BATCH_SIZE = int(os.getenv("CACHE_COMPACTION_BATCH_SIZE", "500"))
+CACHE_HIT_FLUSH_INTERVAL = float(os.getenv("CACHE_HIT_FLUSH_INTERVAL", "10"))
+
+# Cacheability policy: which requests look up / store in the response cache.
+# Users below CACHE_POLICY_MIN_HIT_RATE (after CACHE_POLICY_MIN_SAMPLES full
+# lookups) skip semantic lookups and stores, except for an exploration share
+CACHE_POLICY_ENABLED = os.getenv("CACHE_POLICY_ENABLED", "true").lower() == "true"
+CACHE_POLICY_MAX_TEMPERATURE = float(os.getenv("CACHE_POLICY_MAX_TEMPERATURE", "1.0"))
+CACHE_POLICY_MIN_PROMPT_CHARS = int(os.getenv("CACHE_POLICY_MIN_PROMPT_CHARS", "16"))
+CACHE_POLICY_MAX_PROMPT_CHARS = int(os.getenv("CACHE_POLICY_MAX_PROMPT_CHARS", "16000"))
+CACHE_POLICY_MODEL_DENYLIST = [m.strip() for m in os.getenv("CACHE_POLICY_MODEL_DENYLIST", "").split(",") if m.strip()]
+CACHE_POLICY_MIN_SAMPLES = int(os.getenv("CACHE_POLICY_MIN_SAMPLES", "50"))
+CACHE_POLICY_MIN_HIT_RATE = float(os.getenv("CACHE_POLICY_MIN_HIT_RATE", "0.02"))
+CACHE_POLICY_EXPLORE_RATE = float(os.getenv("CACHE_POLICY_EXPLORE_RATE", "0.05"))
+CACHE_POLICY_MAX_USERS = int(os.getenv("CACHE_POLICY_MAX_USERS", "10000"))
+
+# Stale-while-revalidate cache mode (opt-in per request or X-Cache-Mode):
+# hits older than CACHE_SWR_FRESHNESS seconds are served and refreshed in the
+# background; hits older than CACHE_SWR_MAX_STALENESS (0 = no bound) are misses
+CACHE_SWR_FRESHNESS = float(os.getenv("CACHE_SWR_FRESHNESS", "300"))
+CACHE_SWR_MAX_STALENESS = float(os.getenv("CACHE_SWR_MAX_STALENESS", "86400"))
+CACHE_SWR_MAX_CONCURRENT_REFRESHES = int(os.getenv("CACHE_SWR_MAX_CONCURRENT_REFRESHES", "4"))
+
+# Share one upstream call between identical concurrent requests
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+
+# Streaming cache hits: "burst" replays as fast as possible, "paced" mimics generation
+CACHE_REPLAY_MODE = os.getenv("CACHE_REPLAY_MODE", "burst")
+CACHE_REPLAY_CHUNK_CHARS = int(os.getenv("CACHE_REPLAY_CHUNK_CHARS", "256"))
+CACHE_REPLAY_CHARS_PER_SECOND = float(os.getenv("CACHE_REPLAY_CHARS_PER_SECOND", "4000"))
+
+# Vault uploads: size limit, spool directory (empty = system temp dir) and
+# the process pool that parses documents. At most INGEST_MAX_PENDING_TASKS
+# batches of INGEST_PAGES_PER_TASK pages are parsed ahead of the chunker.
+VAULT_UPLOAD_MAX_BYTES = int(os.getenv("VAULT_UPLOAD_MAX_BYTES", str(50 * 1024 * 1024)))
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "")
+INGEST_PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", "2"))
+INGEST_PAGES_PER_TASK = int(os.getenv("INGEST_PAGES_PER_TASK", "8"))
+INGEST_MAX_PENDING_TASKS = int(os.getenv("INGEST_MAX_PENDING_TASKS", "4"))
+
+# Vault embedding: batches are filled up to INGEST_EMBED_BATCH_TOKENS tokens
+# (and INGEST_EMBED_BATCH_MAX_INPUTS chunks); up to INGEST_EMBED_CONCURRENCY
+# are embedded and stored at once, each retried on transient errors
+INGEST_EMBED_CONCURRENCY = int(os.getenv("INGEST_EMBED_CONCURRENCY", "4"))
+INGEST_EMBED_BATCH_TOKENS = int(os.getenv("INGEST_EMBED_BATCH_TOKENS", "8000"))
+INGEST_EMBED_BATCH_MAX_INPUTS = int(os.getenv("INGEST_EMBED_BATCH_MAX_INPUTS", "128"))
+INGEST_EMBED_MAX_RETRIES = int(os.getenv("INGEST_EMBED_MAX_RETRIES", "4"))
+INGEST_EMBED_RETRY_BACKOFF = float(os.getenv("INGEST_EMBED_RETRY_BACKOFF", "0.5"))
+
+# Vault chunking: "recursive" packs paragraphs/sentences into chunks of up to
+# VAULT_CHUNK_TOKENS tokens; "character" is the original fixed-size splitter
+VAULT_CHUNKER = os.getenv("VAULT_CHUNKER", "recursive")
+VAULT_CHUNK_TOKENS = int(os.getenv("VAULT_CHUNK_TOKENS", "400"))
+VAULT_CHUNK_OVERLAP_TOKENS = int(os.getenv("VAULT_CHUNK_OVERLAP_TOKENS", "40"))
+VAULT_CHUNK_CHARS = int(os.getenv("VAULT_CHUNK_CHARS", "1000"))
+VAULT_CHUNK_OVERLAP_CHARS = int(os.getenv("VAULT_CHUNK_OVERLAP_CHARS", "200"))
+
+# Vault ingestion jobs: uploads are queued (at most INGEST_JOB_QUEUE_SIZE
+# waiting) and run by INGEST_JOB_WORKERS background workers. Finished and
+# failed jobs are kept for INGEST_JOB_RETENTION seconds for status and retries.
+INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "2"))
+INGEST_JOB_QUEUE_SIZE = int(os.getenv("INGEST_JOB_QUEUE_SIZE", "100"))
+INGEST_JOB_RETENTION = float(os.getenv("INGEST_JOB_RETENTION", "3600"))
@@ -0,0 +1,17 @@
+-- Bulk usage counter RPC used by the gateway's batched usage flusher
+-- Run this in your Supabase SQL Editor
+
+-- deltas: [{"key_id": "<uuid>", "usage": 3, "rate_limited": 1}, ...]
+CREATE OR REPLACE FUNCTION public.increment_api_key_usage_bulk(deltas JSONB)
+RETURNS VOID AS $$
+BEGIN
+  UPDATE public.api_keys AS k
+  SET usage_count = k.usage_count + (d->>'usage')::INTEGER
+  FROM jsonb_array_elements(deltas) AS d
+  WHERE k.id = (d->>'key_id')::UUID
+    AND (d->>'usage')::INTEGER > 0;
+
+  -- rate_limited is accepted but not stored yet, matching
+  -- increment_api_key_rate_limit which is still a placeholder.
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
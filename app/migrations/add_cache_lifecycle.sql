@@ -0,0 +1,110 @@
+-- Semantic cache lifecycle: expiry, hit tracking and quota compaction
+-- Run this in your Supabase SQL Editor
+
+-- 1. Lifecycle columns
+ALTER TABLE semantic_cache ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now();
+ALTER TABLE semantic_cache ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ;
+ALTER TABLE semantic_cache ADD COLUMN IF NOT EXISTS hit_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE semantic_cache ADD COLUMN IF NOT EXISTS last_hit_at TIMESTAMPTZ;
+ALTER TABLE semantic_cache ADD COLUMN IF NOT EXISTS size_bytes INTEGER NOT NULL DEFAULT 0;
+
+-- Backfill sizes so existing rows count against quotas
+UPDATE semantic_cache
+SET size_bytes = octet_length(prompt) + octet_length(response::text)
+WHERE size_bytes = 0;
+
+-- 2. Indexes for expiry sweeps and per-(user, model) eviction order
+CREATE INDEX IF NOT EXISTS idx_cache_expires_at
+ON semantic_cache(expires_at) WHERE expires_at IS NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_cache_eviction
+ON semantic_cache(user_id, model, hit_count, last_hit_at);
+
+-- 3. Semantic lookup skips expired rows and returns the row id for hit tracking
+DROP FUNCTION IF EXISTS match_semantic_cache(vector, float, int, uuid, text);
+CREATE OR REPLACE FUNCTION match_semantic_cache(
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  p_user_id uuid,
+  p_model text
+)
+RETURNS TABLE (id uuid, response jsonb, similarity float)
+LANGUAGE sql STABLE
+AS $$
+  SELECT c.id, c.response, 1 - (c.embedding <=> query_embedding) AS similarity
+  FROM semantic_cache c
+  WHERE c.user_id = p_user_id
+    AND c.model = p_model
+    AND (c.expires_at IS NULL OR c.expires_at > now())
+    AND 1 - (c.embedding <=> query_embedding) > match_threshold
+  ORDER BY c.embedding <=> query_embedding
+  LIMIT match_count;
+$$;
+
+-- 4. Buffered hit counts from the gateway
+-- hits: [{"id": "<uuid>", "hits": 3}, ...]
+CREATE OR REPLACE FUNCTION public.record_semantic_cache_hits(hits JSONB)
+RETURNS VOID AS $$
+BEGIN
+  UPDATE public.semantic_cache AS c
+  SET hit_count = c.hit_count + (h->>'hits')::INTEGER,
+      last_hit_at = now()
+  FROM jsonb_array_elements(hits) AS h
+  WHERE c.id = (h->>'id')::UUID;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+-- 5. Compaction: delete one batch of expired or over-quota rows
+-- Quotas apply per (user_id, model). Rows are evicted least frequently used
+-- first (hit_count, then last hit / creation time). p_user_quotas overrides
+-- the defaults: {"<user_id>": {"max_entries": 100, "max_bytes": 1048576}}
+-- Returns the deleted rows so gateways can drop them from local indexes.
+CREATE OR REPLACE FUNCTION public.compact_semantic_cache(
+  p_max_entries INTEGER,
+  p_max_bytes BIGINT,
+  p_batch_size INTEGER,
+  p_user_quotas JSONB DEFAULT '{}'::JSONB
+)
+RETURNS TABLE (id UUID, user_id UUID, model TEXT) AS $$
+BEGIN
+  RETURN QUERY
+  WITH expired AS (
+    SELECT c.id
+    FROM public.semantic_cache c
+    WHERE c.expires_at IS NOT NULL AND c.expires_at <= now()
+    LIMIT p_batch_size
+  ),
+  ranked AS (
+    SELECT
+      c.id,
+      c.user_id,
+      row_number() OVER w AS entry_rank,
+      sum(c.size_bytes) OVER w AS cumulative_bytes
+    FROM public.semantic_cache c
+    WHERE c.expires_at IS NULL OR c.expires_at > now()
+    -- Most valuable rows first, so everything past the quota is evicted
+    WINDOW w AS (
+      PARTITION BY c.user_id, c.model
+      ORDER BY c.hit_count DESC, COALESCE(c.last_hit_at, c.created_at) DESC
+    )
+  ),
+  over_quota AS (
+    SELECT r.id
+    FROM ranked r
+    WHERE r.entry_rank > COALESCE((p_user_quotas->(r.user_id::TEXT)->>'max_entries')::INTEGER, p_max_entries)
+       OR r.cumulative_bytes > COALESCE((p_user_quotas->(r.user_id::TEXT)->>'max_bytes')::BIGINT, p_max_bytes)
+    LIMIT p_batch_size
+  ),
+  victims AS (
+    SELECT e.id FROM expired e
+    UNION
+    SELECT o.id FROM over_quota o
+    LIMIT p_batch_size
+  )
+  DELETE FROM public.semantic_cache AS c
+  USING victims v
+  WHERE c.id = v.id
+  RETURNING c.id, c.user_id, c.model;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
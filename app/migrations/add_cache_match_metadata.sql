@@ -0,0 +1,26 @@
+-- Return row metadata from semantic matches, so RPC hits carry cached_at
+-- Run this in your Supabase SQL Editor (after add_cache_scope.sql)
+
+-- The result columns change, so the function has to be dropped first
+DROP FUNCTION IF EXISTS match_semantic_cache(vector, float, int, uuid, text, text);
+CREATE OR REPLACE FUNCTION match_semantic_cache(
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  p_user_id uuid,
+  p_model text,
+  p_scope text
+)
+RETURNS TABLE (id uuid, response jsonb, metadata jsonb, similarity float)
+LANGUAGE sql STABLE
+AS $$
+  SELECT c.id, c.response, c.metadata, 1 - (c.embedding <=> query_embedding) AS similarity
+  FROM semantic_cache c
+  WHERE c.user_id = p_user_id
+    AND c.model = p_model
+    AND (c.scope = p_scope OR c.scope IS NULL)
+    AND (c.expires_at IS NULL OR c.expires_at > now())
+    AND 1 - (c.embedding <=> query_embedding) > match_threshold
+  ORDER BY c.embedding <=> query_embedding
+  LIMIT match_count;
+$$;
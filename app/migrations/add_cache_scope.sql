@@ -0,0 +1,88 @@
+-- Request-parameter scope of each cached prompt (RequestFingerprint.scope)
+-- Run this in your Supabase SQL Editor
+
+-- 1. Scope column. Rows saved before it existed keep NULL and are matched
+-- under any scope, as they were before.
+ALTER TABLE semantic_cache ADD COLUMN IF NOT EXISTS scope TEXT;
+
+-- 2. Move scopes that were briefly stored as "<model>#<scope>" into the column
+UPDATE semantic_cache
+SET scope = right(model, 16),
+    model = left(model, -17)
+WHERE scope IS NULL AND model ~ '#[0-9a-f]{16}$';
+
+-- 3. Semantic lookup within a scope (plus unscoped older rows)
+DROP FUNCTION IF EXISTS match_semantic_cache(vector, float, int, uuid, text);
+CREATE OR REPLACE FUNCTION match_semantic_cache(
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  p_user_id uuid,
+  p_model text,
+  p_scope text
+)
+RETURNS TABLE (id uuid, response jsonb, similarity float)
+LANGUAGE sql STABLE
+AS $$
+  SELECT c.id, c.response, 1 - (c.embedding <=> query_embedding) AS similarity
+  FROM semantic_cache c
+  WHERE c.user_id = p_user_id
+    AND c.model = p_model
+    AND (c.scope = p_scope OR c.scope IS NULL)
+    AND (c.expires_at IS NULL OR c.expires_at > now())
+    AND 1 - (c.embedding <=> query_embedding) > match_threshold
+  ORDER BY c.embedding <=> query_embedding
+  LIMIT match_count;
+$$;
+
+-- 4. Compaction also returns the scope, so gateways can drop deleted rows
+-- from their local indexes. Quotas stay per (user_id, model).
+DROP FUNCTION IF EXISTS public.compact_semantic_cache(INTEGER, BIGINT, INTEGER, JSONB);
+CREATE OR REPLACE FUNCTION public.compact_semantic_cache(
+  p_max_entries INTEGER,
+  p_max_bytes BIGINT,
+  p_batch_size INTEGER,
+  p_user_quotas JSONB DEFAULT '{}'::JSONB
+)
+RETURNS TABLE (id UUID, user_id UUID, model TEXT, scope TEXT) AS $$
+BEGIN
+  RETURN QUERY
+  WITH expired AS (
+    SELECT c.id
+    FROM public.semantic_cache c
+    WHERE c.expires_at IS NOT NULL AND c.expires_at <= now()
+    LIMIT p_batch_size
+  ),
+  ranked AS (
+    SELECT
+      c.id,
+      c.user_id,
+      row_number() OVER w AS entry_rank,
+      sum(c.size_bytes) OVER w AS cumulative_bytes
+    FROM public.semantic_cache c
+    WHERE c.expires_at IS NULL OR c.expires_at > now()
+    -- Most valuable rows first, so everything past the quota is evicted
+    WINDOW w AS (
+      PARTITION BY c.user_id, c.model
+      ORDER BY c.hit_count DESC, COALESCE(c.last_hit_at, c.created_at) DESC
+    )
+  ),
+  over_quota AS (
+    SELECT r.id
+    FROM ranked r
+    WHERE r.entry_rank > COALESCE((p_user_quotas->(r.user_id::TEXT)->>'max_entries')::INTEGER, p_max_entries)
+       OR r.cumulative_bytes > COALESCE((p_user_quotas->(r.user_id::TEXT)->>'max_bytes')::BIGINT, p_max_bytes)
+    LIMIT p_batch_size
+  ),
+  victims AS (
+    SELECT e.id FROM expired e
+    UNION
+    SELECT o.id FROM over_quota o
+    LIMIT p_batch_size
+  )
+  DELETE FROM public.semantic_cache AS c
+  USING victims v
+  WHERE c.id = v.id
+  RETURNING c.id, c.user_id, c.model, c.scope;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
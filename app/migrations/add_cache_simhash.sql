@@ -0,0 +1,7 @@
+-- SimHash of each cached prompt for the gateway's lexical pre-filter
+-- Run this in your Supabase SQL Editor
+
+-- Signatures are unsigned 64-bit values stored as BIGINT (two's complement).
+-- Existing rows are left NULL; the gateway hashes their prompts when it
+-- rebuilds its index.
+ALTER TABLE semantic_cache ADD COLUMN IF NOT EXISTS simhash BIGINT;
@@ -0,0 +1,10 @@
+-- Idempotent vault chunk inserts
+-- Run this in your Supabase SQL Editor (after add_vault_content_hashes.sql)
+
+-- Character offset of the chunk in its document (also metadata.start).
+-- (document_id, content_hash, chunk_start) identifies a chunk, so a batch
+-- insert that timed out after committing can be retried without storing
+-- its chunks twice. Rows stored before this migration are left NULL.
+ALTER TABLE vault_embeddings ADD COLUMN IF NOT EXISTS chunk_start INTEGER;
+CREATE UNIQUE INDEX IF NOT EXISTS vault_embeddings_chunk_key_idx
+    ON vault_embeddings (document_id, content_hash, chunk_start);
@@ -0,0 +1,6 @@
+-- Where each vault chunk came from: page range, character offsets, tokens
+-- Run this in your Supabase SQL Editor
+
+-- e.g. {"page": 3, "page_end": 4, "start": 10240, "end": 11873, "tokens": 398}
+-- Rows stored before this migration are left NULL.
+ALTER TABLE vault_embeddings ADD COLUMN IF NOT EXISTS metadata JSONB;
@@ -0,0 +1,15 @@
+-- Content hashes for vault deduplication
+-- Run this in your Supabase SQL Editor
+
+-- SHA-256 (hex) of the uploaded file: re-uploading the same file to a vault
+-- returns the existing document instead of processing it again.
+ALTER TABLE vault_documents ADD COLUMN IF NOT EXISTS content_hash TEXT;
+CREATE INDEX IF NOT EXISTS vault_documents_content_hash_idx
+    ON vault_documents (vault_id, content_hash);
+
+-- SHA-256 (hex) of each chunk's text: chunks already embedded in one of the
+-- user's vaults reuse the stored embedding instead of calling the provider.
+-- Rows stored before this migration are left NULL and never matched.
+ALTER TABLE vault_embeddings ADD COLUMN IF NOT EXISTS content_hash TEXT;
+CREATE INDEX IF NOT EXISTS vault_embeddings_content_hash_idx
+    ON vault_embeddings (content_hash, vault_id);
@@ -1,5 +1,5 @@
 from typing import List, Optional, Union, Any, Literal
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 
 # ---- Content blocks ----
@@ -103,6 +103,8 @@ class ChatRequest(BaseModel):
     vault_id: Optional[str] = None  # ID of the vault for RAG retrieval
     cache_enabled: Optional[bool] = True
     cache_threshold: Optional[float] = 0.95
+    cache_mode: Optional[str] = None  # "stale-while-revalidate" serves stale hits and refreshes them in the background
+    cache_max_staleness: Optional[float] = Field(None, ge=0)  # Seconds; older hits are misses in stale-while-revalidate mode (0 = never serve stale)
 
 
 class ChatResponse(BaseModel):
@@ -151,6 +153,8 @@ class ResponseRequest(BaseModel):
     vault_id: Optional[str] = None  # ID of the vault for RAG retrieval
     cache_enabled: Optional[bool] = True
     cache_threshold: Optional[float] = 0.95
+    cache_mode: Optional[str] = None  # "stale-while-revalidate" serves stale hits and refreshes them in the background
+    cache_max_staleness: Optional[float] = Field(None, ge=0)  # Seconds; older hits are misses in stale-while-revalidate mode (0 = never serve stale)
 
 
 # Response content part structures (matching OpenAI official types)
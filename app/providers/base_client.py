@@ -1,17 +1,17 @@
 from openai import AsyncOpenAI, RateLimitError, APIError
-from models.chat import ChatResponse, ChatCompletionChunk, ChatRequest, Usage, Choice, ChoiceMessage, ChoiceChunk, Delta
-from auth.check_key import increment_usage_count, increment_rate_limit_count
+from providers.client_pool import get_client_pool
+from models.chat import ChatResponse, ChatRequest, Usage, Choice, ChoiceMessage
+from services.usage import get_usage_counter
 from exceptions import RateLimitExceededError, ProviderAPIError
-from utils.token_counter import count_tokens_in_messages, estimate_completion_tokens
+from utils.token_counter import count_tokens_in_messages_async, estimate_completion_tokens
+from utils.stream_accumulator import StreamAccumulator
+from utils.sse import encode_chunk, DONE_EVENT
 import time
 import uuid
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Default timeout for API requests (seconds)
-DEFAULT_TIMEOUT = 120.0
-
 
 class BaseLLMClient:
     """
@@ -26,18 +26,13 @@ class BaseLLMClient:
     def __init__(self, api_keys: list, base_url: str):
         self.api_keys = api_keys
         self.base_url = base_url
-        # Connection pooling: cache AsyncOpenAI clients (saves 10-20MB, 30-100ms per call)
-        self._client_cache = {}
     
-    def _get_or_create_client(self, api_key: str) -> AsyncOpenAI:
-        """Get cached AsyncOpenAI client or create new one for connection reuse."""
-        if api_key not in self._client_cache:
-            self._client_cache[api_key] = AsyncOpenAI(
-                api_key=api_key,
-                base_url=self.base_url,
-                timeout=DEFAULT_TIMEOUT
-            )
-        return self._client_cache[api_key]
+    def _hold_client(self, api_key: str) -> AsyncOpenAI:
+        """
+        Get the pooled AsyncOpenAI client for this key (shared across
+        requests), held open until released.
+        """
+        return get_client_pool().retain(get_client_pool().get(self.base_url, api_key))
 
     def _extract_model(self, model: str) -> str:
         """Extract the actual model name from provider:model or provider/model format"""
@@ -80,19 +75,20 @@ class BaseLLMClient:
         params = self._build_request_params(req)
         params["stream"] = False
         
-        prompt_tokens = count_tokens_in_messages(req.messages, req.model)
+        prompt_tokens = await count_tokens_in_messages_async(req.messages, req.model)
         start_time = time.time()
 
         for i, key_data in enumerate(self.api_keys):
             api_key = key_data["encrypted_key"]
             api_key_id = key_data["id"]
             key_name = key_data.get("name", f"key_{i}")
+            client = None
 
             try:
-                client = self._get_or_create_client(api_key)
+                client = self._hold_client(api_key)
                 
                 response = await client.chat.completions.create(**params)
-                increment_usage_count(api_key_id)
+                get_usage_counter().record_usage(api_key_id)
                 rotation_log.append({"key": key_name, "status": "success"})
                 
                 # Calculate metrics
@@ -149,7 +145,7 @@ class BaseLLMClient:
 
             except RateLimitError as e:
                 logger.warning(f"Key {key_name} rate limited: {e}")
-                increment_rate_limit_count(api_key_id)
+                get_usage_counter().record_rate_limit(api_key_id)
                 errors.append(("rate_limit", key_name, str(e)))
                 rotation_log.append({"key": key_name, "status": "failed", "error": str(e)})
                 # Continue to next key
@@ -168,6 +164,10 @@ class BaseLLMClient:
                 rotation_log.append({"key": key_name, "status": "failed", "error": str(e)})
                 # Continue to next key
 
+            finally:
+                if client is not None:
+                    get_client_pool().release(client)
+
         # All keys exhausted - determine best error to return
         logger.error(f"All {len(self.api_keys)} keys exhausted. Errors: {errors}")
         
@@ -190,21 +190,22 @@ class BaseLLMClient:
         params = self._build_request_params(req)
         params["stream"] = True
         
-        prompt_tokens = count_tokens_in_messages(req.messages, req.model)
+        prompt_tokens = await count_tokens_in_messages_async(req.messages, req.model)
         start_time = time.time()
 
         for i, key_data in enumerate(self.api_keys):
             api_key = key_data["encrypted_key"]
             api_key_id = key_data["id"]
             key_name = key_data.get("name", f"key_{i}")
+            client = None
 
             try:
-                client = self._get_or_create_client(api_key)
+                client = self._hold_client(api_key)
                 
                 response = await client.chat.completions.create(**params)
                 
                 usage_incremented = False
-                completion_content = ""
+                accumulator = StreamAccumulator(req.model)
                 first_token_time = None
                 
                 rotation_log.append({"key": key_name, "status": "success"})
@@ -213,7 +214,7 @@ class BaseLLMClient:
 
                 async for chunk in response:
                     if not usage_incremented:
-                        increment_usage_count(api_key_id)
+                        get_usage_counter().record_usage(api_key_id)
                         usage_incremented = True
                     
                     if not first_token_time:
@@ -223,43 +224,22 @@ class BaseLLMClient:
                     if hasattr(chunk, 'usage') and chunk.usage:
                          captured_usage = chunk.usage
 
-                    if chunk.choices and chunk.choices[0].delta.content:
-                        completion_content += chunk.choices[0].delta.content
+                    accumulator.add_chunk(chunk)
                     
-                    chunk_data = ChatCompletionChunk(
-                        id=chunk.id or str(uuid.uuid4()),
-                        object="chat.completion.chunk",
-                        created=chunk.created or int(time.time()),
-                        model=req.model,
-                        choices=[ChoiceChunk(
-                            index=c.index,
-                            delta=Delta(
-                                content=c.delta.content,
-                                role=c.delta.role,
-                                tool_calls=c.delta.tool_calls
-                            ),
-                            finish_reason=c.finish_reason
-                        ) for c in chunk.choices],
-                        # key_name is now excluded from the client stream to match original response structure
-                        system_fingerprint=chunk.system_fingerprint,
-                        usage=Usage(
-                            prompt_tokens=chunk.usage.prompt_tokens,
-                            completion_tokens=chunk.usage.completion_tokens,
-                            total_tokens=chunk.usage.total_tokens
-                        ) if hasattr(chunk, 'usage') and chunk.usage else None
-                    )
-                    
-                    yield f"data: {chunk_data.model_dump_json(exclude_none=True)}\n\n"
+                    # Empty keep-alive deltas are dropped before serialization
+                    frame = encode_chunk(chunk, req.model)
+                    if frame is not None:
+                        yield frame
 
                 # Calculate metrics for logging
                 if captured_usage:
                     completion_tokens = captured_usage.completion_tokens
                     prompt_tokens = captured_usage.prompt_tokens
                 else:
-                    completion_tokens = estimate_completion_tokens(completion_content, req.model)
+                    completion_tokens = accumulator.completion_tokens
                 
                 # Send DONE signal
-                yield "data: [DONE]\n\n"
+                yield DONE_EVENT
                 
                 end_time = time.time()
                 duration = end_time - start_time
@@ -275,14 +255,15 @@ class BaseLLMClient:
                     "prompt_tokens": prompt_tokens,
                     "completion_tokens": completion_tokens,
                     "total_tokens": prompt_tokens + completion_tokens,
-                    "key_name": key_name
+                    "key_name": key_name,
+                    "accumulator": accumulator
                 }
                 
                 return  # Success - exit
 
             except RateLimitError as e:
                 logger.warning(f"Key {key_name} rate limited in streaming: {e}")
-                increment_rate_limit_count(api_key_id)
+                get_usage_counter().record_rate_limit(api_key_id)
                 errors.append(("rate_limit", key_name, str(e)))
                 rotation_log.append({"key": key_name, "status": "failed", "error": str(e)})
                 
@@ -297,6 +278,11 @@ class BaseLLMClient:
                 errors.append(("error", key_name, str(e)))
                 rotation_log.append({"key": key_name, "status": "failed", "error": str(e)})
 
+            finally:
+                # Also runs when the client disconnects and the generator is closed
+                if client is not None:
+                    get_client_pool().release(client)
+
         # All keys exhausted
         logger.error(f"All {len(self.api_keys)} keys exhausted in streaming. Errors: {errors}")
         
@@ -0,0 +1,168 @@
+"""
+Process-wide registry of upstream AsyncOpenAI clients.
+
+Clients are keyed by (base_url, api_key) and share their httpx connection
+pool across requests, so TLS setup is paid once per key instead of once
+per request. Callers hold a client with retain()/release() (or lease())
+while a request or stream is using it; an evicted client is closed once
+the last of them has released it.
+"""
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from collections import OrderedDict
+from contextlib import contextmanager
+from config import (
+    UPSTREAM_MAX_CLIENTS, UPSTREAM_MAX_CONNECTIONS, UPSTREAM_MAX_KEEPALIVE,
+    UPSTREAM_KEEPALIVE_EXPIRY, UPSTREAM_HTTP2
+)
+from typing import Dict, Iterator
+import asyncio
+import importlib.util
+import httpx
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Default timeout for API requests (seconds)
+DEFAULT_TIMEOUT = 120.0
+
+
+class ClientPool:
+    """
+    LRU registry of AsyncOpenAI clients.
+
+    Evicted clients are closed once no request holds them any more, so
+    requests still streaming through them are not cut off.
+    """
+
+    def __init__(
+        self,
+        max_clients: int = UPSTREAM_MAX_CLIENTS,
+        max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive: int = UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry: float = UPSTREAM_KEEPALIVE_EXPIRY,
+        http2: bool = UPSTREAM_HTTP2,
+        timeout: float = DEFAULT_TIMEOUT,
+    ):
+        self.max_clients = max_clients
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("UPSTREAM_HTTP2 is enabled but the 'h2' package is not installed; using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self._clients: "OrderedDict[tuple, AsyncOpenAI]" = OrderedDict()
+        # id(client) -> number of holders
+        self._holders: Dict[int, int] = {}
+        # Evicted clients still held, closed on their last release
+        self._draining: Dict[int, AsyncOpenAI] = {}
+        self._closing: set = set()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def get(self, base_url: str, api_key: str) -> AsyncOpenAI:
+        """Return the pooled client for this key, creating it on first use."""
+        pool_key = (base_url, api_key)
+        client = self._clients.get(pool_key)
+        if client is not None:
+            self._clients.move_to_end(pool_key)
+            self.reused += 1
+            return client
+
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=self.timeout,
+            http_client=DefaultAsyncHttpxClient(limits=self.limits, http2=self.http2),
+        )
+        self._clients[pool_key] = client
+        self.created += 1
+
+        while len(self._clients) > self.max_clients:
+            _, evicted = self._clients.popitem(last=False)
+            self.evicted += 1
+            if self._holders.get(id(evicted)):
+                self._draining[id(evicted)] = evicted
+            else:
+                self._close_soon(evicted)
+        return client
+
+    def retain(self, client: AsyncOpenAI) -> AsyncOpenAI:
+        """Keep `client` open until the matching release(), even if it is evicted meanwhile."""
+        self._holders[id(client)] = self._holders.get(id(client), 0) + 1
+        return client
+
+    def release(self, client: AsyncOpenAI) -> None:
+        holders = self._holders.get(id(client), 0) - 1
+        if holders > 0:
+            self._holders[id(client)] = holders
+            return
+        self._holders.pop(id(client), None)
+        draining = self._draining.pop(id(client), None)
+        if draining is not None:
+            self._close_soon(draining)
+
+    @contextmanager
+    def lease(self, base_url: str, api_key: str) -> Iterator[AsyncOpenAI]:
+        """The pooled client for this key, held for the duration of the block."""
+        client = self.retain(self.get(base_url, api_key))
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def _close_soon(self, client: AsyncOpenAI) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # No loop (e.g. scripts) - let garbage collection handle it
+        task = loop.create_task(self._close(client))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @staticmethod
+    async def _close(client: AsyncOpenAI) -> None:
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning(f"Error closing upstream client: {e}")
+
+    async def close(self) -> None:
+        """Close every pooled client. Called on application shutdown."""
+        clients = [*self._clients.values(), *self._draining.values()]
+        self._clients.clear()
+        self._draining.clear()
+        for client in clients:
+            await self._close(client)
+        if self._closing:
+            await asyncio.gather(*self._closing)
+
+    def stats(self) -> dict:
+        return {
+            "clients": len(self._clients),
+            "max_clients": self.max_clients,
+            "created": self.created,
+            "reused": self.reused,
+            "evicted": self.evicted,
+            "held": len(self._holders),
+            "draining": len(self._draining),
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "http2": self.http2,
+        }
+
+
+# Singleton pattern, same as the Supabase clients in config.py
+_client_pool = None
+
+
+def get_client_pool() -> ClientPool:
+    """Get or create the process-wide upstream client pool."""
+    global _client_pool
+    if _client_pool is None:
+        _client_pool = ClientPool()
+    return _client_pool
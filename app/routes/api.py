@@ -7,12 +7,16 @@ from services.cache import CacheService
 from auth.check_key import fetch_userid, fetch_all_providers_with_keys
 from exceptions import InvalidAPIKeyError, RateLimitExceededError, ProviderAPIError, ModelNotFoundError
 from utils.error_handler import create_error_response, get_error_response, log_request_async
-from utils.token_counter import count_tokens_in_messages, estimate_completion_tokens
+from utils.token_counter import count_tokens_in_messages_async, estimate_completion_tokens
+from utils.sse import replay_cached_response
+from utils.fingerprint import fingerprint_request
+from services.coalescer import get_coalescer
+from services.cache_policy import get_cache_policy
+from services.cache_refresh import get_cache_refresher, is_stale_while_revalidate, refresh_cached_response
 import time
 import asyncio
 import json
 import logging
-import uuid
 from pydantic import BaseModel
 from typing import Any
 from openai import AsyncOpenAI
@@ -132,51 +136,13 @@ async def fetch_provider_models(req: FetchModelsRequest):
 
 
 
-def is_empty_chunk(chunk: Any) -> bool:
-    """Check if the chunk is an empty SSE delta with no content/info."""
-    if not isinstance(chunk, str) or not chunk.startswith("data: "):
-        return False
-    
-    data_str = chunk[6:].strip()
-    if data_str == "[DONE]":
-        return False
-        
-    try:
-        data = json.loads(data_str)
-        # Check for usage or other top-level fields
-        if data.get("usage") or data.get("system_fingerprint"): # system_fingerprint often comes with empty delta? User said "system_fingerprint": "..." in empty chunk. 
-            # If user considers system_fingerprint ONLY chunk as "empty", I should skip it?
-            # User snippet showed: "system_fingerprint": "..." AND "delta": {}.
-            # If I skip it, client might miss fingerprint but who cares?
-            # It's better to reduce noise.
-            # But let's be careful. If usage is present, MUST keep.
-            pass
-            
-        if data.get("usage"):
-            return False
-
-        choices = data.get("choices", [])
-        if not choices:
-            return False # Keep purely structural/empty chunks if not standard choice format?
-            
-        choice = choices[0]
-        delta = choice.get("delta", {})
-        finish_reason = choice.get("finish_reason")
-        
-        # Keep if has meaningful content
-        if delta.get("content") or delta.get("tool_calls") or finish_reason:
-            return False
-            
-        return True
-    except:
-        return False
-
 @router.post("/chat/completions")
 async def chat_completions(
     req: ChatRequest, 
     background_tasks: BackgroundTasks,
     authorization: str = Header(None),
-    x_fallback_model: str = Header(None, alias="X-Fallback-Model")
+    x_fallback_model: str = Header(None, alias="X-Fallback-Model"),
+    x_cache_mode: str = Header(None, alias="X-Cache-Mode")
 ):
     """
     Chat completions endpoint - proxies requests to upstream LLM providers.
@@ -199,10 +165,21 @@ async def chat_completions(
     # Add fallback model if provided
     if x_fallback_model:
         req.fallback_model = x_fallback_model
+    if x_cache_mode and not req.cache_mode:
+        req.cache_mode = x_cache_mode
     
     # Initialize request payload for logging early to capture RAG meta
     request_payload = req.model_dump()
 
+    # Canonical fingerprint of the request as the client sent it (before RAG
+    # injection); keys the response cache and is logged with the request
+    fingerprint = fingerprint_request(
+        req.model, req.messages,
+        temperature=req.temperature, tools=req.tools, tool_choice=req.tool_choice,
+        reasoning_effort=req.reasoning_effort, vault_id=req.vault_id,
+    )
+    request_payload["fingerprint"] = fingerprint.key
+
     # RAG Retrieval
     if req.vault_id:
         try:
@@ -277,14 +254,35 @@ async def chat_completions(
     start_time = time.time()
     
     # Semantic Cache Check
-    prompt_key = json.dumps([m.model_dump() for m in req.messages], sort_keys=True)
-    if req.cache_enabled:
+    cache_decision = get_cache_policy().decide(
+        user_id, req.model, fingerprint.text,
+        temperature=req.temperature, tools=req.tools, enabled=req.cache_enabled,
+    )
+    request_payload["cache_policy"] = cache_decision.reason
+    stale_hit = None
+    if cache_decision.lookup:
         cache_hit = await CacheService.find_in_cache(
             user_id=user_id,
             model=req.model,
-            prompt=prompt_key,
-            threshold=req.cache_threshold
+            prompt=fingerprint.text,
+            threshold=req.cache_threshold,
+            prompt_hash=fingerprint.key,
+            semantic=cache_decision.semantic,
+            scope=fingerprint.scope
         )
+        get_cache_policy().record_lookup(user_id, cache_decision, cache_hit is not None)
+        if cache_hit and is_stale_while_revalidate(req.cache_mode):
+            freshness = get_cache_refresher().classify(cache_hit, req.cache_max_staleness)
+            if freshness == "expired":
+                # Too old to serve; answered upstream and replaced below
+                stale_hit, cache_hit = cache_hit, None
+            elif freshness == "stale":
+                cache_hit["response"].setdefault("usage", {})["cache_stale"] = True
+                background_tasks.add_task(
+                    refresh_cached_response,
+                    client, req.model_copy(update={"stream": False}), user_id, api_key,
+                    fingerprint, cache_hit, request_payload
+                )
         if cache_hit:
             latency_ms = (time.time() - start_time) * 1000
             response_payload = cache_hit["response"]
@@ -316,46 +314,58 @@ async def chat_completions(
             )
             
             if req.stream:
-                async def stream_cache_hit():
-                    content = response_payload["choices"][0]["message"]["content"]
-                    # Yield in small chunks to simulate streaming
-                    chunk_size = 20
-                    for i in range(0, len(content), chunk_size):
-                        chunk_text = content[i:i + chunk_size]
-                        yield f"data: {json.dumps({'id': response_payload['id'], 'object': 'chat.completion.chunk', 'created': response_payload['created'], 'model': response_payload['model'], 'choices': [{'index': 0, 'delta': {'content': chunk_text}, 'finish_reason': None}]})}\n\n"
-                    yield "data: [DONE]\n\n"
-                
-                return StreamingResponse(stream_cache_hit(), media_type="text/event-stream")
+                # Replays content, tool calls and finish reason as pre-encoded frames
+                return StreamingResponse(replay_cached_response(response_payload), media_type="text/event-stream")
             
             return JSONResponse(content=response_payload)
 
 
+    # Identical concurrent requests share one upstream call, unless the
+    # client opted out of cached answers
+    coalesce_key = (user_id, fingerprint.key, req.stream) if cache_decision.lookup else None
+
     try:
         if req.stream:
             # Streaming response
-            prompt_tokens = count_tokens_in_messages(req.messages, req.model)
+            prompt_tokens = await count_tokens_in_messages_async(req.messages, req.model)
+
+            async def save_stream(items: list):
+                # Runs once per upstream stream, from the coalescer's task, so
+                # it happens even if the client that started it has gone
+                metadata = next((item for item in items if isinstance(item, dict) and item.get("type") == "internal_metadata"), {})
+                accumulator = metadata.get("accumulator")
+                if not accumulator:
+                    return
+                p_tokens = metadata.get("prompt_tokens", prompt_tokens)
+                c_tokens = metadata.get("completion_tokens", 0)
+                await CacheService.save_to_cache(
+                    user_id=user_id,
+                    model=req.model,
+                    prompt=fingerprint.text,
+                    response=accumulator.to_response(req.model, p_tokens, c_tokens),
+                    prompt_hash=fingerprint.key,
+                    replaces=stale_hit,
+                    scope=fingerprint.scope
+                )
             
             async def stream_with_logging():
-                completion_content = ""
                 extracted_key = None
                 metadata = {}
                 
                 try:
-                    async for chunk in client.stream_chat_completions(req=req):
+                    upstream, _ = get_coalescer().stream(
+                        coalesce_key,
+                        lambda: client.stream_chat_completions(req=req),
+                        on_complete=save_stream if cache_decision.store else None
+                    )
+                    async for chunk in upstream:
                         # Capture internal metadata
                         if isinstance(chunk, dict) and chunk.get("type") == "internal_metadata":
                             metadata = chunk
                             continue
 
-                        # Extract content for caching
-                        if hasattr(chunk, 'choices') and chunk.choices:
-                            delta = chunk.choices[0].delta
-                            if hasattr(delta, 'content') and delta.content:
-                                completion_content += delta.content
-
-                        # Pass through original chunks, filtering empty keep-alives
-                        if not is_empty_chunk(chunk):
-                            yield chunk
+                        # Pre-encoded SSE frames; empty keep-alives are already filtered upstream
+                        yield chunk
                     
                     # Log successful request using metadata from provider
                     p_tokens = metadata.get("prompt_tokens", prompt_tokens)
@@ -381,37 +391,6 @@ async def chat_completions(
                         is_fallback=False
                     )
                     
-                    # Save to cache if enabled
-                    if req.cache_enabled and completion_content:
-                        p_tokens = metadata.get("prompt_tokens", prompt_tokens)
-                        c_tokens = metadata.get("completion_tokens", 0)
-                        mock_response = {
-                            "id": f"chatcmpl-{uuid.uuid4()}",
-                            "object": "chat.completion",
-                            "created": int(time.time()),
-                            "model": req.model,
-                            "choices": [{
-                                "index": 0,
-                                "message": {
-                                    "role": "assistant",
-                                    "content": completion_content
-                                },
-                                "finish_reason": "stop"
-                            }],
-                            "usage": {
-                                "prompt_tokens": p_tokens,
-                                "completion_tokens": c_tokens,
-                                "total_tokens": p_tokens + c_tokens
-                            }
-                        }
-                        background_tasks.add_task(
-                            CacheService.save_to_cache,
-                            user_id=user_id,
-                            model=req.model,
-                            prompt=prompt_key,
-                            response=mock_response
-                        )
-                    
                 except (RateLimitExceededError, ProviderAPIError) as e:
                     # Try fallback if available
                     fallback_result = await _try_fallback(req, user_id, api_key, request_payload, start_time, background_tasks)
@@ -441,17 +420,23 @@ async def chat_completions(
         
         else:
             # Non-streaming response
-            response_data = await client.chat_completions(req=req)
-            
-            # Save to cache if enabled
-            if req.cache_enabled:
-                background_tasks.add_task(
-                    CacheService.save_to_cache,
+            async def save_response(response_data):
+                await CacheService.save_to_cache(
                     user_id=user_id,
                     model=req.model,
-                    prompt=prompt_key,
-                    response=response_data.model_dump(exclude={"key_name"}, exclude_none=True)
+                    prompt=fingerprint.text,
+                    response=response_data.model_dump(exclude={"key_name"}, exclude_none=True),
+                    prompt_hash=fingerprint.key,
+                    replaces=stale_hit,
+                    scope=fingerprint.scope
                 )
+
+            # Cache saves run once per upstream call, from the shared task
+            response_data, _ = await get_coalescer().run(
+                coalesce_key,
+                lambda: client.chat_completions(req=req),
+                on_complete=save_response if cache_decision.store else None
+            )
             
             # Log request
             usage = response_data.usage
@@ -511,7 +496,7 @@ async def _try_fallback(req: ChatRequest, user_id: str, api_key: str, request_pa
         if req.stream:
             async def fallback_stream():
                 metadata = {}
-                prompt_tokens = count_tokens_in_messages(fallback_req.messages, fallback_req.model)
+                prompt_tokens = await count_tokens_in_messages_async(fallback_req.messages, fallback_req.model)
                 
                 try:
                     async for chunk in fallback_client.stream_chat_completions(req=fallback_req):
@@ -521,8 +506,7 @@ async def _try_fallback(req: ChatRequest, user_id: str, api_key: str, request_pa
                             continue
                         
                         # No need to extract key_name from chunks anymore
-                        if not is_empty_chunk(chunk):
-                            yield chunk
+                        yield chunk
                     
                     # Log successful fallback
                     p_tokens = metadata.get("prompt_tokens", prompt_tokens)
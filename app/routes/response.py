@@ -10,10 +10,14 @@ from services.cache import CacheService
 from auth.check_key import fetch_userid
 from exceptions import InvalidAPIKeyError, RateLimitExceededError, ProviderAPIError
 from utils.error_handler import create_error_response, log_request_async
-from utils.token_counter import count_tokens_in_messages, estimate_completion_tokens, count_tokens_in_tools
+from utils.token_counter import count_tokens_in_messages_async, estimate_completion_tokens, count_tokens_in_tools
+from utils.sse import replay_cached_response
+from utils.fingerprint import fingerprint_request, RequestFingerprint
+from services.coalescer import get_coalescer
+from services.cache_policy import get_cache_policy, CacheDecision
+from services.cache_refresh import get_cache_refresher, is_stale_while_revalidate, refresh_cached_response
 import time
 import json
-import uuid
 import logging
 
 router = APIRouter()
@@ -25,7 +29,8 @@ async def create_response(
     req: ResponseRequest, 
     background_tasks: BackgroundTasks,
     authorization: str = Header(None),
-    x_fallback_model: str = Header(None, alias="X-Fallback-Model")
+    x_fallback_model: str = Header(None, alias="X-Fallback-Model"),
+    x_cache_mode: str = Header(None, alias="X-Cache-Mode")
 ):
     """
     Create a response using OpenAI responses API format.
@@ -47,6 +52,8 @@ async def create_response(
     
     if x_fallback_model:
         req.fallback_model = x_fallback_model
+    if x_cache_mode and not req.cache_mode:
+        req.cache_mode = x_cache_mode
     
     try:
         client = get_provider(model=req.model, user_id=user_id)
@@ -84,10 +91,43 @@ async def create_response(
         return create_error_response(e)
 
 
+def _fingerprint(req: ResponseRequest, messages: list, request_payload: dict) -> RequestFingerprint:
+    """Fingerprint the request as sent upstream, before RAG injection."""
+    fingerprint = fingerprint_request(
+        req.model, messages,
+        temperature=req.temperature or 0.7, tools=req.tools, tool_choice=req.tool_choice,
+        reasoning_effort=req.reasoning_effort, vault_id=req.vault_id,
+    )
+    request_payload["fingerprint"] = fingerprint.key
+    return fingerprint
+
+
+def _chat_request(req: ResponseRequest, messages: list, stream: bool) -> ChatRequest:
+    return ChatRequest(
+        model=req.model,
+        messages=messages,
+        temperature=req.temperature or 0.7,
+        stream=stream,
+        reasoning_effort=req.reasoning_effort,
+        tools=req.tools,
+        tool_choice=req.tool_choice
+    )
+
+
+def _cache_decision(req: ResponseRequest, user_id: str, fingerprint: RequestFingerprint, request_payload: dict) -> CacheDecision:
+    decision = get_cache_policy().decide(
+        user_id, req.model, fingerprint.text,
+        temperature=req.temperature or 0.7, tools=req.tools, enabled=req.cache_enabled,
+    )
+    request_payload["cache_policy"] = decision.reason
+    return decision
+
+
 async def _generate_response(client, req: ResponseRequest, user_id: str, api_key: str, request_payload: dict, start_time: float, background_tasks: BackgroundTasks) -> JSONResponse:
     """Generate non-streaming response."""
     # Convert input to messages
     messages = [Message(role="user", content=req.input)] if isinstance(req.input, str) else req.input
+    fingerprint = _fingerprint(req, messages, request_payload)
     
     # RAG Retrieval
     if req.vault_id:
@@ -138,14 +178,31 @@ async def _generate_response(client, req: ResponseRequest, user_id: str, api_key
         except Exception as e:
             logger.error(f"RAG retrieval failed: {e}")
     # Semantic Cache Check
-    prompt_key = json.dumps([m.model_dump() for m in messages], sort_keys=True)
-    if req.cache_enabled:
+    cache_decision = _cache_decision(req, user_id, fingerprint, request_payload)
+    stale_hit = None
+    if cache_decision.lookup:
         cache_hit = await CacheService.find_in_cache(
             user_id=user_id,
             model=req.model,
-            prompt=prompt_key,
-            threshold=req.cache_threshold
+            prompt=fingerprint.text,
+            threshold=req.cache_threshold,
+            prompt_hash=fingerprint.key,
+            semantic=cache_decision.semantic,
+            scope=fingerprint.scope
         )
+        get_cache_policy().record_lookup(user_id, cache_decision, cache_hit is not None)
+        if cache_hit and is_stale_while_revalidate(req.cache_mode):
+            freshness = get_cache_refresher().classify(cache_hit, req.cache_max_staleness)
+            if freshness == "expired":
+                # Too old to serve; answered upstream and replaced below
+                stale_hit, cache_hit = cache_hit, None
+            elif freshness == "stale":
+                cache_hit["response"].setdefault("usage", {})["cache_stale"] = True
+                background_tasks.add_task(
+                    refresh_cached_response,
+                    client, _chat_request(req, messages, stream=False), user_id, api_key,
+                    fingerprint, cache_hit, request_payload
+                )
         if cache_hit:
             latency_ms = (time.time() - start_time) * 1000
             response_payload = cache_hit["response"]
@@ -177,38 +234,32 @@ async def _generate_response(client, req: ResponseRequest, user_id: str, api_key
             )
             
             if req.stream:
-                async def stream_cache_hit():
-                    content = response_payload["choices"][0]["message"]["content"]
-                    chunk_size = 20
-                    for i in range(0, len(content), chunk_size):
-                        chunk_text = content[i:i + chunk_size]
-                        yield f"data: {json.dumps({'id': response_payload['id'], 'object': 'chat.completion.chunk', 'created': response_payload['created'], 'model': response_payload['model'], 'choices': [{'index': 0, 'delta': {'content': chunk_text}, 'finish_reason': None}]})}\n\n"
-                    yield "data: [DONE]\n\n"
-                return StreamingResponse(stream_cache_hit(), media_type="text/event-stream")
+                # Replays content, tool calls and finish reason as pre-encoded frames
+                return StreamingResponse(replay_cached_response(response_payload), media_type="text/event-stream")
             
             return JSONResponse(content=response_payload)
 
-    chat_req = ChatRequest(
-        model=req.model,
-        messages=messages,
-        temperature=req.temperature or 0.7,
-        stream=False,
-        reasoning_effort=req.reasoning_effort,
-        tools=req.tools,
-        tool_choice=req.tool_choice
-    )
-    
-    chat_response = await client.chat_completions(req=chat_req)
+    chat_req = _chat_request(req, messages, stream=False)
     
-    # Save to cache if enabled
-    if req.cache_enabled:
-        background_tasks.add_task(
-            CacheService.save_to_cache,
+    coalesce_key = (user_id, fingerprint.key, False) if cache_decision.lookup else None
+
+    async def save_response(chat_response):
+        await CacheService.save_to_cache(
             user_id=user_id,
             model=req.model,
-            prompt=prompt_key,
-            response=chat_response.model_dump(exclude={"key_name"}, exclude_none=True)
+            prompt=fingerprint.text,
+            response=chat_response.model_dump(exclude={"key_name"}, exclude_none=True),
+            prompt_hash=fingerprint.key,
+            replaces=stale_hit,
+            scope=fingerprint.scope
         )
+
+    # Cache saves run once per upstream call, from the shared task
+    chat_response, _ = await get_coalescer().run(
+        coalesce_key,
+        lambda: client.chat_completions(req=chat_req),
+        on_complete=save_response if cache_decision.store else None
+    )
     
     # Log request
     # Log request
@@ -238,6 +289,7 @@ async def _generate_response(client, req: ResponseRequest, user_id: str, api_key
 async def _generate_streaming_response(client, req: ResponseRequest, user_id: str, api_key: str, request_payload: dict, start_time: float, background_tasks: BackgroundTasks) -> StreamingResponse:
     """Generate streaming response in OpenAI Responses API format."""
     messages = [Message(role="user", content=req.input)] if isinstance(req.input, str) else req.input
+    fingerprint = _fingerprint(req, messages, request_payload)
 
     # RAG Retrieval
     if req.vault_id:
@@ -288,14 +340,31 @@ async def _generate_streaming_response(client, req: ResponseRequest, user_id: st
         except Exception as e:
             logger.error(f"RAG retrieval failed: {e}")
     # Semantic Cache Check
-    prompt_key = json.dumps([m.model_dump() for m in messages], sort_keys=True)
-    if req.cache_enabled:
+    cache_decision = _cache_decision(req, user_id, fingerprint, request_payload)
+    stale_hit = None
+    if cache_decision.lookup:
         cache_hit = await CacheService.find_in_cache(
             user_id=user_id,
             model=req.model,
-            prompt=prompt_key,
-            threshold=req.cache_threshold
+            prompt=fingerprint.text,
+            threshold=req.cache_threshold,
+            prompt_hash=fingerprint.key,
+            semantic=cache_decision.semantic,
+            scope=fingerprint.scope
         )
+        get_cache_policy().record_lookup(user_id, cache_decision, cache_hit is not None)
+        if cache_hit and is_stale_while_revalidate(req.cache_mode):
+            freshness = get_cache_refresher().classify(cache_hit, req.cache_max_staleness)
+            if freshness == "expired":
+                # Too old to serve; answered upstream and replaced below
+                stale_hit, cache_hit = cache_hit, None
+            elif freshness == "stale":
+                cache_hit["response"].setdefault("usage", {})["cache_stale"] = True
+                background_tasks.add_task(
+                    refresh_cached_response,
+                    client, _chat_request(req, messages, stream=False), user_id, api_key,
+                    fingerprint, cache_hit, request_payload
+                )
         if cache_hit:
             latency_ms = (time.time() - start_time) * 1000
             response_payload = cache_hit["response"]
@@ -327,47 +396,52 @@ async def _generate_streaming_response(client, req: ResponseRequest, user_id: st
             )
             
             if req.stream:
-                async def stream_cache_hit():
-                    content = response_payload["choices"][0]["message"]["content"]
-                    chunk_size = 20
-                    for i in range(0, len(content), chunk_size):
-                        chunk_text = content[i:i + chunk_size]
-                        yield f"data: {json.dumps({'id': response_payload['id'], 'object': 'chat.completion.chunk', 'created': response_payload['created'], 'model': response_payload['model'], 'choices': [{'index': 0, 'delta': {'content': chunk_text}, 'finish_reason': None}]})}\n\n"
-                    yield "data: [DONE]\n\n"
-                return StreamingResponse(stream_cache_hit(), media_type="text/event-stream")
+                return StreamingResponse(replay_cached_response(response_payload), media_type="text/event-stream")
             
             return JSONResponse(content=response_payload)
 
-    chat_req = ChatRequest(
-        model=req.model,
-        messages=messages,
-        temperature=req.temperature or 0.7,
-        stream=True,
-        reasoning_effort=req.reasoning_effort,
-        tools=req.tools,
-        tool_choice=req.tool_choice
-    )
+    chat_req = _chat_request(req, messages, stream=True)
     
     # Initial count for fallback, will be overwritten by metadata if available
-    prompt_tokens = count_tokens_in_messages(messages, req.model)
+    prompt_tokens = await count_tokens_in_messages_async(messages, req.model)
     if req.tools:
         prompt_tokens += count_tokens_in_tools([tool.model_dump() for tool in req.tools], req.model)
     
+    coalesce_key = (user_id, fingerprint.key, True) if cache_decision.lookup else None
+
+    async def save_stream(items: list):
+        # Runs once per upstream stream, from the coalescer's task, so it
+        # happens even if the client that started it has gone
+        metadata = next((item for item in items if isinstance(item, dict) and item.get("type") == "internal_metadata"), {})
+        accumulator = metadata.get("accumulator")
+        if not accumulator:
+            return
+        p_tokens = metadata.get("prompt_tokens", prompt_tokens)
+        c_tokens = metadata.get("completion_tokens", 0)
+        await CacheService.save_to_cache(
+            user_id=user_id,
+            model=req.model,
+            prompt=fingerprint.text,
+            response=accumulator.to_response(req.model, p_tokens, c_tokens),
+            prompt_hash=fingerprint.key,
+            replaces=stale_hit,
+            scope=fingerprint.scope
+        )
+
     async def stream_generator():
         metadata = {}
         
-        async for chunk in client.stream_chat_completions(req=chat_req):
+        upstream, _ = get_coalescer().stream(
+            coalesce_key,
+            lambda: client.stream_chat_completions(req=chat_req),
+            on_complete=save_stream if cache_decision.store else None
+        )
+        async for chunk in upstream:
             # Capture internal metadata
             if isinstance(chunk, dict) and chunk.get("type") == "internal_metadata":
                 metadata = chunk
                 continue
 
-            # Extract content for caching
-            if hasattr(chunk, 'choices') and chunk.choices:
-                delta = chunk.choices[0].delta
-                if hasattr(delta, 'content') and delta.content:
-                    completion_content += delta.content
-
             # Pass through original chunks
             yield chunk
         
@@ -395,36 +469,5 @@ async def _generate_streaming_response(client, req: ResponseRequest, user_id: st
             key_rotation_log=metadata.get("key_rotation_log", []),
             is_fallback=False
         )
-        
-        # Save to cache if enabled
-        if req.cache_enabled and completion_content:
-            p_tokens = metadata.get("prompt_tokens", prompt_tokens)
-            c_tokens = metadata.get("completion_tokens", 0)
-            mock_response = {
-                "id": f"chatcmpl-{uuid.uuid4()}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": req.model,
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": completion_content
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": {
-                    "prompt_tokens": p_tokens,
-                    "completion_tokens": c_tokens,
-                    "total_tokens": p_tokens + c_tokens
-                }
-            }
-            background_tasks.add_task(
-                CacheService.save_to_cache,
-                user_id=user_id,
-                model=req.model,
-                prompt=prompt_key,
-                response=mock_response
-            )
     
     return StreamingResponse(stream_generator(), media_type="text/event-stream")
\ No newline at end of file
@@ -1,9 +1,11 @@
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from typing import Optional
 from pydantic import BaseModel
+import asyncio
 import logging
 
 from services.vault import VaultService
+from services.ingestion_jobs import IngestionJob, get_ingestion_queue
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -69,7 +71,7 @@ async def delete_vault(vault_id: str, user_id: str):
         logger.error(f"Error deleting vault: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
-@router.post("/vaults/{vault_id}/upload")
+@router.post("/vaults/{vault_id}/upload", status_code=202)
 async def upload_file(
     vault_id: str,
     user_id: str = Form(...),
@@ -78,13 +80,68 @@ async def upload_file(
     """
     Upload a document to the vault.
     Supports PDF, DOCX, TXT.
-    Automatically generates embeddings.
+    The file is queued for parsing and embedding; poll
+    GET /vaults/{vault_id}/jobs/{job_id} for progress.
     """
     try:
-        doc = await VaultService.upload_document(vault_id, user_id, file)
-        return doc
+        upload = await VaultService.prepare_upload(vault_id, user_id, file)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error uploading file: {e}")
         raise HTTPException(status_code=500, detail="Internal server error during upload")
+    try:
+        job = get_ingestion_queue().submit(vault_id, user_id, upload)
+    except asyncio.QueueFull:
+        upload.close()
+        raise HTTPException(status_code=503, detail="Too many uploads are being processed. Please try again later.")
+    return job.to_dict()
+
+def _get_job(vault_id: str, job_id: str, user_id: str) -> IngestionJob:
+    job = get_ingestion_queue().get(job_id)
+    if job is None or job.vault_id != vault_id or job.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Ingestion job not found.")
+    return job
+
+@router.get("/vaults/{vault_id}/jobs")
+async def list_jobs(vault_id: str, user_id: str):
+    """
+    List recent ingestion jobs for a vault.
+    """
+    jobs = [job.to_dict() for job in get_ingestion_queue().list(vault_id) if job.user_id == user_id]
+    return {"data": jobs}
+
+@router.get("/vaults/{vault_id}/jobs/{job_id}")
+async def get_job(vault_id: str, job_id: str, user_id: str):
+    """
+    Status of an ingestion job: progress, ETA and any failure.
+    """
+    return _get_job(vault_id, job_id, user_id).to_dict()
+
+@router.post("/vaults/{vault_id}/jobs/{job_id}/retry", status_code=202)
+async def retry_job(vault_id: str, job_id: str, user_id: str):
+    """
+    Retry a failed ingestion job. The uploaded file is processed again from
+    the start.
+    """
+    job = _get_job(vault_id, job_id, user_id)
+    try:
+        get_ingestion_queue().retry(job)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many uploads are being processed. Please try again later.")
+    return job.to_dict()
+
+@router.delete("/vaults/{vault_id}/jobs/{job_id}")
+async def delete_job(vault_id: str, job_id: str, user_id: str):
+    """
+    Forget a finished ingestion job. A failed job's uploaded file is deleted
+    and it can no longer be retried.
+    """
+    job = _get_job(vault_id, job_id, user_id)
+    try:
+        get_ingestion_queue().discard(job)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"success": True}
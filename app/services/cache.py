@@ -1,22 +1,112 @@
 import logging
 import json
 import hashlib
+import asyncio
+import random
+import time
 from typing import List, Dict, Optional, Any
-from config import supabase_admin
-from services.vault import VaultService
+from config import supabase_admin, CACHE_L1_TTL, CACHE_L1_MAX_ENTRIES, CACHE_L1_MAX_BYTES, LEXICAL_SHADOW_SAMPLE_RATE
+from services.embeddings import get_embedding_service
+from services.semantic_index import get_semantic_index
+from services.lexical_index import get_lexical_index, LexicalMatch
+from services.cache_lifecycle import get_cache_lifecycle
+from services.cache_scope import get_cache_scope
+from services.cache_feed import get_cache_feed
+from utils.simhash import simhash
+from utils.sse import dumps
+from utils.ttl_cache import TTLCache
+from utils.postgrest import is_missing_function
 
 logger = logging.getLogger(__name__)
 
+# L1 exact-match tier keyed by (user_id, model, prompt_hash). Hits are stored
+# as serialized JSON so the byte budget is exact and every reader gets its own
+# copy to annotate (the routes add usage/latency fields to cached payloads).
+_l1_cache = TTLCache(
+    maxsize=CACHE_L1_MAX_ENTRIES,
+    ttl=CACHE_L1_TTL,
+    max_bytes=CACHE_L1_MAX_BYTES,
+    sizeof=len,
+)
+
+
+def _l1_set(key: tuple, hit: Dict) -> None:
+    try:
+        _l1_cache.set(key, dumps(hit))
+    except Exception as e:
+        logger.warning(f"Could not store cache entry in L1: {e}")
+
+
+def _execute_live(build):
+    """Run a semantic_cache select restricted to rows that haven't expired."""
+    lifecycle, scopes = get_cache_lifecycle(), get_cache_scope()
+    while True:
+        try:
+            return lifecycle.live(build()).execute()
+        except Exception as e:
+            # `build` drops the filters of columns found missing
+            if not (lifecycle.check_schema_error(e) or scopes.check_schema_error(e)):
+                raise
+
+
+def _insert_row(row: Dict, size_bytes: int, signature: int, scope: str):
+    """Insert a semantic_cache row, dropping optional columns the schema lacks."""
+    lifecycle, lexical, scopes = get_cache_lifecycle(), get_lexical_index(), get_cache_scope()
+    while True:
+        fields = {**lifecycle.row_fields(size_bytes), **lexical.row_fields(signature), **scopes.row_fields(scope)}
+        try:
+            return supabase_admin.table('semantic_cache').insert({**row, **fields}).execute()
+        except Exception as e:
+            if not fields or not (
+                lifecycle.check_schema_error(e) or lexical.check_schema_error(e) or scopes.check_schema_error(e)
+            ):
+                raise
+
+
+def _update_row(row_id: str, fields: Dict, size_bytes: int):
+    """Replace the response of an existing semantic_cache row."""
+    lifecycle = get_cache_lifecycle()
+    while True:
+        extra = lifecycle.row_fields(size_bytes)
+        try:
+            return supabase_admin.table('semantic_cache').update({**fields, **extra}).eq("id", row_id).execute()
+        except Exception as e:
+            if not extra or not lifecycle.check_schema_error(e):
+                raise
+
+
+def _cached_at(row: Dict) -> Optional[float]:
+    # Save time is kept in the row metadata (absent for older rows)
+    return (row.get("metadata") or {}).get("cached_at")
+
+
+# Which path answered semantic lookups: the local index or the RPC
+_semantic_lookups = {"index": 0, "rpc": 0}
+# Background comparisons of lexical decisions with the embedding tier
+_shadow_tasks: set = set()
+
+
+def get_cache_stats() -> dict:
+    return {
+        "l1": _l1_cache.stats(),
+        "semantic_lookups": dict(_semantic_lookups),
+        "semantic_index": get_semantic_index().stats(),
+        "lexical_index": get_lexical_index().stats(),
+        "index_feed": get_cache_feed().stats(),
+        "embeddings": get_embedding_service().stats(),
+        "lifecycle": get_cache_lifecycle().stats(),
+    }
+
+
 class CacheService:
     @staticmethod
     async def get_embedding(user_id: str, text: str) -> Optional[List[float]]:
         """
         Generate embedding for the given text using the user's configured provider.
+        Memoized, so saving a prompt that was just looked up costs no extra call.
         """
         try:
-            client = await VaultService.get_embedding_client(user_id)
-            resp = await client.embeddings.create(input=text, model="text-embedding-3-small")
-            return resp.data[0].embedding
+            return await get_embedding_service().embed(user_id, text)
         except Exception as e:
             logger.error(f"Failed to generate embedding for cache: {e}")
             return None
@@ -26,34 +116,56 @@ class CacheService:
         user_id: str, 
         model: str, 
         prompt: str, 
-        threshold: float = 0.95
+        threshold: float = 0.95,
+        prompt_hash: Optional[str] = None,
+        semantic: bool = True,
+        scope: str = ""
     ) -> Optional[Dict]:
         """
         Search for a similar prompt in the semantic cache.
+        `prompt` is the text embedded for semantic matching; `prompt_hash`
+        (normally the request fingerprint) keys exact matches and defaults
+        to a hash of the prompt. Only entries saved with the same `scope`
+        (the fingerprint's), or before scopes were stored, are considered.
+        With `semantic=False` only exact matches are checked and no
+        embedding is computed.
         """
         # 1. Hash-based exact match (fastest, < 10ms with index)
-        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        prompt_hash = prompt_hash or hashlib.sha256(prompt.encode()).hexdigest()
+        scopes = get_cache_scope()
         
         logger.debug(f"🔍 Cache lookup - user_id: {user_id}, model: {model}, hash: {prompt_hash}")
-        
+
+        l1_key = (user_id, model, prompt_hash)
+        cached = _l1_cache.get(l1_key)
+        if cached is not None:
+            logger.debug(f"✅ L1 cache hit for hash: {prompt_hash}")
+            hit = json.loads(cached)
+            get_cache_lifecycle().record_hit(hit.get("id"))
+            return hit
+
         try:
-            res = supabase_admin.table('semantic_cache') \
-                .select("response, metadata") \
-                .eq("user_id", user_id) \
-                .eq("model", model) \
-                .eq("prompt_hash", prompt_hash) \
-                .limit(1) \
-                .execute()
+            res = _execute_live(lambda: scopes.filter(supabase_admin.table('semantic_cache')
+                .select("id, response, metadata")
+                .eq("user_id", user_id)
+                .eq("model", model)
+                .eq("prompt_hash", prompt_hash), scope)
+                .limit(1))
             
             logger.debug(f"📊 Hash query executed - data count: {len(res.data) if res.data else 0}")
             
             if res.data:
                 logger.info(f"✅ Exact cache hit (hash) for prompt: {prompt[:50]}...")
-                return {
+                hit = {
+                    "id": res.data[0]["id"],
                     "response": res.data[0]["response"],
                     "hit_type": "exact",
-                    "similarity": 1.0
+                    "similarity": 1.0,
+                    "cached_at": _cached_at(res.data[0])
                 }
+                _l1_set(l1_key, hit)
+                get_cache_lifecycle().record_hit(hit["id"])
+                return hit
             else:
                 logger.debug(f"❌ Hash lookup returned no results")
         except Exception as e:
@@ -61,11 +173,98 @@ class CacheService:
             import traceback
             logger.error(traceback.format_exc())
 
-        # 2. Semantic match check
+        if not semantic or not scopes.available:
+            return None
+
+        # 2. Lexical pre-filter: no similarly worded prompt means no embedding
+        # call, and a near-identical one is answered without an embedding,
+        # each only once shadow checks have shown that to be safe. Sampled
+        # lookups are compared with the embedding tier: inline when it runs
+        # anyway, in the background when the lexical tier answered.
+        lexical = get_lexical_index()
+        shadowed = None
+        if lexical.is_ready():
+            match = lexical.lookup(user_id, model, scope, simhash(prompt))
+            sampled = random.random() < LEXICAL_SHADOW_SAMPLE_RATE
+            if match.skip and lexical.skips_embeddings():
+                if sampled:
+                    CacheService._start_shadow_check(user_id, model, scope, prompt, threshold, match)
+                return None
+            if match.near_duplicate and match.similarity >= threshold and lexical.answers_near_duplicates():
+                try:
+                    res = _execute_live(lambda: supabase_admin.table('semantic_cache')
+                        .select("response, metadata")
+                        .eq("id", match.row_id)
+                        .limit(1))
+                    if res.data:
+                        logger.info(f"Near-duplicate cache hit ({match.distance} bits)")
+                        hit = {
+                            "id": match.row_id,
+                            "response": res.data[0]["response"],
+                            "hit_type": "near_duplicate",
+                            "similarity": match.similarity,
+                            "cached_at": _cached_at(res.data[0])
+                        }
+                        _l1_set(l1_key, hit)
+                        get_cache_lifecycle().record_hit(match.row_id)
+                        if sampled:
+                            CacheService._start_shadow_check(user_id, model, scope, prompt, threshold, match)
+                        return hit
+                    lexical.discard(user_id, model, scope, match.row_id)
+                except Exception as e:
+                    logger.error(f"Near-duplicate cache fetch failed: {e}")
+            if sampled:
+                shadowed = match
+
+        # 3. Semantic match check
         embedding = await CacheService.get_embedding(user_id, prompt)
         if not embedding:
             return None
 
+        hit = await CacheService._find_similar(user_id, model, scope, embedding, threshold, l1_key)
+        if shadowed is not None:
+            # Older versions of the RPC don't return the row id
+            lexical.record_shadow(shadowed, (hit["id"] or "") if hit else None)
+        return hit
+
+    @staticmethod
+    async def _find_similar(user_id: str, model: str, scope: str, embedding: List[float], threshold: float, l1_key: tuple) -> Optional[Dict]:
+        """Closest stored prompt at or above threshold, from the local index or the RPC."""
+        scopes = get_cache_scope()
+        index = get_semantic_index()
+        if index.is_ready():
+            _semantic_lookups["index"] += 1
+            match = index.search(user_id, model, scope, embedding, threshold)
+            if match:
+                row_id, similarity = match
+                try:
+                    res = _execute_live(lambda: supabase_admin.table('semantic_cache')
+                        .select("response, metadata")
+                        .eq("id", row_id)
+                        .limit(1))
+                except Exception as e:
+                    logger.error(f"Semantic cache fetch failed: {e}")
+                    return None
+                if not res.data:
+                    # Row was deleted or has expired since the index saw it
+                    index.discard(user_id, model, scope, row_id)
+                    return None
+                logger.info(f"Semantic cache hit (score: {similarity:.4f})")
+                hit = {
+                    "id": row_id,
+                    "response": res.data[0]["response"],
+                    "hit_type": "semantic",
+                    "similarity": similarity,
+                    "cached_at": _cached_at(res.data[0])
+                }
+                _l1_set(l1_key, hit)
+                get_cache_lifecycle().record_hit(row_id)
+                return hit
+            if index.settles_miss(user_id, model, scope):
+                return None
+            # Partition not loaded (yet) or only partly loaded
+
+        _semantic_lookups["rpc"] += 1
         try:
             # RPC call to find similar embeddings
             res = supabase_admin.rpc(
@@ -75,56 +274,155 @@ class CacheService:
                     'match_threshold': threshold,
                     'match_count': 1,
                     'p_user_id': user_id,
-                    'p_model': model
+                    'p_model': model,
+                    'p_scope': scope
                 }
             ).execute()
 
             if res.data:
                 match = res.data[0]
                 logger.info(f"Semantic cache hit (score: {match['similarity']:.4f})")
-                return {
+                hit = {
+                    "id": match.get("id"),
                     "response": match["response"],
                     "hit_type": "semantic",
-                    "similarity": match["similarity"]
+                    "similarity": match["similarity"],
+                    "cached_at": CacheService._rpc_cached_at(match)
                 }
+                # The same prompt will resolve to the same match, so skip the
+                # embedding round trip next time
+                _l1_set(l1_key, hit)
+                get_cache_lifecycle().record_hit(hit["id"])
+                return hit
         except Exception as e:
-            if "function" in str(e) and "does not exist" in str(e):
+            if scopes.check_schema_error(e):
+                pass
+            elif is_missing_function(e):
                 logger.error("RPC match_semantic_cache not found in database.")
             else:
                 logger.error(f"Semantic cache lookup failed: {e}")
         
         return None
 
+    @staticmethod
+    def _rpc_cached_at(match: Dict) -> Optional[float]:
+        """cached_at of an RPC match; fetched by id when the RPC predates migrations/add_cache_match_metadata.sql."""
+        if "metadata" in match or not match.get("id"):
+            return _cached_at(match)
+        try:
+            res = supabase_admin.table('semantic_cache').select("metadata").eq("id", match["id"]).limit(1).execute()
+        except Exception as e:
+            logger.error(f"Semantic cache metadata fetch failed: {e}")
+            return None
+        return _cached_at(res.data[0]) if res.data else None
+
+    @staticmethod
+    def _start_shadow_check(user_id: str, model: str, scope: str, prompt: str, threshold: float, match: LexicalMatch) -> None:
+        task = asyncio.create_task(CacheService._shadow_check(user_id, model, scope, prompt, threshold, match))
+        _shadow_tasks.add(task)
+        task.add_done_callback(_shadow_tasks.discard)
+
+    @staticmethod
+    async def _shadow_check(user_id: str, model: str, scope: str, prompt: str, threshold: float, match: LexicalMatch) -> None:
+        """Run the embedding tier for a sampled lexical decision and record whether they agree."""
+        embedding = await CacheService.get_embedding(user_id, prompt)
+        if not embedding:
+            return
+        try:
+            index = get_semantic_index()
+            found = index.search(user_id, model, scope, embedding, threshold) if index.is_ready() else None
+            if found or index.settles_miss(user_id, model, scope):
+                row_id = found[0] if found else None
+            else:
+                res = await asyncio.to_thread(lambda: supabase_admin.rpc(
+                    'match_semantic_cache',
+                    {
+                        'query_embedding': embedding,
+                        'match_threshold': threshold,
+                        'match_count': 1,
+                        'p_user_id': user_id,
+                        'p_model': model,
+                        'p_scope': scope
+                    }
+                ).execute())
+                # Older versions of the RPC don't return the row id
+                row_id = (res.data[0].get("id") or "") if res.data else None
+        except Exception as e:
+            logger.debug(f"Lexical shadow check failed: {e}")
+            return
+        get_lexical_index().record_shadow(match, row_id)
+
     @staticmethod
     async def save_to_cache(
         user_id: str, 
         model: str, 
         prompt: str, 
         response: Any, 
-        metadata: Optional[Dict] = None
+        metadata: Optional[Dict] = None,
+        prompt_hash: Optional[str] = None,
+        replaces: Optional[Dict] = None,
+        scope: str = ""
     ):
         """
         Save a response to the semantic cache.
+        Writes through to the L1 tier first, so repeats of the prompt are
+        served from memory even before the row is inserted. `replaces` is a
+        stale hit for the same request; an exact hit is updated in place.
         """
+        # Generate hash for fast exact matching
+        prompt_hash = prompt_hash or hashlib.sha256(prompt.encode()).hexdigest()
+        l1_key = (user_id, model, prompt_hash)
+        cached_at = time.time()
+        metadata = {**(metadata or {}), "cached_at": cached_at}
+        hit = {
+            "response": response,
+            "hit_type": "exact",
+            "similarity": 1.0,
+            "cached_at": cached_at
+        }
+        _l1_set(l1_key, hit)
+
+        if replaces and replaces.get("hit_type") == "exact" and replaces.get("id"):
+            # Same prompt, so the stored embedding and signature still apply
+            row_id = replaces["id"]
+            try:
+                size_bytes = len(prompt.encode()) + len(dumps(response))
+                res = _update_row(row_id, {"response": response, "metadata": metadata}, size_bytes)
+                if res.data:
+                    _l1_set(l1_key, {"id": row_id, **hit})
+                    logger.info(f"Refreshed cache entry for model: {model}")
+                    return
+            except Exception as e:
+                logger.error(f"Failed to refresh cache entry: {e}")
+                return
+
         embedding = await CacheService.get_embedding(user_id, prompt)
         if not embedding:
              return
 
-        # Generate hash for fast exact matching
-        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
-
+        # Store everything as JSON/Text
+        # response can be a full OpenAI Response object (dict)
+        row = {
+            "user_id": user_id,
+            "model": model,
+            "prompt": prompt,
+            "prompt_hash": prompt_hash,
+            "response": response,
+            "embedding": embedding,
+            "metadata": metadata
+        }
+        signature = simhash(prompt)
         try:
-            # Store everything as JSON/Text
-            # response can be a full OpenAI Response object (dict)
-            supabase_admin.table('semantic_cache').insert({
-                "user_id": user_id,
-                "model": model,
-                "prompt": prompt,
-                "prompt_hash": prompt_hash,
-                "response": response,
-                "embedding": embedding,
-                "metadata": metadata or {}
-            }).execute()
+            size_bytes = len(prompt.encode()) + len(dumps(response))
+            res = _insert_row(row, size_bytes, signature, scope)
+            if res.data:
+                row_id = res.data[0]["id"]
+                # Without the scope column the row matches any scope
+                row_scope = scope if get_cache_scope().available else None
+                get_semantic_index().add(user_id, model, row_scope, row_id, embedding)
+                get_lexical_index().add(user_id, model, row_scope, row_id, signature)
+                # L1 hits on this entry now count towards its hit_count
+                _l1_set(l1_key, {"id": row_id, **hit})
             logger.info(f"Saved response to cache for model: {model}")
         except Exception as e:
             logger.error(f"Failed to save to cache: {e}")
@@ -0,0 +1,208 @@
+"""
+Shared refresh of the gateway's in-memory copies of semantic_cache.
+
+The local indexes mirror semantic_cache rows; instead of each paging
+through the table on its own, the feed reads the rows once for all of them:
+
+- a full reload at startup and every CACHE_INDEX_REBUILD_INTERVAL seconds,
+  keyset-paginated on id. Subscribers build new partitions and swap them
+  in, which also drops rows deleted by other gateway instances;
+- in between, every CACHE_INDEX_REFRESH_INTERVAL seconds, only the rows
+  created since the previous pass, keyset-paginated on (created_at, id).
+  Each refresh re-reads the last _OVERLAP seconds, for transactions that
+  committed late and for clock skew between gateway and database.
+
+Without the created_at column (migrations/add_cache_lifecycle.sql) every
+pass is a full reload.
+
+Subscribers provide:
+    columns()         extra columns to select
+    begin_rebuild(), stage(rows), finish_rebuild(), abort_rebuild()
+                      a full reload (stage and finish run in a worker thread)
+    apply(rows)       rows from a refresh, added in place
+    check_schema_error(e)
+"""
+from config import supabase_admin as supabase
+from config import CACHE_INDEX_REFRESH_INTERVAL, CACHE_INDEX_REBUILD_INTERVAL
+from services.cache_scope import get_cache_scope
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Optional
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_PAGE_SIZE = 1000
+_OVERLAP = 60
+
+
+class CacheFeed:
+    """Reads semantic_cache rows for the local indexes, fully or incrementally."""
+
+    def __init__(
+        self,
+        refresh_interval: float = CACHE_INDEX_REFRESH_INTERVAL,
+        rebuild_interval: float = CACHE_INDEX_REBUILD_INTERVAL,
+    ):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        # Cleared when the lifecycle migration hasn't been applied
+        self.created_at_available = True
+        self._subscribers: list = []
+        self._task: Optional[asyncio.Task] = None
+        self._last_rebuild: Optional[float] = None
+        # Lower bound (created_at) of the next refresh
+        self._since: Optional[str] = None
+        self.rebuilds = 0
+        self.refreshes = 0
+        self.failed = 0
+        self.rows_read = 0
+        self.last_pass_seconds = 0.0
+
+    def subscribe(self, subscriber) -> None:
+        """Receive rows from the next pass on; call before start()."""
+        if subscriber not in self._subscribers:
+            self._subscribers.append(subscriber)
+
+    def start(self) -> None:
+        if self._subscribers and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sync)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Cache index refresh failed: {e}")
+            if self.refresh_interval <= 0:
+                return
+            await asyncio.sleep(self.refresh_interval)
+
+    def sync(self) -> None:
+        """One pass: a full reload when one is due, otherwise the new rows."""
+        started = time.monotonic()
+        since = (datetime.now(timezone.utc) - timedelta(seconds=_OVERLAP)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        full = (
+            self._since is None
+            or not self.created_at_available
+            or (self.rebuild_interval > 0 and started - self._last_rebuild >= self.rebuild_interval)
+        )
+        while True:
+            try:
+                if full:
+                    self._rebuild()
+                else:
+                    self._refresh()
+                break
+            except Exception as e:
+                # Retried with the columns that turned out to be missing dropped
+                if not self._check_schema_error(e):
+                    raise
+                full = full or not self.created_at_available
+
+        if full:
+            self._last_rebuild = started
+            self.rebuilds += 1
+        else:
+            self.refreshes += 1
+        self._since = since
+        self.last_pass_seconds = time.monotonic() - started
+
+    def _rebuild(self) -> None:
+        subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.begin_rebuild()
+        try:
+            for rows in self._pages(self._columns(subscribers)):
+                for subscriber in subscribers:
+                    subscriber.stage(rows)
+        except BaseException:
+            for subscriber in subscribers:
+                subscriber.abort_rebuild()
+            raise
+        for subscriber in subscribers:
+            subscriber.finish_rebuild()
+
+    def _refresh(self) -> None:
+        subscribers = list(self._subscribers)
+        for rows in self._pages(self._columns(subscribers), self._since):
+            for subscriber in subscribers:
+                subscriber.apply(rows)
+
+    def _columns(self, subscribers: list) -> str:
+        columns = ["id", "user_id", "model"]
+        if get_cache_scope().available:
+            columns.append("scope")
+        if self.created_at_available:
+            columns.append("created_at")
+        for subscriber in subscribers:
+            columns.extend(c for c in subscriber.columns() if c not in columns)
+        return ", ".join(columns)
+
+    def _pages(self, columns: str, since: Optional[str] = None) -> Iterator[List[dict]]:
+        """Rows in keyset-paginated pages: all of them, or those created since `since`."""
+        last = None
+        while True:
+            query = supabase.table('semantic_cache').select(columns)
+            if since is None:
+                if last is not None:
+                    query = query.gt("id", last["id"])
+                query = query.order("id")
+            else:
+                if last is None:
+                    query = query.gte("created_at", since)
+                else:
+                    created_at = last["created_at"]
+                    query = query.or_(
+                        f'created_at.gt."{created_at}",and(created_at.eq."{created_at}",id.gt.{last["id"]})'
+                    )
+                query = query.order("created_at").order("id")
+            rows = query.limit(_PAGE_SIZE).execute().data or []
+            self.rows_read += len(rows)
+            if rows:
+                yield rows
+            if len(rows) < _PAGE_SIZE:
+                return
+            last = rows[-1]
+
+    def _check_schema_error(self, e: Exception) -> bool:
+        if self.created_at_available and "created_at" in str(e):
+            logger.warning("semantic_cache.created_at not found; local cache indexes are fully reloaded on every refresh.")
+            self.created_at_available = False
+            return True
+        if get_cache_scope().check_schema_error(e):
+            return True
+        return any(subscriber.check_schema_error(e) for subscriber in self._subscribers)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscribers),
+            "incremental": self.created_at_available,
+            "rebuilds": self.rebuilds,
+            "refreshes": self.refreshes,
+            "failed": self.failed,
+            "rows_read": self.rows_read,
+            "last_pass_seconds": round(self.last_pass_seconds, 2),
+        }
+
+
+_cache_feed = None
+
+
+def get_cache_feed() -> CacheFeed:
+    """Get or create the process-wide cache feed."""
+    global _cache_feed
+    if _cache_feed is None:
+        _cache_feed = CacheFeed()
+    return _cache_feed
@@ -0,0 +1,215 @@
+"""
+semantic_cache lifecycle: expiry, hit tracking and compaction.
+
+New rows get an expiry and a size. Cache hits only bump in-memory counters,
+which are flushed to Supabase in one RPC every few seconds. A background job
+then deletes expired and over-quota rows in small batches, least
+frequently used first, so the table and its vector index stay bounded.
+See migrations/add_cache_lifecycle.sql.
+"""
+from config import supabase_admin as supabase
+from config import (
+    CACHE_TTL, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_USER_QUOTAS,
+    CACHE_COMPACTION_INTERVAL, CACHE_COMPACTION_BATCH_SIZE, CACHE_HIT_FLUSH_INTERVAL,
+)
+from services.semantic_index import get_semantic_index
+from services.lexical_index import get_lexical_index
+from utils.postgrest import is_missing_function
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Pause between compaction batches so a large backlog doesn't hog the database
+_BATCH_PAUSE = 0.5
+_MAX_PENDING_HITS = 50000
+
+
+class CacheLifecycle:
+    """Expiry, hit counting and compaction for semantic_cache rows."""
+
+    def __init__(
+        self,
+        ttl: float = CACHE_TTL,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        max_bytes: int = CACHE_MAX_BYTES,
+        user_quotas: Optional[dict] = None,
+        compaction_interval: float = CACHE_COMPACTION_INTERVAL,
+        batch_size: int = CACHE_COMPACTION_BATCH_SIZE,
+        hit_flush_interval: float = CACHE_HIT_FLUSH_INTERVAL,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.user_quotas = CACHE_USER_QUOTAS if user_quotas is None else user_quotas
+        self.compaction_interval = compaction_interval
+        self.batch_size = batch_size
+        self.hit_flush_interval = hit_flush_interval
+        # Cleared when the migration hasn't been applied, so the cache keeps
+        # working with the original schema
+        self.columns_available = True
+        self._hits_rpc_available = True
+        self._compaction_rpc_available = True
+        self._hits: Dict[str, int] = defaultdict(int)
+        self._tasks: list = []
+        self.hits_recorded = 0
+        self.hits_flushed = 0
+        self.compactions = 0
+        self.rows_deleted = 0
+        self.failed_compactions = 0
+
+    # ---- Row fields and filters ----
+
+    def row_fields(self, size_bytes: int) -> dict:
+        """Lifecycle columns for a new semantic_cache row."""
+        if not self.columns_available:
+            return {}
+        fields: Dict[str, Any] = {"size_bytes": size_bytes}
+        if self.ttl > 0:
+            fields["expires_at"] = (datetime.now(timezone.utc) + timedelta(seconds=self.ttl)).isoformat()
+        return fields
+
+    def live(self, query):
+        """Restrict a semantic_cache select to rows that haven't expired."""
+        if not self.columns_available:
+            return query
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        return query.or_(f"expires_at.is.null,expires_at.gt.{now}")
+
+    def check_schema_error(self, e: Exception) -> bool:
+        """
+        True if `e` means the lifecycle columns don't exist; lifecycle
+        fields are dropped from then on and the caller should retry.
+        """
+        message = str(e)
+        if self.columns_available and any(c in message for c in ("expires_at", "size_bytes")):
+            logger.warning("semantic_cache lifecycle columns not found; run migrations/add_cache_lifecycle.sql.")
+            self.columns_available = False
+            return True
+        return False
+
+    # ---- Hit tracking ----
+
+    def record_hit(self, row_id: Optional[str]) -> None:
+        """Count one cache hit for LFU eviction."""
+        if row_id is None or not self._hits_rpc_available:
+            return
+        if row_id not in self._hits and len(self._hits) >= _MAX_PENDING_HITS:
+            return
+        self._hits[str(row_id)] += 1
+        self.hits_recorded += 1
+
+    async def flush_hits(self) -> None:
+        if not self._hits:
+            return
+        hits, self._hits = self._hits, defaultdict(int)
+        payload = [{"id": row_id, "hits": count} for row_id, count in hits.items()]
+        try:
+            await asyncio.to_thread(lambda: supabase.rpc('record_semantic_cache_hits', {'hits': payload}).execute())
+            self.hits_flushed += sum(hits.values())
+        except Exception as e:
+            if is_missing_function(e):
+                logger.warning("RPC record_semantic_cache_hits not found; cache hits will not be tracked.")
+                self._hits_rpc_available = False
+                return
+            logger.error(f"Failed to flush cache hit counts: {e}")
+            for row_id, count in hits.items():
+                self._hits[row_id] += count
+
+    # ---- Compaction ----
+
+    async def compact(self) -> int:
+        """Delete expired and over-quota rows, one batch at a time."""
+        if not self._compaction_rpc_available:
+            return 0
+        params = {
+            'p_max_entries': self.max_entries or None,
+            'p_max_bytes': self.max_bytes or None,
+            'p_batch_size': self.batch_size,
+            'p_user_quotas': self.user_quotas,
+        }
+        deleted = 0
+        while True:
+            try:
+                res = await asyncio.to_thread(lambda: supabase.rpc('compact_semantic_cache', params).execute())
+            except Exception as e:
+                if is_missing_function(e):
+                    logger.warning("RPC compact_semantic_cache not found; cache compaction disabled.")
+                    self._compaction_rpc_available = False
+                else:
+                    self.failed_compactions += 1
+                    logger.error(f"Cache compaction failed: {e}")
+                break
+
+            rows = res.data or []
+            index, lexical = get_semantic_index(), get_lexical_index()
+            for row in rows:
+                index.discard(row["user_id"], row["model"], row.get("scope"), row["id"])
+                lexical.discard(row["user_id"], row["model"], row.get("scope"), row["id"])
+            deleted += len(rows)
+            if len(rows) < self.batch_size:
+                break
+            await asyncio.sleep(_BATCH_PAUSE)
+
+        self.compactions += 1
+        self.rows_deleted += deleted
+        if deleted:
+            logger.info(f"Cache compaction deleted {deleted} rows")
+        return deleted
+
+    # ---- Background tasks ----
+
+    def start(self) -> None:
+        """Start the hit flusher and the compaction job. Must be called from the event loop."""
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._every(self.hit_flush_interval, self.flush_hits)))
+        if self.compaction_interval > 0:
+            self._tasks.append(asyncio.create_task(self._every(self.compaction_interval, self.compact)))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        await self.flush_hits()
+
+    async def _every(self, interval: float, job) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await job()
+            except Exception as e:
+                logger.error(f"Cache lifecycle job failed: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "ttl": self.ttl,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "columns_available": self.columns_available,
+            "pending_hits": sum(self._hits.values()),
+            "hits_recorded": self.hits_recorded,
+            "hits_flushed": self.hits_flushed,
+            "compactions": self.compactions,
+            "failed_compactions": self.failed_compactions,
+            "rows_deleted": self.rows_deleted,
+        }
+
+
+_cache_lifecycle = None
+
+
+def get_cache_lifecycle() -> CacheLifecycle:
+    """Get or create the process-wide cache lifecycle manager."""
+    global _cache_lifecycle
+    if _cache_lifecycle is None:
+        _cache_lifecycle = CacheLifecycle()
+    return _cache_lifecycle
@@ -0,0 +1,177 @@
+"""
+Cacheability policy for the response cache.
+
+Decides per request whether to look the response up, whether that lookup
+may go semantic (embedding + similarity search), and whether to store the
+result. Traffic that can't realistically hit (sampled at high temperature,
+denylisted models, huge one-off prompts, users whose requests never repeat)
+skips the embedding calls and inserts. Cheap exact-hash lookups are kept
+wherever a hit is still possible.
+
+Per-user hit rates are learned from full lookups. Users below the minimum
+hit rate still take the full path for a small share of requests, so a user
+whose traffic starts repeating is picked up again.
+"""
+from config import (
+    CACHE_POLICY_ENABLED, CACHE_POLICY_MAX_TEMPERATURE, CACHE_POLICY_MIN_PROMPT_CHARS,
+    CACHE_POLICY_MAX_PROMPT_CHARS, CACHE_POLICY_MODEL_DENYLIST, CACHE_POLICY_MIN_SAMPLES,
+    CACHE_POLICY_MIN_HIT_RATE, CACHE_POLICY_EXPLORE_RATE, CACHE_POLICY_MAX_USERS,
+)
+from collections import Counter, OrderedDict
+from fnmatch import fnmatchcase
+from typing import List, Optional
+import random
+
+
+class CacheDecision:
+    """
+    `lookup`: check the exact-hash tiers. `semantic`: also embed the prompt
+    and search by similarity. `store`: save the response (embeds the prompt).
+    """
+
+    __slots__ = ("lookup", "semantic", "store", "reason")
+
+    def __init__(self, lookup: bool, semantic: bool, store: bool, reason: str):
+        self.lookup = lookup
+        self.semantic = semantic
+        self.store = store
+        self.reason = reason
+
+    @property
+    def tracked(self) -> bool:
+        """Full lookups are the ones that feed the per-user hit rate."""
+        return self.reason in ("cacheable", "explore")
+
+    def __repr__(self) -> str:
+        return f"CacheDecision(lookup={self.lookup}, semantic={self.semantic}, store={self.store}, reason={self.reason!r})"
+
+
+_DISABLED = CacheDecision(False, False, False, "disabled")
+
+
+class CachePolicy:
+    """Per-request cacheability decisions and the hit-rate history behind them."""
+
+    def __init__(
+        self,
+        enabled: bool = CACHE_POLICY_ENABLED,
+        max_temperature: float = CACHE_POLICY_MAX_TEMPERATURE,
+        min_prompt_chars: int = CACHE_POLICY_MIN_PROMPT_CHARS,
+        max_prompt_chars: int = CACHE_POLICY_MAX_PROMPT_CHARS,
+        model_denylist: Optional[List[str]] = None,
+        min_samples: int = CACHE_POLICY_MIN_SAMPLES,
+        min_hit_rate: float = CACHE_POLICY_MIN_HIT_RATE,
+        explore_rate: float = CACHE_POLICY_EXPLORE_RATE,
+        max_users: int = CACHE_POLICY_MAX_USERS,
+    ):
+        self.enabled = enabled
+        self.max_temperature = max_temperature
+        self.min_prompt_chars = min_prompt_chars
+        self.max_prompt_chars = max_prompt_chars
+        self.model_denylist = CACHE_POLICY_MODEL_DENYLIST if model_denylist is None else model_denylist
+        self.min_samples = min_samples
+        self.min_hit_rate = min_hit_rate
+        self.explore_rate = explore_rate
+        self.max_users = max_users
+        # user_id -> [lookups, hits], least recently seen first
+        self._history: "OrderedDict[str, list]" = OrderedDict()
+        self.decisions: Counter = Counter()
+        self.lookups_skipped = 0
+        self.semantic_skipped = 0
+        self.stores_skipped = 0
+        self.embeddings_avoided = 0
+
+    def decide(
+        self,
+        user_id: str,
+        model: str,
+        prompt: str,
+        temperature: Optional[float] = None,
+        tools: Optional[list] = None,
+        enabled: bool = True,
+    ) -> CacheDecision:
+        """
+        Decide how to cache one request. `prompt` is the fingerprint text;
+        `enabled` is the request's cache_enabled flag.
+        """
+        if not enabled:
+            return _DISABLED
+        decision = self._decide(user_id, model, prompt, temperature, tools)
+        self.decisions[decision.reason] += 1
+        self.lookups_skipped += not decision.lookup
+        self.semantic_skipped += not decision.semantic
+        self.stores_skipped += not decision.store
+        # Lookup and store share one memoized embedding
+        self.embeddings_avoided += not (decision.semantic or decision.store)
+        return decision
+
+    def _decide(self, user_id, model, prompt, temperature, tools) -> CacheDecision:
+        if not self.enabled:
+            return CacheDecision(True, True, True, "cacheable")
+        if any(fnmatchcase(model, pattern) for pattern in self.model_denylist):
+            return CacheDecision(False, False, False, "model_denylisted")
+        if temperature is not None and temperature > self.max_temperature:
+            # Sampled output isn't worth reusing; temperature is part of the
+            # fingerprint, so there is nothing to look up either
+            return CacheDecision(False, False, False, "high_temperature")
+        if self.max_prompt_chars and len(prompt) > self.max_prompt_chars:
+            return CacheDecision(True, False, False, "prompt_too_long")
+        if tools:
+            # Tool calls depend on the exact schema; only exact repeats (agent
+            # retries) are safe to answer
+            return CacheDecision(True, False, True, "tools")
+        if len(prompt) < self.min_prompt_chars:
+            # Too little text for a meaningful similarity score
+            return CacheDecision(True, False, True, "prompt_too_short")
+        if self._low_hit_rate(user_id):
+            if random.random() < self.explore_rate:
+                return CacheDecision(True, True, True, "explore")
+            return CacheDecision(True, False, False, "low_hit_rate")
+        return CacheDecision(True, True, True, "cacheable")
+
+    def _low_hit_rate(self, user_id: str) -> bool:
+        counts = self._history.get(user_id)
+        if counts is None or counts[0] < self.min_samples:
+            return False
+        return counts[1] / counts[0] < self.min_hit_rate
+
+    def record_lookup(self, user_id: str, decision: CacheDecision, hit: bool) -> None:
+        """Feed the outcome of a lookup back into the user's hit rate."""
+        if not decision.tracked:
+            return
+        counts = self._history.get(user_id)
+        if counts is None:
+            counts = self._history[user_id] = [0, 0]
+            if len(self._history) > self.max_users:
+                self._history.popitem(last=False)
+        else:
+            self._history.move_to_end(user_id)
+        counts[0] += 1
+        counts[1] += hit
+        # Halve the counts once the window is full so the rate follows recent traffic
+        if counts[0] >= 4 * self.min_samples:
+            counts[0] //= 2
+            counts[1] //= 2
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "decisions": dict(self.decisions),
+            "lookups_skipped": self.lookups_skipped,
+            "semantic_lookups_skipped": self.semantic_skipped,
+            "stores_skipped": self.stores_skipped,
+            "embeddings_avoided": self.embeddings_avoided,
+            "tracked_users": len(self._history),
+            "low_hit_rate_users": sum(1 for user_id in self._history if self._low_hit_rate(user_id)),
+        }
+
+
+_cache_policy = None
+
+
+def get_cache_policy() -> CachePolicy:
+    """Get or create the process-wide cache policy."""
+    global _cache_policy
+    if _cache_policy is None:
+        _cache_policy = CachePolicy()
+    return _cache_policy
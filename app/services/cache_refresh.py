@@ -0,0 +1,177 @@
+"""
+Stale-while-revalidate for cached completions.
+
+In this mode a cache hit is served immediately whatever its age, as long as
+it is within the max-staleness bound. Once it is older than the freshness
+window, the same request is replayed upstream after the response has been
+sent (through FastAPI background tasks) and the cache entry is replaced.
+Refreshes are deduplicated per entry and limited in number; when the limit
+is reached a refresh is dropped rather than queued, since the next hit will
+ask again.
+"""
+from config import CACHE_SWR_FRESHNESS, CACHE_SWR_MAX_STALENESS, CACHE_SWR_MAX_CONCURRENT_REFRESHES
+from models.chat import ChatRequest
+from services.cache import CacheService
+from utils.error_handler import log_request_async
+from utils.fingerprint import RequestFingerprint
+from typing import Any, Awaitable, Callable, Dict, Optional
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+STALE_WHILE_REVALIDATE = "stale-while-revalidate"
+_MODES = {STALE_WHILE_REVALIDATE, "swr"}
+
+
+def is_stale_while_revalidate(mode: Optional[str]) -> bool:
+    return (mode or "").strip().lower() in _MODES
+
+
+class CacheRefresher:
+    """Freshness checks and bounded background refreshes of cache entries."""
+
+    def __init__(
+        self,
+        freshness: float = CACHE_SWR_FRESHNESS,
+        max_staleness: float = CACHE_SWR_MAX_STALENESS,
+        max_concurrent: int = CACHE_SWR_MAX_CONCURRENT_REFRESHES,
+    ):
+        self.freshness = freshness
+        self.max_staleness = max_staleness
+        self.max_concurrent = max_concurrent
+        self._running = 0
+        self._in_flight: set = set()
+        self.stale_served = 0
+        self.too_stale = 0
+        self.refreshes = 0
+        self.failed_refreshes = 0
+        self.skipped_duplicate = 0
+        self.skipped_busy = 0
+
+    def age(self, hit: Dict) -> Optional[float]:
+        """Seconds since the entry was cached, or None for entries saved without a timestamp."""
+        cached_at = hit.get("cached_at")
+        return max(0.0, time.time() - cached_at) if cached_at else None
+
+    def classify(self, hit: Dict, max_staleness: Optional[float] = None) -> str:
+        """
+        "fresh", "stale" (serve and refresh) or "expired" (older than the
+        max-staleness bound; treat as a miss). A request can only tighten
+        the server-side bound; a request bound of 0 never serves stale hits.
+        """
+        limit = self.max_staleness if self.max_staleness > 0 else None  # 0 = no server bound
+        if max_staleness is not None:
+            limit = min(limit, max_staleness) if limit is not None else max_staleness
+        age = self.age(hit)
+        if age is None:
+            # Saved before timestamps were recorded: serve it, refresh it once
+            self.stale_served += 1
+            return "stale"
+        if limit is not None and age > limit:
+            self.too_stale += 1
+            return "expired"
+        if age >= self.freshness:
+            self.stale_served += 1
+            return "stale"
+        return "fresh"
+
+    async def refresh(self, key: Any, call: Callable[[], Awaitable[Any]], save: Callable[[Any], Awaitable[None]]) -> None:
+        """
+        Run `call()` upstream and pass the result to `save`, unless the
+        entry is already being refreshed or the concurrency limit is reached.
+        """
+        if key in self._in_flight:
+            self.skipped_duplicate += 1
+            return
+        if self._running >= self.max_concurrent:
+            self.skipped_busy += 1
+            return
+        self._in_flight.add(key)
+        self._running += 1
+        try:
+            response = await call()
+            await save(response)
+            self.refreshes += 1
+        except Exception as e:
+            self.failed_refreshes += 1
+            logger.warning(f"Background cache refresh failed: {e}")
+        finally:
+            self._running -= 1
+            self._in_flight.discard(key)
+
+    def stats(self) -> dict:
+        return {
+            "freshness": self.freshness,
+            "max_staleness": self.max_staleness,
+            "max_concurrent": self.max_concurrent,
+            "running": self._running,
+            "stale_served": self.stale_served,
+            "too_stale": self.too_stale,
+            "refreshes": self.refreshes,
+            "failed_refreshes": self.failed_refreshes,
+            "skipped_duplicate": self.skipped_duplicate,
+            "skipped_busy": self.skipped_busy,
+        }
+
+
+async def refresh_cached_response(
+    client,
+    chat_req: ChatRequest,
+    user_id: str,
+    api_key: str,
+    fingerprint: RequestFingerprint,
+    stale_hit: Dict,
+    request_payload: dict,
+) -> None:
+    """
+    Background task: send the non-streaming `chat_req` upstream and replace
+    `stale_hit` with the result. The upstream call is logged like any other.
+    """
+    start_time = time.time()
+
+    async def save(response) -> None:
+        await CacheService.save_to_cache(
+            user_id=user_id,
+            model=chat_req.model,
+            prompt=fingerprint.text,
+            response=response.model_dump(exclude={"key_name"}, exclude_none=True),
+            prompt_hash=fingerprint.key,
+            replaces=stale_hit,
+            scope=fingerprint.scope
+        )
+        usage = response.usage
+        await log_request_async(
+            user_id=user_id,
+            api_key=api_key,
+            provider=chat_req.model,
+            model=chat_req.model,
+            status=200,
+            request_payload={**request_payload, "cache_refresh": True},
+            response_payload={},
+            start_time=start_time,
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+            total_tokens=usage.total_tokens if usage else 0,
+            key_name=response.key_name,
+            latency_ms=getattr(response, "latency_ms", 0),
+            tokens_per_second=getattr(response, "tokens_per_second", 0),
+            key_rotation_log=getattr(response, "key_rotation_log", []),
+        )
+
+    await get_cache_refresher().refresh(
+        (user_id, chat_req.model, fingerprint.key),
+        lambda: client.chat_completions(req=chat_req),
+        save,
+    )
+
+
+_cache_refresher = None
+
+
+def get_cache_refresher() -> CacheRefresher:
+    """Get or create the process-wide cache refresher."""
+    global _cache_refresher
+    if _cache_refresher is None:
+        _cache_refresher = CacheRefresher()
+    return _cache_refresher
@@ -0,0 +1,65 @@
+"""
+Request-parameter scopes of semantic_cache rows.
+
+RequestFingerprint.scope is stored in semantic_cache.scope (see
+migrations/add_cache_scope.sql), and semantic matches are only made within
+one scope. Rows saved before the column existed have a NULL scope and are
+matched under any scope, as they were then.
+
+Without the column there is no way to keep scopes apart, so until the
+migration is applied only exact (fingerprint) matches are served.
+"""
+from typing import List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CacheScope:
+    """Whether semantic_cache.scope exists, and how to query by it."""
+
+    def __init__(self):
+        self.available = True
+
+    def check_schema_error(self, e: Exception) -> bool:
+        """
+        True if `e` means the scope column (or the scoped RPC) doesn't
+        exist; it is dropped from queries from then on and the caller
+        should retry.
+        """
+        if self.available and "scope" in str(e):
+            logger.warning(
+                "semantic_cache.scope not found; run migrations/add_cache_scope.sql. "
+                "Semantic cache matching is off until then."
+            )
+            self.available = False
+            return True
+        return False
+
+    def row_fields(self, scope: str) -> dict:
+        """scope column for a new semantic_cache row."""
+        return {"scope": scope} if self.available else {}
+
+    def filter(self, query, scope: str):
+        """Restrict a semantic_cache select to `scope` and unscoped rows."""
+        if not self.available:
+            return query
+        return query.or_(f"scope.eq.{scope},scope.is.null")
+
+    @staticmethod
+    def keys(user_id: str, model: str, scope: Optional[str]) -> List[tuple]:
+        """Local index partitions a lookup covers: its scope's and the unscoped one."""
+        if scope is None:
+            return [(user_id, model, None)]
+        return [(user_id, model, scope), (user_id, model, None)]
+
+
+_cache_scope = None
+
+
+def get_cache_scope() -> CacheScope:
+    """Get or create the process-wide scope state."""
+    global _cache_scope
+    if _cache_scope is None:
+        _cache_scope = CacheScope()
+    return _cache_scope
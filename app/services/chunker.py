@@ -0,0 +1,277 @@
+"""
+Chunkers for vault documents.
+
+A chunker turns the (page, text) segments from services/ingestion.py into
+Chunk objects carrying the text plus where it came from: the page it starts
+and ends on (PDFs only) and its character offsets in the extracted text.
+
+- "character": the original fixed 1000-character windows with 200 characters
+  of overlap, regardless of sentences or paragraphs.
+- "recursive": splits on paragraphs, then lines, then sentences, then words,
+  only as far as needed to fit VAULT_CHUNK_TOKENS tokens, and packs the
+  pieces back together up to that size. Consecutive chunks share up to
+  VAULT_CHUNK_OVERLAP_TOKENS tokens of whole sentences.
+
+Both work on a stream: text is chunked as segments arrive, holding back at
+most the paragraph in progress.
+"""
+from config import (
+    VAULT_CHUNKER, VAULT_CHUNK_TOKENS, VAULT_CHUNK_OVERLAP_TOKENS,
+    VAULT_CHUNK_CHARS, VAULT_CHUNK_OVERLAP_CHARS,
+)
+from services.ingestion import TextSegment
+from utils.token_counter import get_encoding_for_model
+from typing import AsyncIterator, Iterator, List, Optional
+import bisect
+import hashlib
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Separators tried in order; each split keeps the separator on the left part
+_SEPARATORS = [
+    re.compile(r"\n\s*\n\s*"),
+    re.compile(r"\n\s*"),
+    re.compile(r"[.!?。！？]+[\"'”’)\]]*\s+"),
+    re.compile(r"\s+"),
+]
+_SENTENCE = _SEPARATORS[2]
+
+# The recursive chunker cuts its buffer at a paragraph break once it holds
+# this much text, or anywhere after a line break once it holds 4x as much
+_FLUSH_CHARS = 16 * 1024
+
+
+class Chunk:
+    """A chunk of a document and where it came from."""
+
+    __slots__ = ("text", "start", "end", "page", "page_end", "tokens")
+
+    def __init__(self, text: str, start: int, page: Optional[int] = None, page_end: Optional[int] = None, tokens: Optional[int] = None):
+        self.text = text
+        self.start = start
+        self.end = start + len(text)
+        self.page = page
+        self.page_end = page_end
+        self.tokens = tokens
+
+    @property
+    def content_hash(self) -> str:
+        """SHA-256 of the text; equal chunks share stored embeddings."""
+        return hashlib.sha256(self.text.encode("utf-8", "surrogatepass")).hexdigest()
+
+    @property
+    def metadata(self) -> dict:
+        """Stored with the chunk's embedding (vault_embeddings.metadata)."""
+        meta = {"start": self.start, "end": self.end}
+        if self.page is not None:
+            meta["page"] = self.page
+            meta["page_end"] = self.page_end
+        if self.tokens is not None:
+            meta["tokens"] = self.tokens
+        return meta
+
+
+class _PageMap:
+    """Which page each character offset of the extracted text is on."""
+
+    def __init__(self):
+        self._offsets: List[int] = []
+        self._pages: List[Optional[int]] = []
+
+    def add(self, offset: int, page: Optional[int]) -> None:
+        if not self._pages or self._pages[-1] != page:
+            self._offsets.append(offset)
+            self._pages.append(page)
+
+    def page_at(self, offset: int) -> Optional[int]:
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        return self._pages[i] if i >= 0 else None
+
+    def forget_before(self, offset: int) -> None:
+        """Drop entries no chunk can refer to any more."""
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        if i > 0:
+            del self._offsets[:i]
+            del self._pages[:i]
+
+
+class CharacterChunker:
+    """Fixed-size character windows with overlap (the original splitter)."""
+
+    name = "character"
+
+    def __init__(self, chunk_size: int = VAULT_CHUNK_CHARS, overlap: int = VAULT_CHUNK_OVERLAP_CHARS):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    async def chunks(self, segments: AsyncIterator[TextSegment]) -> AsyncIterator[Chunk]:
+        """Identical to splitting the concatenated text."""
+        step = max(1, self.chunk_size - self.overlap)
+        pages = _PageMap()
+        buffer, pos, base = "", 0, 0  # base: document offset of buffer[0]
+        async for page, text in segments:
+            base += pos
+            buffer = buffer[pos:] + text
+            pos = 0
+            pages.add(base + len(buffer) - len(text), page)
+            while len(buffer) - pos >= self.chunk_size:
+                yield self._chunk(buffer[pos:pos + self.chunk_size], base + pos, pages)
+                pos += step
+            pages.forget_before(base + pos)
+        while pos < len(buffer):
+            yield self._chunk(buffer[pos:pos + self.chunk_size], base + pos, pages)
+            pos += step
+
+    @staticmethod
+    def _chunk(text: str, start: int, pages: _PageMap) -> Chunk:
+        return Chunk(text, start, pages.page_at(start), pages.page_at(start + len(text) - 1))
+
+
+class _Piece:
+    __slots__ = ("text", "start", "tokens")
+
+    def __init__(self, text: str, start: int, tokens: int):
+        self.text = text
+        self.start = start
+        self.tokens = tokens
+
+
+def _split_after(text: str, separator: re.Pattern) -> List[str]:
+    """Split `text` after each match of `separator`, keeping every character."""
+    parts, last = [], 0
+    for match in separator.finditer(text):
+        if match.end() > last and match.end() < len(text):
+            parts.append(text[last:match.end()])
+            last = match.end()
+    parts.append(text[last:])
+    return parts
+
+
+class RecursiveTokenChunker:
+    """Chunks on paragraph and sentence boundaries, sized in tokens."""
+
+    name = "recursive"
+
+    def __init__(self, max_tokens: int = VAULT_CHUNK_TOKENS, overlap_tokens: int = VAULT_CHUNK_OVERLAP_TOKENS, model: str = EMBEDDING_MODEL):
+        self.max_tokens = max(16, max_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.max_tokens // 2))
+        self._encoding = get_encoding_for_model(model)
+
+    def _count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    async def chunks(self, segments: AsyncIterator[TextSegment]) -> AsyncIterator[Chunk]:
+        pages = _PageMap()
+        pending: List[_Piece] = []
+        buffer, base = "", 0  # base: document offset of buffer[0]
+        async for page, text in segments:
+            pages.add(base + len(buffer), page)
+            buffer += text
+            cut = self._cut(buffer)
+            if cut:
+                for chunk in self._pack(self._pieces(buffer[:cut], base), pending, pages):
+                    yield chunk
+                buffer, base = buffer[cut:], base + cut
+                pages.forget_before(pending[0].start if pending else base)
+        if buffer:
+            for chunk in self._pack(self._pieces(buffer, base), pending, pages):
+                yield chunk
+        if pending:
+            yield self._chunk(pending, pages)
+
+    @staticmethod
+    def _cut(buffer: str) -> int:
+        """How much of the buffer can be chunked before more text arrives."""
+        if len(buffer) < _FLUSH_CHARS:
+            return 0
+        for separator in _SEPARATORS[0].pattern, r"\n":
+            ends = [m.end() for m in re.finditer(separator, buffer)]
+            ends = [end for end in ends if end < len(buffer)]
+            if ends:
+                return ends[-1]
+            if len(buffer) < 4 * _FLUSH_CHARS:
+                return 0
+        return len(buffer)
+
+    def _pieces(self, text: str, start: int, level: int = 0) -> Iterator[_Piece]:
+        """Pieces of at most max_tokens, split at the coarsest boundaries possible."""
+        if level > 0:
+            tokens = self._count(text)
+            if tokens <= self.max_tokens:
+                yield _Piece(text, start, tokens)
+                return
+        if level == len(_SEPARATORS):
+            yield from self._hard_split(text, start, tokens)
+            return
+        for part in _split_after(text, _SEPARATORS[level]):
+            yield from self._pieces(part, start, level + 1)
+            start += len(part)
+
+    def _hard_split(self, text: str, start: int, tokens: int) -> Iterator[_Piece]:
+        # A single "word" longer than a chunk (base64, tables without spaces)
+        size = max(1, len(text) * self.max_tokens // tokens)
+        for i in range(0, len(text), size):
+            part = text[i:i + size]
+            yield _Piece(part, start + i, self._count(part))
+
+    def _pack(self, pieces: Iterator[_Piece], pending: List[_Piece], pages: _PageMap) -> Iterator[Chunk]:
+        """Greedily fill chunks with whole pieces; `pending` holds the chunk being filled."""
+        for piece in pieces:
+            if pending and sum(p.tokens for p in pending) + piece.tokens > self.max_tokens:
+                if any(p.text.strip() for p in pending):
+                    yield self._chunk(pending, pages)
+                    pending[:] = self._overlap(pending)
+                else:
+                    pending.clear()
+                while pending and sum(p.tokens for p in pending) + piece.tokens > self.max_tokens:
+                    pending.pop(0)
+            pending.append(piece)
+
+    def _overlap(self, pieces: List[_Piece]) -> List[_Piece]:
+        """The trailing sentences of a chunk that fit in overlap_tokens."""
+        if not self.overlap_tokens:
+            return []
+        tail: List[_Piece] = []
+        budget = self.overlap_tokens
+        for piece in reversed(pieces):
+            if piece.tokens <= budget:
+                tail.insert(0, piece)
+                budget -= piece.tokens
+                continue
+            # Take whole sentences from the end of a longer piece
+            offset = piece.start + len(piece.text)
+            for sentence in reversed(_split_after(piece.text, _SENTENCE)):
+                tokens = self._count(sentence)
+                offset -= len(sentence)
+                if tokens > budget:
+                    break
+                tail.insert(0, _Piece(sentence, offset, tokens))
+                budget -= tokens
+            break
+        return tail
+
+    @staticmethod
+    def _chunk(pieces: List[_Piece], pages: _PageMap) -> Chunk:
+        text = "".join(p.text for p in pieces)
+        start = pieces[0].start
+        return Chunk(text, start, pages.page_at(start), pages.page_at(start + len(text) - 1), sum(p.tokens for p in pieces))
+
+
+CHUNKERS = {
+    CharacterChunker.name: CharacterChunker,
+    RecursiveTokenChunker.name: RecursiveTokenChunker,
+}
+
+
+def get_chunker(name: Optional[str] = None):
+    """A chunker by name (default VAULT_CHUNKER); unknown names fall back to "recursive"."""
+    name = (name or VAULT_CHUNKER).strip().lower()
+    cls = CHUNKERS.get(name)
+    if cls is None:
+        logger.warning(f"Unknown chunker {name!r}; using {RecursiveTokenChunker.name!r}.")
+        cls = RecursiveTokenChunker
+    return cls()
@@ -0,0 +1,193 @@
+"""
+Single-flight coalescing of identical in-flight completions.
+
+Requests are keyed by (user_id, request fingerprint, stream). The first one
+starts the upstream call in its own task; identical requests that arrive
+while it is running await the same result instead of calling upstream
+again. Streams are tee'd: every item the provider client yields (SSE frames
+and the final metadata dict) is buffered and replayed to each subscriber,
+so late joiners still receive the full response.
+
+Running upstream in a task means the leader's client disconnecting does not
+cut off the followers. Per-response side effects such as cache saves are
+passed in as `on_complete` and run from that task, so they happen once per
+upstream call whichever subscribers are still connected. A stream whose
+subscribers have all gone is cancelled rather than read to the end.
+"""
+from config import COALESCE_ENABLED
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+OnComplete = Callable[[Any], Awaitable[None]]
+
+
+class _StreamFlight:
+    """Buffered output of one upstream stream, shared by its subscribers."""
+
+    def __init__(self):
+        self.items: list = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, item: Any) -> None:
+        self.items.append(item)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        position = 0
+        while True:
+            while position < len(self.items):
+                yield self.items[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class RequestCoalescer:
+    """Shares one upstream call between concurrent identical requests."""
+
+    def __init__(self, enabled: bool = COALESCE_ENABLED):
+        self.enabled = enabled
+        self._calls: Dict[tuple, asyncio.Task] = {}
+        self._streams: Dict[tuple, _StreamFlight] = {}
+        self._tasks: set = set()
+        self.upstream_calls = 0
+        self.coalesced_calls = 0
+        self.upstream_streams = 0
+        self.coalesced_streams = 0
+
+    async def run(self, key: Optional[tuple], call: Callable[[], Awaitable[Any]],
+                  on_complete: Optional[OnComplete] = None) -> Tuple[Any, bool]:
+        """
+        Await `call()` once per key (None opts out). Returns (result, leader).
+        `on_complete(result)` runs in the background once per upstream call.
+        """
+        if not self.enabled or key is None:
+            return await self._call(call, on_complete), True
+
+        task = self._calls.get(key)
+        leader = task is None
+        if leader:
+            self.upstream_calls += 1
+            task = asyncio.get_running_loop().create_task(self._call(call, on_complete))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._calls.pop(key, None) if self._calls.get(key) is t else None)
+        else:
+            self.coalesced_calls += 1
+        return await asyncio.shield(task), leader
+
+    async def _call(self, call: Callable[[], Awaitable[Any]], on_complete: Optional[OnComplete]) -> Any:
+        result = await call()
+        if on_complete is not None:
+            self._spawn(self._complete(on_complete, result))
+        return result
+
+    def stream(self, key: Optional[tuple], open_stream: Callable[[], AsyncIterator[Any]],
+               on_complete: Optional[OnComplete] = None) -> Tuple[AsyncIterator[Any], bool]:
+        """
+        Subscribe to the stream for `key` (None opts out), starting it if
+        needed. Returns (items, leader). `on_complete(items)` runs once the
+        upstream stream has finished successfully.
+        """
+        flight = self._streams.get(key) if self.enabled and key is not None else None
+        leader = flight is None
+        if leader:
+            flight = _StreamFlight()
+            if self.enabled and key is not None:
+                self.upstream_streams += 1
+                self._streams[key] = flight
+            else:
+                # Opted out: still pumped from a task so on_complete and
+                # cancellation behave the same, just never shared
+                key = None
+            flight.task = self._spawn(self._pump(key, flight, open_stream, on_complete))
+        else:
+            self.coalesced_streams += 1
+        # Counted up front so the pump isn't cancelled between a follower
+        # joining and its first read
+        flight.subscribers += 1
+        return self._subscribe(key, flight), leader
+
+    async def _subscribe(self, key: Optional[tuple], flight: _StreamFlight) -> AsyncIterator[Any]:
+        try:
+            async for item in flight.subscribe():
+                yield item
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Nobody is reading any more; stop paying for the upstream
+                # stream. New requests start a fresh one.
+                if key is not None and self._streams.get(key) is flight:
+                    del self._streams[key]
+                flight.task.cancel()
+
+    async def _pump(self, key: Optional[tuple], flight: _StreamFlight,
+                    open_stream: Callable[[], AsyncIterator[Any]], on_complete: Optional[OnComplete]) -> None:
+        error: Optional[BaseException] = RuntimeError("Upstream stream was cancelled")
+        try:
+            async for item in open_stream():
+                flight.publish(item)
+            error = None
+        except Exception as e:
+            error = e
+        finally:
+            # New requests from here on start a fresh upstream call
+            if key is not None and self._streams.get(key) is flight:
+                del self._streams[key]
+            flight.finish(error)
+        if error is None and on_complete is not None:
+            await self._complete(on_complete, flight.items)
+
+    @staticmethod
+    async def _complete(on_complete: OnComplete, result: Any) -> None:
+        try:
+            await on_complete(result)
+        except Exception as e:
+            logger.error(f"Coalesced completion callback failed: {e}", exc_info=True)
+
+    def _spawn(self, coro: Awaitable[Any]) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "in_flight_calls": len(self._calls),
+            "in_flight_streams": len(self._streams),
+            "upstream_calls": self.upstream_calls,
+            "coalesced_calls": self.coalesced_calls,
+            "upstream_streams": self.upstream_streams,
+            "coalesced_streams": self.coalesced_streams,
+            "upstream_requests_saved": self.coalesced_calls + self.coalesced_streams,
+        }
+
+
+_coalescer = None
+
+
+def get_coalescer() -> RequestCoalescer:
+    """Get or create the process-wide request coalescer."""
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = RequestCoalescer()
+    return _coalescer
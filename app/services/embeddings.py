@@ -0,0 +1,300 @@
+"""
+Shared embedding service for the semantic cache and the knowledge vault.
+
+Embeddings are memoized by (embedding model, text hash), so the lookup and
+the save of the same uncached prompt, and repeated vault queries, cost one
+provider call. Concurrent requests for the same text through the same
+provider endpoint and key share a single call; the user's provider is
+always resolved first, so one without an embedding provider is refused
+even for a memoized text. The memo can be snapshotted to disk so a restart
+keeps it warm.
+
+Misses are micro-batched: texts for the same provider key and model that
+arrive within a short window go out as one multi-input embeddings call and
+the vectors are fanned back out to the callers. Batches are capped by text
+count and by estimated tokens; one the provider rejects as a bad request is
+split in halves, so only the texts at fault fail.
+"""
+from config import EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_MAX_BYTES, EMBEDDING_CACHE_PATH
+from config import EMBEDDING_BATCH_WINDOW_MS, EMBEDDING_BATCH_MAX_SIZE, EMBEDDING_BATCH_MAX_TOKENS
+from services.routing import get_routing_table, DEFAULT_BASE_URL
+from providers.client_pool import get_client_pool
+from utils.ttl_cache import TTLCache
+from openai import AsyncOpenAI
+from typing import Dict, List, Optional
+import numpy as np
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+
+def get_embedding_client(user_id: str) -> AsyncOpenAI:
+    """
+    Get OpenAI or OpenRouter client for embeddings.
+    """
+    table = get_routing_table(user_id)
+
+    # 1. Try OpenAI first
+    route = table.resolve("openai")
+    if route and route.keys:
+        return get_client_pool().get(DEFAULT_BASE_URL, route.keys[0].get('encrypted_key'))
+
+    # 2. Try OpenRouter as fallback
+    route = table.resolve("openrouter")
+    if route and route.keys:
+        return get_client_pool().get(OPENROUTER_BASE_URL, route.keys[0].get('encrypted_key'))
+
+    raise ValueError("No API keys found for OpenAI or OpenRouter. Please configure one of them to use Knowledge Vault.")
+
+
+def _estimate_tokens(text: str) -> int:
+    # Upper bound-ish without running a tokenizer: English averages ~4 bytes
+    # per token, CJK ~3
+    return len(text.encode("utf-8", "surrogatepass")) // 3 + 1
+
+
+def _is_input_error(e: Exception) -> bool:
+    """True if the provider refused the request itself (e.g. an input over the token limit)."""
+    return getattr(e, "status_code", None) in (400, 413)
+
+
+def _retrieve_exception(task: asyncio.Future) -> None:
+    # Callers re-raise it; this only avoids "exception never retrieved" when
+    # every caller has gone away
+    if not task.cancelled():
+        task.exception()
+
+
+class _Batch:
+    """Texts waiting to be sent in one embeddings call."""
+
+    __slots__ = ("client", "model", "texts", "futures", "enqueued", "tokens", "timer")
+
+    def __init__(self, client: AsyncOpenAI, model: str):
+        self.client = client
+        self.model = model
+        self.texts: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.enqueued: List[float] = []
+        self.tokens = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class EmbeddingService:
+    """Memoizing, micro-batching front for single-text embedding requests."""
+
+    def __init__(
+        self,
+        max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+        path: str = EMBEDDING_CACHE_PATH,
+        batch_window: float = EMBEDDING_BATCH_WINDOW_MS / 1000,
+        batch_max_size: int = EMBEDDING_BATCH_MAX_SIZE,
+        batch_max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+    ):
+        # Vectors are kept as float32 arrays (~6 KB for 1536 dims instead of
+        # ~50 KB as a list of Python floats)
+        self._memo = TTLCache(maxsize=max_entries, ttl=float("inf"), max_bytes=max_bytes, sizeof=lambda v: v.nbytes)
+        self._inflight: Dict[tuple, asyncio.Future] = {}
+        self.path = path
+        self.batch_window = batch_window
+        self.batch_max_size = batch_max_size
+        self.batch_max_tokens = batch_max_tokens
+        self._batches: Dict[tuple, _Batch] = {}
+        self._senders: set = set()
+        self.requests = 0
+        self.shared_calls = 0
+        self.provider_calls = 0
+        self.failures = 0
+        self.split_batches = 0
+        self.batched_texts = 0
+        self.max_batch_size_seen = 0
+        self.batch_wait_seconds = 0.0
+
+    @staticmethod
+    def _key(model: str, text: str) -> tuple:
+        return (model, hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest())
+
+    @staticmethod
+    def _client_identity(client: AsyncOpenAI) -> tuple:
+        return (str(client.base_url), hashlib.blake2b((client.api_key or "").encode(), digest_size=16).digest())
+
+    async def embed(self, user_id: str, text: str, model: str = EMBEDDING_MODEL) -> List[float]:
+        """
+        Embed one text with the user's embedding provider.
+        Raises ValueError if the user has no embedding provider configured.
+        """
+        self.requests += 1
+        client = get_embedding_client(user_id)
+        key = self._key(model, text)
+        vector = self._memo.get(key)
+        if vector is not None:
+            return vector.tolist()
+
+        # Only callers using the same provider key share a call, so nobody
+        # gets another user's provider errors or is billed for their text
+        flight = self._client_identity(client) + key
+        pending = self._inflight.get(flight)
+        if pending is None:
+            # A task of its own, so a cancelled caller doesn't cancel the
+            # call for everyone else waiting on the same text
+            get_client_pool().retain(client)
+            pending = self._inflight[flight] = asyncio.ensure_future(self._compute(client, flight, key, text, model))
+            pending.add_done_callback(_retrieve_exception)
+        else:
+            self.shared_calls += 1
+        return (await asyncio.shield(pending)).tolist()
+
+    async def _compute(self, client: AsyncOpenAI, flight: tuple, key: tuple, text: str, model: str) -> np.ndarray:
+        try:
+            vector = await self._dispatch(client, text, model)
+            self._memo.set(key, vector)
+            return vector
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            del self._inflight[flight]
+            get_client_pool().release(client)
+
+    async def _dispatch(self, client: AsyncOpenAI, text: str, model: str) -> np.ndarray:
+        if self.batch_window <= 0 or self.batch_max_size <= 1:
+            self.provider_calls += 1
+            resp = await client.embeddings.create(input=text, model=model)
+            return np.asarray(resp.data[0].embedding, dtype=np.float32)
+
+        loop = asyncio.get_running_loop()
+        batch_key = (str(client.base_url), client.api_key, model)
+        tokens = _estimate_tokens(text)
+        batch = self._batches.get(batch_key)
+        if batch is not None and self.batch_max_tokens > 0 and batch.tokens + tokens > self.batch_max_tokens:
+            self._flush(batch_key)
+            batch = None
+        if batch is None:
+            batch = self._batches[batch_key] = _Batch(client, model)
+            batch.timer = loop.call_later(self.batch_window, self._flush, batch_key)
+
+        future = loop.create_future()
+        batch.texts.append(text)
+        batch.futures.append(future)
+        batch.enqueued.append(loop.time())
+        batch.tokens += tokens
+        if len(batch.texts) >= self.batch_max_size or (self.batch_max_tokens > 0 and batch.tokens >= self.batch_max_tokens):
+            self._flush(batch_key)
+        return await future
+
+    def _flush(self, batch_key: tuple) -> None:
+        batch = self._batches.pop(batch_key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.get_running_loop().create_task(self._send(batch))
+        self._senders.add(task)
+        task.add_done_callback(self._senders.discard)
+
+    async def _send(self, batch: _Batch) -> None:
+        now = asyncio.get_running_loop().time()
+        self.batch_wait_seconds += sum(now - t for t in batch.enqueued)
+        self.batched_texts += len(batch.texts)
+        self.max_batch_size_seen = max(self.max_batch_size_seen, len(batch.texts))
+        await self._send_texts(batch.client, batch.model, batch.texts, batch.futures)
+
+    async def _send_texts(self, client: AsyncOpenAI, model: str, texts: List[str], futures: List[asyncio.Future]) -> None:
+        self.provider_calls += 1
+        try:
+            resp = await client.embeddings.create(input=texts, model=model)
+        except Exception as e:
+            if len(texts) > 1 and _is_input_error(e):
+                # Most likely one text is too long; retry the halves so the
+                # rest still get their vectors
+                self.split_batches += 1
+                middle = len(texts) // 2
+                await asyncio.gather(
+                    self._send_texts(client, model, texts[:middle], futures[:middle]),
+                    self._send_texts(client, model, texts[middle:], futures[middle:]),
+                )
+                return
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for item in resp.data:
+            future = futures[item.index]
+            if not future.done():
+                future.set_result(np.asarray(item.embedding, dtype=np.float32))
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError("Embedding missing from batched response"))
+
+    async def start(self) -> None:
+        """Load the memo snapshot, if one is configured."""
+        if self.path and os.path.exists(self.path):
+            try:
+                loaded = await asyncio.to_thread(self._load)
+                logger.info(f"Loaded {loaded} cached embeddings from {self.path}")
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable embedding cache snapshot: {e}")
+
+    async def stop(self) -> None:
+        """Write the memo snapshot, if one is configured."""
+        if self.path:
+            try:
+                await asyncio.to_thread(self._save)
+            except Exception as e:
+                logger.error(f"Failed to save embedding cache snapshot: {e}")
+
+    def _save(self) -> None:
+        # One "model<TAB>hash<TAB>base64 float32" line per entry, oldest first
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for (model, digest), vector in self._memo.items():
+                f.write(f"{model}\t{digest.hex()}\t{base64.b64encode(vector.tobytes()).decode()}\n")
+        os.replace(tmp, self.path)
+
+    def _load(self) -> int:
+        loaded = 0
+        with open(self.path) as f:
+            for line in f:
+                model, digest, data = line.rstrip("\n").split("\t")
+                self._memo.set((model, bytes.fromhex(digest)), np.frombuffer(base64.b64decode(data), dtype=np.float32))
+                loaded += 1
+        return loaded
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "provider_calls": self.provider_calls,
+            "calls_avoided": self._memo.hits + self.shared_calls,
+            "shared_calls": self.shared_calls,
+            "failures": self.failures,
+            "batching": {
+                "window_ms": self.batch_window * 1000,
+                "max_size": self.batch_max_size,
+                "max_tokens": self.batch_max_tokens,
+                "split_batches": self.split_batches,
+                "batched_texts": self.batched_texts,
+                "avg_batch_size": round(self.batched_texts / self.provider_calls, 2) if self.provider_calls else 0.0,
+                "max_batch_size": self.max_batch_size_seen,
+                "avg_added_latency_ms": round(self.batch_wait_seconds / self.batched_texts * 1000, 3) if self.batched_texts else 0.0,
+            },
+            "memo": self._memo.stats(),
+        }
+
+
+_embedding_service = None
+
+
+def get_embedding_service() -> EmbeddingService:
+    """Get or create the process-wide embedding service."""
+    global _embedding_service
+    if _embedding_service is None:
+        _embedding_service = EmbeddingService()
+    return _embedding_service
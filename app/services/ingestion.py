@@ -0,0 +1,212 @@
+"""
+Streaming ingestion pipeline for vault uploads.
+
+Uploads are spooled to a temporary file in small reads instead of being
+read into memory in one go. Text is then extracted off the event loop: PDF
+pages are parsed in batches in a process pool, DOCX files are parsed there
+too, and plain text is decoded incrementally in a thread. Extracted text
+is yielded in order as each batch finishes, so chunking and embedding start
+before the last page has been parsed.
+
+Memory per upload is bounded by the read size, the number of parse tasks
+in flight (INGEST_MAX_PENDING_TASKS x INGEST_PAGES_PER_TASK pages of text)
+and whatever the consumer buffers.
+"""
+from config import (
+    VAULT_UPLOAD_MAX_BYTES, INGEST_SPOOL_DIR, INGEST_PARSE_WORKERS,
+    INGEST_PAGES_PER_TASK, INGEST_MAX_PENDING_TASKS,
+)
+from utils import document_parser
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import UploadFile
+from typing import AsyncIterator, Optional, Tuple
+import asyncio
+import codecs
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+_READ_SIZE = 1024 * 1024
+_TEXT_BLOCK_CHARS = 64 * 1024
+
+# (page number or None, text)
+TextSegment = Tuple[Optional[int], str]
+
+
+class IngestionProgress:
+    """How far an upload has got; updated by the parser and the embedding executor."""
+
+    def __init__(self):
+        self.pages_total: Optional[int] = None  # PDFs only
+        self.pages_parsed = 0
+        self.bytes_total = 0
+        self.bytes_parsed = 0
+        self.chunks = 0
+        self.chunks_embedded = 0
+        self.embeddings_saved = 0
+
+    def fraction(self) -> Optional[float]:
+        """Share of the input parsed so far, if known."""
+        if self.pages_total:
+            return self.pages_parsed / self.pages_total
+        if self.bytes_total:
+            return self.bytes_parsed / self.bytes_total
+        return None
+
+    def to_dict(self) -> dict:
+        return {
+            "pages_total": self.pages_total,
+            "pages_parsed": self.pages_parsed,
+            "bytes_total": self.bytes_total,
+            "bytes_parsed": self.bytes_parsed,
+            "chunks": self.chunks,
+            "chunks_embedded": self.chunks_embedded,
+            "embeddings_saved": self.embeddings_saved,
+        }
+
+
+class SpooledUpload:
+    """An upload copied to a temporary file; delete with close()."""
+
+    def __init__(self, path: str, filename: str, size: int, sha256: str):
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.sha256 = sha256
+
+    @property
+    def extension(self) -> str:
+        return self.filename.rsplit(".", 1)[-1].lower() if "." in self.filename else ""
+
+    def close(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+async def spool_upload(file: UploadFile, max_bytes: int = VAULT_UPLOAD_MAX_BYTES) -> SpooledUpload:
+    """
+    Copy an upload to disk in bounded reads, rejecting files over max_bytes.
+    The content is hashed on the way through.
+    """
+    digest = hashlib.sha256()
+    fd, path = tempfile.mkstemp(prefix="vault-upload-", suffix=os.path.splitext(file.filename or "")[1], dir=INGEST_SPOOL_DIR or None)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            while True:
+                data = await file.read(_READ_SIZE)
+                if not data:
+                    break
+                size += len(data)
+                if max_bytes and size > max_bytes:
+                    raise ValueError(f"File exceeds the upload limit of {max_bytes} bytes.")
+                digest.update(data)
+                await asyncio.to_thread(out.write, data)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return SpooledUpload(path, file.filename or "upload.txt", size, digest.hexdigest())
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=INGEST_PARSE_WORKERS)
+    return _pool
+
+
+def shutdown_ingestion_pool() -> None:
+    """Stop the parser processes (called on app shutdown)."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def _run_in_pool(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_pool(), fn, *args)
+
+
+async def _pdf_segments(path: str, progress: IngestionProgress) -> AsyncIterator[TextSegment]:
+    try:
+        page_count = await _run_in_pool(document_parser.pdf_page_count, path)
+        progress.pages_total = page_count
+        starts = iter(range(0, page_count, INGEST_PAGES_PER_TASK))
+        pending = collections.deque()
+
+        def submit() -> bool:
+            start = next(starts, None)
+            if start is None:
+                return False
+            stop = min(start + INGEST_PAGES_PER_TASK, page_count)
+            pending.append((start, asyncio.ensure_future(_run_in_pool(document_parser.extract_pdf_pages, path, start, stop))))
+            return True
+
+        # Keep a bounded window of batches in flight, consumed in page order
+        for _ in range(max(1, INGEST_MAX_PENDING_TASKS)):
+            if not submit():
+                break
+        try:
+            while pending:
+                start, task = pending.popleft()
+                pages = await task
+                submit()
+                progress.pages_parsed = start + len(pages)
+                for offset, text in enumerate(pages):
+                    if text:
+                        yield start + offset + 1, text + "\n"
+        finally:
+            for _, task in pending:
+                task.cancel()
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError(f"Failed to parse PDF: {e}")
+
+
+async def _docx_segments(path: str, progress: IngestionProgress) -> AsyncIterator[TextSegment]:
+    try:
+        blocks = await _run_in_pool(document_parser.extract_docx_blocks, path, _TEXT_BLOCK_CHARS)
+    except Exception as e:
+        raise ValueError(f"Failed to parse DOCX: {e}")
+    progress.bytes_parsed = progress.bytes_total
+    for block in blocks:
+        yield None, block
+
+
+async def _text_segments(path: str, progress: IngestionProgress) -> AsyncIterator[TextSegment]:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    with open(path, "rb") as f:
+        while True:
+            data = await asyncio.to_thread(f.read, _READ_SIZE)
+            progress.bytes_parsed += len(data)
+            try:
+                text = decoder.decode(data, final=not data)
+            except UnicodeDecodeError:
+                raise ValueError("File content must be UTF-8 text.")
+            if text:
+                yield None, text
+            if not data:
+                return
+
+
+def iter_document_text(upload: SpooledUpload, progress: Optional[IngestionProgress] = None) -> AsyncIterator[TextSegment]:
+    """Extracted text of an upload as (page, text) segments, in document order."""
+    progress = progress or IngestionProgress()
+    progress.bytes_total = upload.size
+    if upload.extension == "pdf":
+        return _pdf_segments(upload.path, progress)
+    if upload.extension == "docx":
+        return _docx_segments(upload.path, progress)
+    # Anything else is treated as plain text
+    return _text_segments(upload.path, progress)
+
@@ -0,0 +1,357 @@
+"""
+Concurrent embedding and storage of vault chunks.
+
+Chunks are grouped into embedding requests by token count rather than by a
+fixed number of inputs, so a batch of short chunks and a batch of long ones
+cost about the same per request. Up to INGEST_EMBED_CONCURRENCY batches are
+in flight at once; each is embedded and then inserted from a worker thread,
+so the insert of one batch overlaps the embedding of the next. When every
+slot is busy, add() waits, which in turn slows down parsing.
+
+Transient failures (connection errors, timeouts, 429 and 5xx) are retried
+per batch with exponential backoff. A batch the provider rejects as too
+large is split in half and the token budget of later batches is lowered.
+Only a batch that still fails after that fails the upload.
+
+Inserts are upserts keyed on (document_id, content_hash, chunk_start), added
+by migrations/add_vault_chunk_keys.sql, so an insert that timed out after
+committing can be retried. Without that key, only failures where nothing
+can have been written (connection refused, database unreachable) are.
+
+Chunk metadata (page, offsets, tokens; see services/chunker.py) goes into
+vault_embeddings.metadata, added by migrations/add_vault_chunk_metadata.sql.
+
+Each row also records the SHA-256 of its text (content_hash, added by
+migrations/add_vault_content_hashes.sql). Before a batch is sent, chunks
+whose text is already stored in one of the user's vaults take that
+embedding, and repeats within the batch are embedded once.
+"""
+from config import supabase_admin
+from config import (
+    INGEST_EMBED_CONCURRENCY, INGEST_EMBED_BATCH_TOKENS, INGEST_EMBED_BATCH_MAX_INPUTS,
+    INGEST_EMBED_MAX_RETRIES, INGEST_EMBED_RETRY_BACKOFF,
+)
+from services.chunker import Chunk
+from services.ingestion import IngestionProgress
+from utils.token_counter import count_tokens_in_text
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, BadRequestError
+from typing import Awaitable, Callable, Dict, List, Optional
+import asyncio
+import httpx
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Token budgets never shrink below this when batches are split
+_MIN_BATCH_TOKENS = 512
+# Content hashes per reuse lookup, keeping the query string short
+_LOOKUP_PAGE = 50
+
+
+def _is_transient(e: Exception) -> bool:
+    if isinstance(e, APIConnectionError):  # includes timeouts
+        return True
+    if isinstance(e, APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+
+def _is_unapplied(e: Exception) -> bool:
+    """True if a failed insert certainly wrote nothing."""
+    if isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    code = str(getattr(e, "code", None) or "")
+    # PostgREST couldn't reach the database; SQLSTATE classes 08 (connection),
+    # 40 (rolled back), 53 (resources) and 57 (cancelled, e.g. statement timeout)
+    return code.startswith("PGRST0") or (len(code) == 5 and code[:2] in ("08", "40", "53", "57"))
+
+
+def _is_transient_insert(e: Exception, idempotent: bool) -> bool:
+    if _is_unapplied(e):
+        return True
+    if not idempotent:
+        return False
+    # May have been committed before failing; safe to repeat as an upsert
+    if isinstance(e, httpx.TransportError):
+        return True
+    code = str(getattr(e, "code", None) or "")
+    # Without a JSON body, PostgREST errors carry the HTTP status
+    return code.isdigit() and len(code) == 3 and int(code) >= 500
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    response = getattr(e, "response", None)
+    try:
+        return float(response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class IngestionExecutor:
+    """Embeds and stores the chunks of one document."""
+
+    # Cleared when vault_embeddings lacks these columns
+    metadata_column = True
+    hash_column = True
+    chunk_key = True  # chunk_start and its unique index
+
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        vault_id: str,
+        document_id: str,
+        reuse_vault_ids: Optional[List[str]] = None,
+        progress: Optional[IngestionProgress] = None,
+        model: str = EMBEDDING_MODEL,
+        concurrency: int = INGEST_EMBED_CONCURRENCY,
+        batch_tokens: int = INGEST_EMBED_BATCH_TOKENS,
+        max_inputs: int = INGEST_EMBED_BATCH_MAX_INPUTS,
+        max_retries: int = INGEST_EMBED_MAX_RETRIES,
+        retry_backoff: float = INGEST_EMBED_RETRY_BACKOFF,
+    ):
+        self.client = client
+        self.vault_id = vault_id
+        self.document_id = document_id
+        # Vaults whose stored embeddings may be reused (the uploader's)
+        self.reuse_vault_ids = reuse_vault_ids or []
+        self.progress = progress
+        self.model = model
+        self.batch_tokens = max(_MIN_BATCH_TOKENS, batch_tokens)
+        self.max_inputs = max(1, max_inputs)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._tasks: set = set()
+        self._batch: List[Chunk] = []
+        self._batch_size = 0
+        self._error: Optional[Exception] = None
+        self._started = time.monotonic()
+        self.chunks = 0
+        self.tokens = 0
+        self.requests = 0
+        self.retries = 0
+        self.splits = 0
+        self.embedded = 0
+        self.reused = 0      # taken from rows already stored
+        self.duplicates = 0  # repeated within a batch
+
+    async def add(self, chunk: Chunk) -> None:
+        """Queue a chunk; raises the first batch failure, if any."""
+        if self._error is not None:
+            raise self._error
+        tokens = chunk.tokens if chunk.tokens is not None else count_tokens_in_text(chunk.text, self.model)
+        if self._batch and (self._batch_size + tokens > self.batch_tokens or len(self._batch) >= self.max_inputs):
+            await self._dispatch()
+        self._batch.append(chunk)
+        self._batch_size += tokens
+        self.chunks += 1
+        self.tokens += tokens
+
+    async def finish(self) -> dict:
+        """Send the last batch, wait for everything in flight and report throughput."""
+        if self._batch and self._error is None:
+            await self._dispatch()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        if self._error is not None:
+            raise self._error
+        elapsed = time.monotonic() - self._started
+        return {
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "requests": self.requests,
+            "embedded": self.embedded,
+            "embeddings_reused": self.reused,
+            "duplicate_chunks": self.duplicates,
+            "embeddings_saved": self.reused + self.duplicates,
+            "retries": self.retries,
+            "splits": self.splits,
+            "seconds": round(elapsed, 3),
+            "chunks_per_second": round(self.chunks / elapsed, 1) if elapsed > 0 else None,
+        }
+
+    async def abort(self) -> None:
+        """
+        Stop sending new batches and wait for the ones in flight, so no rows
+        are written after the caller cleans up.
+        """
+        if self._error is None:
+            self._error = ValueError("Ingestion aborted.")
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    async def _dispatch(self) -> None:
+        batch, self._batch, self._batch_size = self._batch, [], 0
+        await self._slots.acquire()
+        if self._error is not None:
+            self._slots.release()
+            raise self._error
+        task = asyncio.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._slots.release()
+
+    async def _run(self, batch: List[Chunk]) -> None:
+        try:
+            await self._store(batch)
+        except Exception as e:
+            if self._error is None:
+                logger.error(f"Embedding generation failed for document {self.document_id}: {e}")
+                self._error = ValueError(f"Embedding generation failed: {e}")
+
+    async def _store(self, batch: List[Chunk]) -> None:
+        if self._error is not None:
+            return  # Another batch failed; the document is going away
+        hashes = [chunk.content_hash for chunk in batch]
+        vectors = await self._stored_embeddings(set(hashes))
+        reused = sum(h in vectors for h in hashes)
+        todo: Dict[str, Chunk] = {}
+        for h, chunk in zip(hashes, batch):
+            if h not in vectors:
+                todo.setdefault(h, chunk)
+        duplicates = len(batch) - reused - len(todo)
+        self.reused += reused
+        self.duplicates += duplicates
+        if todo:
+            vectors.update(zip(todo, await self._embed_all(list(todo.values()))))
+
+        rows = [
+            {
+                "vault_id": self.vault_id,
+                "document_id": self.document_id,
+                "content": chunk.text,
+                "embedding": vectors[h],
+                "metadata": chunk.metadata,
+                "content_hash": h,
+                "chunk_start": chunk.start,
+            }
+            for h, chunk in zip(hashes, batch)
+        ]
+        if self._error is not None:
+            return  # The document is being deleted
+        await self._retry(
+            lambda: asyncio.to_thread(self._insert, rows),
+            transient=lambda e: _is_transient_insert(e, self.idempotent_inserts()),
+        )
+        if self.progress is not None:
+            self.progress.chunks_embedded += len(batch)
+            self.progress.embeddings_saved += reused + duplicates
+
+    async def _embed_all(self, chunks: List[Chunk]) -> list:
+        try:
+            vectors = await self._retry(lambda: self._embed(chunks))
+        except BadRequestError as e:
+            if len(chunks) < 2:
+                raise
+            # Most likely over the provider's per-request token limit
+            self.splits += 1
+            self.batch_tokens = max(_MIN_BATCH_TOKENS, self.batch_tokens // 2)
+            logger.warning(f"Splitting a batch of {len(chunks)} chunks after: {e}")
+            half = len(chunks) // 2
+            return await self._embed_all(chunks[:half]) + await self._embed_all(chunks[half:])
+        self.embedded += len(chunks)
+        return vectors
+
+    async def _embed(self, batch: List[Chunk]) -> list:
+        self.requests += 1
+        resp = await self.client.embeddings.create(input=[chunk.text for chunk in batch], model=self.model)
+        if len(resp.data) != len(batch):
+            raise ValueError(f"Expected {len(batch)} embeddings, got {len(resp.data)}")
+        return [item.embedding for item in sorted(resp.data, key=lambda item: item.index)]
+
+    async def _stored_embeddings(self, hashes: set) -> dict:
+        """Embeddings already stored for these content hashes, by hash."""
+        if not (hashes and self.reuse_vault_ids and self.hash_column):
+            return {}
+        try:
+            return await asyncio.to_thread(self._fetch_embeddings, sorted(hashes))
+        except Exception as e:
+            # Only costs the saving; embed everything instead
+            if not self.check_schema_error(e) and self.hash_column:
+                logger.warning(f"Embedding reuse lookup failed: {e}")
+            return {}
+
+    def _fetch_embeddings(self, hashes: List[str]) -> dict:
+        found = {}
+        for i in range(0, len(hashes), _LOOKUP_PAGE):
+            res = (
+                supabase_admin.table('vault_embeddings')
+                .select("content_hash, embedding")
+                .in_("vault_id", self.reuse_vault_ids)
+                .in_("content_hash", hashes[i:i + _LOOKUP_PAGE])
+                .execute()
+            )
+            # pgvector values come back as text, which inserts accept as is
+            for row in res.data or []:
+                found[row["content_hash"]] = row["embedding"]
+        return found
+
+    @classmethod
+    def idempotent_inserts(cls) -> bool:
+        return cls.hash_column and cls.chunk_key
+
+    @classmethod
+    def _insert(cls, rows: List[dict]) -> None:
+        while True:
+            dropped = {
+                c for c, ok in (
+                    ("metadata", cls.metadata_column),
+                    ("content_hash", cls.hash_column),
+                    ("chunk_start", cls.chunk_key),
+                ) if not ok
+            }
+            if dropped:
+                rows = [{k: v for k, v in row.items() if k not in dropped} for row in rows]
+            table = supabase_admin.table('vault_embeddings')
+            try:
+                if cls.idempotent_inserts():
+                    table.upsert(rows, on_conflict="document_id,content_hash,chunk_start", ignore_duplicates=True).execute()
+                else:
+                    table.insert(rows).execute()
+                return
+            except Exception as e:
+                if not cls.check_schema_error(e):
+                    raise
+
+    @classmethod
+    def check_schema_error(cls, e: Exception) -> bool:
+        """
+        True if `e` means a vault_embeddings column from a migration doesn't
+        exist; it is dropped from inserts from then on and the caller should retry.
+        """
+        message = str(e)
+        if cls.chunk_key and ("chunk_start" in message or "ON CONFLICT" in message):
+            logger.warning("vault_embeddings.chunk_start or its unique index not found; run migrations/add_vault_chunk_keys.sql.")
+            cls.chunk_key = False
+            return True
+        if cls.metadata_column and "metadata" in message:
+            logger.warning("vault_embeddings.metadata not found; run migrations/add_vault_chunk_metadata.sql.")
+            cls.metadata_column = False
+            return True
+        if cls.hash_column and "content_hash" in message:
+            logger.warning("vault_embeddings.content_hash not found; run migrations/add_vault_content_hashes.sql.")
+            cls.hash_column = False
+            return True
+        return False
+
+    async def _retry(self, call: Callable[[], Awaitable], transient: Callable[[Exception], bool] = _is_transient):
+        attempt = 0
+        while True:
+            try:
+                return await call()
+            except Exception as e:
+                if attempt >= self.max_retries or not transient(e) or self._error is not None:
+                    raise
+                delay = self.retry_backoff * (2 ** attempt) * (0.5 + random.random())
+                delay = max(delay, _retry_after(e) or 0.0)
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"Retrying batch for document {self.document_id} in {delay:.2f}s ({attempt}/{self.max_retries}): {e}")
+                await asyncio.sleep(delay)
@@ -0,0 +1,286 @@
+"""
+Background ingestion jobs for vault uploads.
+
+The upload endpoint only checks the request and spools the file, then
+queues an IngestionJob and returns its id. INGEST_JOB_WORKERS workers take
+jobs off a bounded queue and run VaultService.ingest, which updates the
+job's progress (pages parsed, chunks embedded) as it goes; the status
+endpoint turns that into an ETA.
+
+A job that fails part-way has its partial document deleted, so search
+never sees it, but keeps its spooled file: retrying it processes the file
+again without another upload. Failed jobs not retried within
+INGEST_JOB_RETENTION seconds are discarded together with their file;
+finished jobs are forgotten after the same time.
+
+Jobs live in the memory of the process that accepted the upload, so with
+several server processes the status of a job is only known to one of them.
+On shutdown, running jobs are cancelled (deleting their partial documents)
+and queued ones are failed; none of them survive a restart.
+"""
+from config import INGEST_JOB_WORKERS, INGEST_JOB_QUEUE_SIZE, INGEST_JOB_RETENTION
+from services.ingestion import IngestionProgress, SpooledUpload
+from services.vault import VaultService
+from typing import Dict, List, Optional
+import asyncio
+import collections
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# How often idle workers look for expired jobs
+_PRUNE_INTERVAL = 60
+
+
+class IngestionJob:
+    """One upload being ingested into a vault."""
+
+    def __init__(self, vault_id: str, user_id: str, upload: SpooledUpload):
+        self.id = uuid.uuid4().hex
+        self.vault_id = vault_id
+        self.user_id = user_id
+        self.filename = upload.filename
+        self.upload: Optional[SpooledUpload] = upload
+        self.status = QUEUED
+        self.progress = IngestionProgress()
+        self.document: Optional[Dict] = None
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.attempts = 0
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def resumable(self) -> bool:
+        """True if the job can be retried from its spooled file."""
+        return self.status == FAILED and self.upload is not None
+
+    def fraction(self) -> Optional[float]:
+        """Estimated share of the work done: parsing, discounted by embedding backlog."""
+        if self.status == COMPLETED:
+            return 1.0
+        parsed = self.progress.fraction()
+        if parsed is None:
+            return None
+        if self.progress.chunks:
+            parsed *= self.progress.chunks_embedded / self.progress.chunks
+        return parsed
+
+    def eta(self) -> Optional[float]:
+        """Seconds left, extrapolated from progress so far."""
+        fraction = self.fraction()
+        if self.status != RUNNING or not fraction or self.started_at is None:
+            return None
+        elapsed = time.time() - self.started_at
+        return round(elapsed * (1 - fraction) / fraction, 1)
+
+    def to_dict(self) -> dict:
+        fraction = self.fraction()
+        return {
+            "job_id": self.id,
+            "vault_id": self.vault_id,
+            "filename": self.filename,
+            "status": self.status,
+            "progress": {**self.progress.to_dict(), "fraction": round(fraction, 4) if fraction is not None else None},
+            "eta_seconds": self.eta(),
+            "attempts": self.attempts,
+            "error": self.error,
+            "resumable": self.resumable,
+            "document_id": self.document["id"] if self.document else None,
+            "result": self.result,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class IngestionQueue:
+    """Bounded queue of ingestion jobs and the workers that run them."""
+
+    def __init__(
+        self,
+        workers: int = INGEST_JOB_WORKERS,
+        max_queued: int = INGEST_JOB_QUEUE_SIZE,
+        retention: float = INGEST_JOB_RETENTION,
+    ):
+        self.workers = max(1, workers)
+        self.retention = retention
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_queued))
+        self._jobs: "collections.OrderedDict[str, IngestionJob]" = collections.OrderedDict()
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.expired = 0
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """
+        Cancel running jobs, which deletes their partial documents, fail
+        queued ones and log every job that didn't complete, so nothing
+        accepted with a 202 disappears without a trace.
+        """
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            self._fail(job, "Server shut down before the upload was processed. Please upload it again.")
+        for job in self._jobs.values():
+            if job.status == FAILED:
+                logger.warning(f"Ingestion job {job.id} ({job.filename}) did not complete: {job.error}")
+            if job.upload is not None:
+                job.upload.close()
+                job.upload = None
+
+    def submit(self, vault_id: str, user_id: str, upload: SpooledUpload) -> IngestionJob:
+        """Queue an upload; raises asyncio.QueueFull when the queue is at capacity."""
+        job = IngestionJob(vault_id, user_id, upload)
+        try:
+            if self._stopping:
+                raise asyncio.QueueFull()
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise
+        self._jobs[job.id] = job
+        self.submitted += 1
+        return job
+
+    def retry(self, job: IngestionJob) -> None:
+        """Queue a failed job again; its spooled file is processed from the start."""
+        if not job.resumable:
+            raise ValueError("Only failed jobs can be retried.")
+        if self._stopping:
+            raise asyncio.QueueFull()
+        self._queue.put_nowait(job)
+        job.status = QUEUED
+        job.error = None
+        job.finished_at = None
+        self.retried += 1
+
+    def discard(self, job: IngestionJob) -> None:
+        """Forget a finished job and its spooled file."""
+        if job.status in (QUEUED, RUNNING):
+            raise ValueError("Job is still in progress.")
+        self._jobs.pop(job.id, None)
+        self._cleanup(job)
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        return self._jobs.get(job_id)
+
+    def list(self, vault_id: str) -> List[IngestionJob]:
+        return [job for job in self._jobs.values() if job.vault_id == vault_id]
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                job = await asyncio.wait_for(self._queue.get(), timeout=_PRUNE_INTERVAL)
+            except asyncio.TimeoutError:
+                self._prune()
+                continue
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+            self._prune()
+
+    async def _run(self, job: IngestionJob) -> None:
+        job.status = RUNNING
+        job.attempts += 1
+        job.started_at = time.time()
+        job.progress = IngestionProgress()
+        job.document = None
+
+        def on_document(document: Dict) -> None:
+            job.document = document
+
+        try:
+            document = await VaultService.ingest(
+                job.vault_id, job.user_id, job.upload,
+                progress=job.progress, on_document=on_document,
+            )
+        except asyncio.CancelledError:
+            self._fail(job, "Interrupted by server shutdown.")
+            raise
+        except ValueError as e:
+            self._fail(job, str(e))
+        except Exception as e:
+            logger.error(f"Ingestion job {job.id} failed: {e}")
+            self._fail(job, "Internal error during ingestion.")
+        else:
+            job.status = COMPLETED
+            job.finished_at = time.time()
+            job.result = document.pop("ingestion", None)
+            job.document = document
+            job.upload.close()
+            job.upload = None
+            self.completed += 1
+
+    def _fail(self, job: IngestionJob, error: str) -> None:
+        # VaultService.ingest has deleted the partial document
+        job.document = None
+        job.status = FAILED
+        job.error = error
+        job.finished_at = time.time()
+        self.failed += 1
+
+    @staticmethod
+    def _cleanup(job: IngestionJob) -> None:
+        if job.upload is not None:
+            job.upload.close()
+            job.upload = None
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.retention
+        expired = [
+            job for job in self._jobs.values()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]
+        for job in expired:
+            self._jobs.pop(job.id, None)
+            self.expired += 1
+            self._cleanup(job)
+
+    def stats(self) -> dict:
+        statuses = collections.Counter(job.status for job in self._jobs.values())
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "running": statuses[RUNNING],
+            "failed_resumable": sum(job.resumable for job in self._jobs.values()),
+            "tracked": len(self._jobs),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "expired": self.expired,
+        }
+
+
+_ingestion_queue = None
+
+
+def get_ingestion_queue() -> IngestionQueue:
+    """Get or create the process-wide ingestion queue."""
+    global _ingestion_queue
+    if _ingestion_queue is None:
+        _ingestion_queue = IngestionQueue()
+    return _ingestion_queue
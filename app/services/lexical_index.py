@@ -0,0 +1,391 @@
+"""
+Lexical near-duplicate tier for the semantic cache.
+
+Every cache row carries a SimHash of its prompt (semantic_cache.simhash,
+see migrations/add_cache_simhash.sql). The signatures are kept in memory
+per (user_id, model, scope), so before paying for an embedding
+find_in_cache can check how close the nearest stored prompt is by Hamming
+distance:
+
+- nothing within the neighbour radius: no lexical neighbour, the embedding
+  and vector search may be skipped (see below). Only for partitions this
+  process has loaded; prompts of a partition it has never seen, e.g.
+  cached by another gateway instance since the last refresh, go on to the
+  RPC;
+- within the near-duplicate radius: the row may be answered directly,
+  see below;
+- otherwise: the usual embedding lookup decides.
+
+Skipping on "no lexical neighbour" trades some recall (paraphrases with
+different wording) for fewer embedding calls. A sample of lookups is
+compared with the embedding tier and reported as precision/recall, and
+embeddings are only skipped once at least LEXICAL_SKIP_MIN_SAMPLES
+embedding-tier hits were sampled and the lexical recall over them is at
+least LEXICAL_SKIP_MIN_RECALL.
+
+SimHash can't tell "SKU 1234" from "SKU 9876", so near-duplicates go
+through the embedding lookup like any neighbour unless LEXICAL_NEAR_DUP_ANSWER
+is set, and even then only while the shadow-measured near-duplicate
+precision is at least LEXICAL_NEAR_DUP_MIN_PRECISION.
+
+Rows are loaded by the shared cache feed (services/cache_feed.py), together
+with the semantic index.
+"""
+from config import supabase_admin as supabase
+from services.cache_feed import get_cache_feed
+from services.cache_scope import get_cache_scope
+from config import (
+    LEXICAL_INDEX_ENABLED, LEXICAL_NEIGHBOUR_DISTANCE, LEXICAL_NEAR_DUP_DISTANCE,
+    LEXICAL_SKIP_MIN_RECALL, LEXICAL_SKIP_MIN_SAMPLES, LEXICAL_NEAR_DUP_ANSWER,
+    LEXICAL_NEAR_DUP_MIN_PRECISION, LEXICAL_NEAR_DUP_MIN_SAMPLES,
+)
+from utils.simhash import SIMHASH_BITS, simhash, to_signed, to_unsigned
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Prompts fetched per query for rows saved before the simhash column
+_PROMPT_BATCH_SIZE = 200
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    # NumPy < 2.0: count set bits a byte at a time
+    _BYTE_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        values = np.ascontiguousarray(values, dtype=np.uint64)
+        return _BYTE_BITS[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+class _Partition:
+    """Signatures and row ids for one (user_id, model, scope)."""
+
+    def __init__(self):
+        self.ids: List[Optional[str]] = []
+        self._signatures = np.empty(1024, dtype=np.uint64)
+        self._alive = np.zeros(1024, dtype=bool)
+        self._rows: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add(self, row_id: str, signature: int) -> None:
+        row = self._rows.get(row_id)
+        if row is None:
+            row = len(self.ids)
+            if row == len(self._signatures):
+                self._signatures = np.concatenate((self._signatures, np.empty(row, dtype=np.uint64)))
+                self._alive = np.concatenate((self._alive, np.zeros(row, dtype=bool)))
+            self._rows[row_id] = row
+            self.ids.append(row_id)
+        self._signatures[row] = signature
+        self._alive[row] = True
+
+    def discard(self, row_id: str) -> None:
+        row = self._rows.pop(row_id, None)
+        if row is not None:
+            self._alive[row] = False
+            self.ids[row] = None
+
+    def nearest(self, signature: int) -> Tuple[Optional[str], int]:
+        """Closest live row id and its Hamming distance."""
+        n = len(self.ids)
+        if not len(self._rows):
+            return None, SIMHASH_BITS + 1
+        distances = _popcount(self._signatures[:n] ^ np.uint64(signature))
+        if len(self._rows) < n:
+            distances = np.where(self._alive[:n], distances, SIMHASH_BITS + 1)
+        row = int(np.argmin(distances))
+        return self.ids[row], int(distances[row])
+
+
+class LexicalMatch:
+    """Outcome of a lexical lookup: the nearest row and how to treat it."""
+
+    __slots__ = ("row_id", "distance", "neighbour", "near_duplicate", "indexed")
+
+    def __init__(self, row_id: Optional[str], distance: int, neighbour: bool, near_duplicate: bool, indexed: bool = True):
+        self.row_id = row_id
+        self.distance = distance
+        self.neighbour = neighbour
+        self.near_duplicate = near_duplicate
+        # False when none of the partitions looked up is in the local index
+        self.indexed = indexed
+
+    @property
+    def skip(self) -> bool:
+        """True if the embedding lookup could be skipped (see LexicalIndex.skips_embeddings)."""
+        return self.indexed and not self.neighbour
+
+    @property
+    def similarity(self) -> float:
+        return 1.0 - self.distance / SIMHASH_BITS
+
+
+class LexicalIndex:
+    """Process-wide SimHash index over semantic_cache prompts."""
+
+    def __init__(
+        self,
+        neighbour_distance: int = LEXICAL_NEIGHBOUR_DISTANCE,
+        near_dup_distance: int = LEXICAL_NEAR_DUP_DISTANCE,
+        skip_min_recall: float = LEXICAL_SKIP_MIN_RECALL,
+        skip_min_samples: int = LEXICAL_SKIP_MIN_SAMPLES,
+        near_dup_answer: bool = LEXICAL_NEAR_DUP_ANSWER,
+        near_dup_min_precision: float = LEXICAL_NEAR_DUP_MIN_PRECISION,
+        near_dup_min_samples: int = LEXICAL_NEAR_DUP_MIN_SAMPLES,
+    ):
+        self.neighbour_distance = neighbour_distance
+        self.near_dup_distance = near_dup_distance
+        self.skip_min_recall = skip_min_recall
+        self.skip_min_samples = max(1, skip_min_samples)
+        self.near_dup_answer = near_dup_answer
+        self.near_dup_min_precision = near_dup_min_precision
+        self.near_dup_min_samples = max(1, near_dup_min_samples)
+        # Cleared when the migration hasn't been applied; signatures are then
+        # computed from the prompts at rebuild time
+        self.columns_available = True
+        self._partitions: Dict[tuple, _Partition] = {}
+        self._ready = False
+        self._rebuild_log: Optional[list] = None
+        self._staging: Optional[Dict[tuple, _Partition]] = None
+        self._rebuild_started = 0.0
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.no_neighbour = 0
+        self.near_duplicates = 0
+        self.rebuilds = 0
+        self.failed_rebuilds = 0
+        # Shadow comparison against the embedding tier
+        self.shadow_samples = 0
+        self.neighbour_confirmed = 0    # neighbour, embedding tier hit
+        self.neighbour_unconfirmed = 0  # neighbour, embedding tier miss
+        self.no_neighbour_missed = 0    # no neighbour, embedding tier hit
+        self.no_neighbour_confirmed = 0  # no neighbour, embedding tier miss
+        self.near_dup_samples = 0
+        self.near_dup_confirmed = 0
+
+    def is_ready(self) -> bool:
+        """True once a full rebuild has loaded; until then nothing is skipped."""
+        return LEXICAL_INDEX_ENABLED and self._ready
+
+    def skips_embeddings(self) -> bool:
+        """
+        True if lookups without a lexical neighbour may skip the embedding:
+        the shadow checks saw enough embedding-tier hits and the lexical
+        tier found a neighbour for enough of them.
+        """
+        embedding_hits = self.neighbour_confirmed + self.no_neighbour_missed
+        if embedding_hits < self.skip_min_samples:
+            return False
+        return self.neighbour_confirmed / embedding_hits >= self.skip_min_recall
+
+    def answers_near_duplicates(self) -> bool:
+        """
+        True if near-duplicates may be answered without an embedding: enabled,
+        and the shadow checks confirmed enough of them.
+        """
+        if not self.near_dup_answer or self.near_dup_samples < self.near_dup_min_samples:
+            return False
+        return self.near_dup_confirmed / self.near_dup_samples >= self.near_dup_min_precision
+
+    def row_fields(self, signature: int) -> dict:
+        """simhash column for a new semantic_cache row."""
+        if not self.columns_available:
+            return {}
+        return {"simhash": to_signed(signature)}
+
+    def check_schema_error(self, e: Exception) -> bool:
+        """
+        True if `e` means the simhash column doesn't exist; it is dropped
+        from inserts from then on and the caller should retry.
+        """
+        if self.columns_available and "simhash" in str(e):
+            logger.warning("semantic_cache.simhash not found; run migrations/add_cache_simhash.sql.")
+            self.columns_available = False
+            return True
+        return False
+
+    def add(self, user_id: str, model: str, scope: Optional[str], row_id: str, signature: int) -> None:
+        """Index a newly saved cache row by the simhash of its prompt."""
+        if not LEXICAL_INDEX_ENABLED:
+            return
+        self._apply("add", (user_id, model, scope), str(row_id), signature)
+
+    def discard(self, user_id: str, model: str, scope: Optional[str], row_id: str) -> None:
+        """Forget a row that no longer exists in semantic_cache."""
+        # The row may have come from the unscoped partition
+        for key in get_cache_scope().keys(user_id, model, scope):
+            self._apply("discard", key, str(row_id), None)
+
+    def _apply(self, action: str, key: tuple, row_id: str, signature: Optional[int]) -> None:
+        with self._lock:
+            if self._rebuild_log is not None:
+                self._rebuild_log.append((action, key, row_id, signature))
+            partition = self._partitions.get(key)
+            if action == "add":
+                if partition is None:
+                    partition = self._partitions[key] = _Partition()
+                partition.add(row_id, signature)
+            elif partition is not None:
+                partition.discard(row_id)
+
+    def lookup(self, user_id: str, model: str, scope: Optional[str], signature: int) -> LexicalMatch:
+        """Find the stored prompt closest to the one with `signature`."""
+        keys = get_cache_scope().keys(user_id, model, scope)
+        row_id, distance, indexed = None, SIMHASH_BITS + 1, False
+        for key in keys:
+            partition = self._partitions.get(key)
+            if partition is not None:
+                indexed = True
+                found, found_distance = partition.nearest(signature)
+                if found_distance < distance:
+                    row_id, distance = found, found_distance
+        match = LexicalMatch(
+            row_id, distance,
+            neighbour=distance <= self.neighbour_distance,
+            near_duplicate=distance <= self.near_dup_distance,
+            indexed=indexed,
+        )
+        self.lookups += 1
+        self.no_neighbour += match.skip and self.skips_embeddings()
+        self.near_duplicates += match.near_duplicate
+        return match
+
+    def record_shadow(self, match: LexicalMatch, embedding_row_id: Optional[str]) -> None:
+        """Compare a lexical decision with what the embedding tier found."""
+        if not match.indexed:
+            return  # Nothing was decided lexically
+        hit = embedding_row_id is not None
+        self.shadow_samples += 1
+        if match.neighbour:
+            if hit:
+                self.neighbour_confirmed += 1
+            else:
+                self.neighbour_unconfirmed += 1
+        elif hit:
+            self.no_neighbour_missed += 1
+        else:
+            self.no_neighbour_confirmed += 1
+        if match.near_duplicate:
+            self.near_dup_samples += 1
+            self.near_dup_confirmed += hit
+
+    # ---- Cache feed ----
+
+    def start(self) -> None:
+        """Load rows through the cache feed."""
+        if LEXICAL_INDEX_ENABLED:
+            get_cache_feed().subscribe(self)
+
+    def columns(self) -> List[str]:
+        return ["simhash"] if self.columns_available else ["prompt"]
+
+    def begin_rebuild(self) -> None:
+        with self._lock:
+            self._rebuild_log = []
+        self._staging = {}
+        self._rebuild_started = time.monotonic()
+
+    def stage(self, rows: List[dict]) -> None:
+        for row, signature in self._signed(rows):
+            key = (row["user_id"], row["model"], row.get("scope"))
+            partition = self._staging.get(key)
+            if partition is None:
+                partition = self._staging[key] = _Partition()
+            partition.add(str(row["id"]), signature)
+
+    def abort_rebuild(self) -> None:
+        with self._lock:
+            self._rebuild_log = None
+        self._staging = None
+        self.failed_rebuilds += 1
+
+    def finish_rebuild(self) -> None:
+        partitions, self._staging = self._staging, None
+        with self._lock:
+            for action, key, row_id, signature in self._rebuild_log:
+                partition = partitions.get(key)
+                if action == "add":
+                    if partition is None:
+                        partition = partitions[key] = _Partition()
+                    partition.add(row_id, signature)
+                elif partition is not None:
+                    partition.discard(row_id)
+            self._rebuild_log = None
+            self._partitions = partitions
+            self._ready = True
+
+        self.rebuilds += 1
+        logger.info(
+            f"Lexical index rebuilt: {sum(len(p) for p in partitions.values())} rows in "
+            f"{len(partitions)} partitions ({time.monotonic() - self._rebuild_started:.1f}s)"
+        )
+
+    def apply(self, rows: List[dict]) -> None:
+        """Add rows created since the last pass, e.g. by other gateway instances."""
+        if not self._ready:
+            return
+        for row, signature in self._signed(rows):
+            self._apply("add", (row["user_id"], row["model"], row.get("scope")), str(row["id"]), signature)
+
+    def _signed(self, rows: List[dict]):
+        """(row, signature) pairs, hashing the prompts of rows saved before the simhash column."""
+        unsigned = []
+        for row in rows:
+            if row.get("simhash") is not None:
+                yield row, to_unsigned(int(row["simhash"]))
+            elif "prompt" in row:
+                yield row, simhash(row.get("prompt") or "")
+            else:
+                unsigned.append(row)
+        for start in range(0, len(unsigned), _PROMPT_BATCH_SIZE):
+            batch = unsigned[start:start + _PROMPT_BATCH_SIZE]
+            res = supabase.table('semantic_cache').select("id, prompt").in_("id", [row["id"] for row in batch]).execute()
+            prompts = {str(r["id"]): r.get("prompt") or "" for r in res.data or []}
+            for row in batch:
+                if str(row["id"]) in prompts:
+                    yield row, simhash(prompts[str(row["id"])])
+
+    def stats(self) -> dict:
+        neighbours = self.neighbour_confirmed + self.neighbour_unconfirmed
+        embedding_hits = self.neighbour_confirmed + self.no_neighbour_missed
+        return {
+            "enabled": LEXICAL_INDEX_ENABLED,
+            "ready": self._ready,
+            "columns_available": self.columns_available,
+            "entries": sum(len(p) for p in list(self._partitions.values())),
+            "lookups": self.lookups,
+            "embeddings_skipped": self.no_neighbour,
+            "skipping": self.skips_embeddings(),
+            "near_duplicates": self.near_duplicates,
+            "rebuilds": self.rebuilds,
+            "failed_rebuilds": self.failed_rebuilds,
+            "shadow": {
+                "samples": self.shadow_samples,
+                # Share of lexical neighbours the embedding tier also matched
+                "precision": round(self.neighbour_confirmed / neighbours, 4) if neighbours else None,
+                # Share of embedding-tier hits that had a lexical neighbour
+                # (the rest would be lost by skipping)
+                "recall": round(self.neighbour_confirmed / embedding_hits, 4) if embedding_hits else None,
+                "near_dup_samples": self.near_dup_samples,
+                "near_dup_precision": round(self.near_dup_confirmed / self.near_dup_samples, 4) if self.near_dup_samples else None,
+            },
+            "near_dup_answers": self.answers_near_duplicates(),
+        }
+
+
+_lexical_index = None
+
+
+def get_lexical_index() -> LexicalIndex:
+    """Get or create the process-wide lexical index."""
+    global _lexical_index
+    if _lexical_index is None:
+        _lexical_index = LexicalIndex()
+    return _lexical_index
@@ -1,5 +1,6 @@
 from providers.base_client import BaseLLMClient
-from auth.check_key import fetch_api_keys, fetch_all_providers_with_keys, get_provider_by_name
+from auth.check_key import fetch_api_keys, get_provider_by_name
+from services.routing import get_routing_table, invalidate_routing, DEFAULT_BASE_URL
 import os
 import logging
 
@@ -20,6 +21,30 @@ def extract_provider_name(model: str) -> str:
 def get_provider(model: str, user_id: str, provider_id: str = None):
     """
     Get provider client for a given model and user.
+    Resolves from the cached routing snapshot; only falls back to the
+    database when the provider is not in the snapshot.
+    """
+    table = get_routing_table(user_id)
+    if provider_id:
+        route = table.by_id.get(provider_id)
+    else:
+        route = table.resolve(extract_provider_name(model))
+
+    if route is None or not route.keys:
+        # Not in the snapshot, or a provider without keys: the uncached
+        # lookup picks up keys added since and raises the precise error
+        return _get_provider_uncached(model, user_id, provider_id)
+
+    base_url = route.base_url or DEFAULT_BASE_URL
+    logger.debug(f"Using Generic Client for {route.name} with URL: {base_url}")
+    return BaseLLMClient(api_keys=route.keys, base_url=base_url)
+
+
+def _get_provider_uncached(model: str, user_id: str, provider_id: str = None):
+    """
+    Resolve provider and keys directly from the database.
+    Used when the routing snapshot has no match (e.g. a key added since the
+    snapshot was built), and to produce precise error messages.
     """
     provider_name = None
     provider_record = None
@@ -48,9 +73,12 @@ def get_provider(model: str, user_id: str, provider_id: str = None):
     keys = fetch_api_keys(user_id, provider_id=provider_id)
     if not keys:
         raise ValueError(f"No API keys found for provider: {provider_name or provider_id}")
+
+    # Snapshot is out of date - rebuild it on the next request
+    invalidate_routing(user_id)
     
     # 3. Determine Client Strategy - Always use Generic Client
-    base_url = keys[0].get('base_url') or "https://api.openai.com/v1"
+    base_url = keys[0].get('base_url') or DEFAULT_BASE_URL
     
     logger.debug(f"Using Generic Client for {provider_name} with URL: {base_url}")
     return BaseLLMClient(api_keys=keys, base_url=base_url)
@@ -60,20 +88,14 @@ def get_all_providers(user_id: str) -> dict:
     """
     Get all available providers with their clients for a user.
     """
-    providers_dict = fetch_all_providers_with_keys(user_id)
+    table = get_routing_table(user_id)
     provider_clients = {}
     
-    for provider_id, keys in providers_dict.items():
-        base_url = None
-        if keys:
-             base_url = keys[0].get('base_url') # We flattened it in fetch_all
-        
-        if not base_url:
-             # Try to guess or default
-             base_url = "https://api.openai.com/v1"
+    for provider_id, route in table.by_id.items():
+        base_url = route.base_url or DEFAULT_BASE_URL
             
         try:
-            provider_clients[provider_id] = BaseLLMClient(api_keys=keys, base_url=base_url)
+            provider_clients[provider_id] = BaseLLMClient(api_keys=route.keys, base_url=base_url)
         except Exception as e:
             logger.warning(f"Failed to create client for provider {provider_id}: {e}")
     
@@ -0,0 +1,146 @@
+"""
+Per-user routing snapshot: provider name -> base URL and active keys.
+
+Built from the user's active keys (with their providers) and the user's own
+providers, and cached, so a request resolves its provider without the
+`providers` / `api_keys` lookups. A user-defined provider shadows a global
+one of the same name even while it has no keys, as the uncached lookup does.
+A snapshot is only cached when both queries succeeded.
+"""
+from auth.check_key import fetch_all_providers_with_keys, fetch_user_providers
+from config import ROUTING_CACHE_TTL, ROUTING_CACHE_MAX_USERS
+from utils.ttl_cache import TTLCache
+from typing import Dict, List, Optional
+import hashlib
+import json
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://api.openai.com/v1"
+
+# Key fields the proxy actually needs; everything else stays in the DB.
+KEY_FIELDS = ("id", "name", "encrypted_key", "base_url")
+
+
+class ProviderRoute:
+    """A provider together with the user's active keys for it."""
+
+    __slots__ = ("id", "name", "base_url", "is_user_scoped", "keys")
+
+    def __init__(self, provider_id: str, name: str, base_url: Optional[str], is_user_scoped: bool):
+        self.id = provider_id
+        self.name = name
+        self.base_url = base_url
+        self.is_user_scoped = is_user_scoped
+        self.keys: List[dict] = []
+
+
+class RoutingTable:
+    """Immutable snapshot of a user's providers and keys."""
+
+    def __init__(self, user_id: str, providers_with_keys: dict, user_providers: Optional[List[dict]] = None):
+        self.user_id = user_id
+        self.built_at = time.time()
+        # Routes with keys
+        self.by_id: Dict[str, ProviderRoute] = {}
+        # What each provider name resolves to; may be a route without keys
+        self.by_name: Dict[str, ProviderRoute] = {}
+
+        for provider_id, keys in providers_with_keys.items():
+            if not keys:
+                continue
+            provider = keys[0].get("providers") or {}
+            route = ProviderRoute(
+                provider_id=provider_id,
+                name=provider.get("name") or "",
+                base_url=provider.get("base_url"),
+                is_user_scoped=provider.get("user_id") == user_id,
+            )
+            route.keys = [{field: key.get(field) for field in KEY_FIELDS} for key in keys]
+            self.by_id[provider_id] = route
+            self._add_name(route)
+
+        for provider in user_providers or []:
+            if provider["id"] not in self.by_id:
+                self._add_name(ProviderRoute(provider["id"], provider.get("name") or "", provider.get("base_url"), True))
+
+        self.version = self._fingerprint()
+
+    def _add_name(self, route: ProviderRoute) -> None:
+        # User-specific providers shadow global ones with the same name
+        existing = self.by_name.get(route.name)
+        if existing is None or (route.is_user_scoped and not existing.is_user_scoped):
+            self.by_name[route.name] = route
+
+    def _fingerprint(self) -> str:
+        """
+        Hash of everything routing depends on. `updated_at` is not usable here
+        because usage counters bump it on every flush.
+        """
+        routes = {route.id: route for route in (*self.by_id.values(), *self.by_name.values())}
+        state = sorted(
+            (route.id, route.name, route.base_url or "", [sorted(k.items()) for k in route.keys])
+            for route in routes.values()
+        )
+        return hashlib.sha256(json.dumps(state, default=str).encode()).hexdigest()[:16]
+
+    def resolve(self, provider_name: str) -> Optional[ProviderRoute]:
+        """The provider a name routes to; its `keys` may be empty."""
+        return self.by_name.get(provider_name)
+
+
+_routing_cache = TTLCache(maxsize=ROUTING_CACHE_MAX_USERS, ttl=ROUTING_CACHE_TTL)
+# Last snapshot per user, kept past the TTL so refreshes can compare versions
+_last_tables = TTLCache(maxsize=ROUTING_CACHE_MAX_USERS, ttl=ROUTING_CACHE_TTL * 10)
+_refresh_stats = {"builds": 0, "unchanged": 0, "changed": 0, "failed": 0}
+
+
+def get_routing_table(user_id: str) -> RoutingTable:
+    """Return the cached routing snapshot for a user, rebuilding it when stale."""
+    table = _routing_cache.get(user_id)
+    if table is not None:
+        return table
+
+    try:
+        fresh = RoutingTable(
+            user_id,
+            fetch_all_providers_with_keys(user_id, raise_errors=True),
+            fetch_user_providers(user_id),
+        )
+    except Exception as e:
+        # Not cached, so the next request tries again. Until then the last
+        # snapshot (or an empty one, i.e. the uncached lookups) is used.
+        _refresh_stats["failed"] += 1
+        logger.error(f"Error building routing table for {user_id}: {e}")
+        previous = _last_tables.get(user_id)
+        return previous if previous is not None else RoutingTable(user_id, {})
+    _refresh_stats["builds"] += 1
+
+    previous = _last_tables.get(user_id)
+    if previous is not None and previous.version == fresh.version:
+        # Nothing relevant changed - keep the existing snapshot object
+        _refresh_stats["unchanged"] += 1
+        fresh = previous
+    elif previous is not None:
+        _refresh_stats["changed"] += 1
+        logger.debug(f"Routing table for {user_id} changed: {previous.version} -> {fresh.version}")
+
+    _routing_cache.set(user_id, fresh)
+    _last_tables.set(user_id, fresh)
+    return fresh
+
+
+def invalidate_routing(user_id: Optional[str] = None) -> None:
+    """Force a rebuild on the next request, e.g. after keys were added or revoked."""
+    if user_id is None:
+        _routing_cache.clear()
+        _last_tables.clear()
+    else:
+        _routing_cache.pop(user_id)
+        _last_tables.pop(user_id)
+
+
+def get_routing_stats() -> dict:
+    return {**_routing_cache.stats(), **_refresh_stats}
@@ -0,0 +1,582 @@
+"""
+In-process approximate nearest neighbour index for the semantic cache.
+
+Embeddings are kept in NumPy arrays partitioned by (user_id, model, scope),
+so a semantic lookup is a local matrix product instead of a pgvector query per
+request. Small partitions are searched exhaustively. Large ones are split
+into IVF lists (spherical k-means) and only the lists closest to the query
+are probed; rows added since the last training are scanned exhaustively
+until the partition grows enough to be retrained.
+
+Rows are loaded by the shared cache feed (services/cache_feed.py): in full
+at startup and now and then, and incrementally every
+CACHE_INDEX_REFRESH_INTERVAL seconds. save_to_cache adds this process's
+rows right away. The index is snapshotted to .npy files that are
+memory-mapped on the next start, so a restarted gateway can serve hits
+before the first rebuild finishes.
+
+Memory is bounded by SEMANTIC_INDEX_MAX_ENTRIES rows in total and
+SEMANTIC_INDEX_MAX_PARTITION_ENTRIES per partition. Rows that don't fit are
+left out and their partition is marked incomplete. A miss is final for
+partitions that were fully loaded; for incomplete ones, and until the first
+rebuild, find_in_cache confirms it with the match_semantic_cache RPC.
+Rows other gateway instances saved since the last refresh are not seen
+until the next one.
+"""
+from services.cache_feed import get_cache_feed
+from services.cache_scope import get_cache_scope
+from config import (
+    SEMANTIC_INDEX_ENABLED, SEMANTIC_INDEX_DIR, SEMANTIC_INDEX_IVF_MIN_ENTRIES,
+    SEMANTIC_INDEX_NPROBE, SEMANTIC_INDEX_MAX_ENTRIES, SEMANTIC_INDEX_MAX_PARTITION_ENTRIES,
+)
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_TRAIN_POINTS_PER_LIST = 32
+_TRAIN_ITERATIONS = 10
+_ASSIGN_CHUNK = 8192
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _parse_embedding(value) -> np.ndarray:
+    # pgvector columns come back from PostgREST as "[0.1,0.2,...]" strings
+    if isinstance(value, str):
+        value = json.loads(value)
+    return _normalize(value)
+
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Closest centroid for every row, computed in chunks to bound memory."""
+    out = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _ASSIGN_CHUNK):
+        block = np.asarray(vectors[start:start + _ASSIGN_CHUNK])
+        out[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+class _Partition:
+    """Vectors and row ids for one (user_id, model, scope)."""
+
+    def __init__(self, dim: int, vectors: Optional[np.ndarray] = None, ids: Optional[List[Optional[str]]] = None):
+        self.dim = dim
+        self.ids: List[Optional[str]] = list(ids or [])
+        # May be a read-only memmap after loading a snapshot; copied into
+        # memory on the first write
+        self._vectors = vectors if vectors is not None else np.empty((0, dim), dtype=np.float32)
+        self._rows: Dict[str, int] = {row_id: i for i, row_id in enumerate(self.ids) if row_id is not None}
+        # (centroids, order, offsets, trained_rows), swapped as one unit
+        self._ivf: Optional[tuple] = None
+        # False when rows were left out to stay within the size limits
+        self.complete = True
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, row_id: str) -> bool:
+        return row_id in self._rows
+
+    def _writable(self, capacity: int) -> np.ndarray:
+        vectors = self._vectors
+        if not vectors.flags.writeable or len(vectors) < capacity:
+            grown = np.empty((max(capacity, len(vectors) * 2, 1024), self.dim), dtype=np.float32)
+            grown[:len(self.ids)] = vectors[:len(self.ids)]
+            self._vectors = vectors = grown
+        return vectors
+
+    def add(self, row_id: str, vector: np.ndarray) -> bool:
+        """Add or update a row; True if it took a new slot."""
+        with self._lock:
+            row = self._rows.get(row_id)
+            if row is not None:
+                self._writable(len(self.ids))[row] = vector
+                return False
+            # Write the vector before publishing the row, so readers that see
+            # the new length also see its data
+            self._writable(len(self.ids) + 1)[len(self.ids)] = vector
+            self._rows[row_id] = len(self.ids)
+            self.ids.append(row_id)
+            return True
+
+    def discard(self, row_id: str) -> None:
+        with self._lock:
+            row = self._rows.pop(row_id, None)
+            if row is not None:
+                # A zero vector scores 0 against everything, below any threshold
+                self._writable(len(self.ids))[row] = 0
+                self.ids[row] = None
+
+    def needs_training(self, min_entries: int) -> bool:
+        if len(self.ids) < min_entries:
+            return False
+        return self._ivf is None or len(self.ids) >= 2 * self._ivf[3]
+
+    def train(self, seed: int = 0) -> None:
+        """Build IVF lists over the current rows (runs in a worker thread)."""
+        n = len(self.ids)
+        vectors = self._vectors[:n]
+        nlist = max(1, int(4 * np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+
+        sample = np.asarray(vectors[np.sort(rng.choice(n, min(n, nlist * _TRAIN_POINTS_PER_LIST), replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(_TRAIN_ITERATIONS):
+            labels = _assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            filled = norms[:, 0] > 0  # empty lists keep their old centroid
+            centroids[filled] = sums[filled] / norms[filled]
+
+        labels = _assign(vectors, centroids)
+        order = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=nlist)))).astype(np.int64)
+        self._ivf = (centroids, order, offsets, n)
+
+    def search(self, query: np.ndarray, nprobe: int) -> Tuple[Optional[str], float]:
+        """Best row id and its cosine similarity."""
+        n = len(self.ids)  # read before the vectors, see add()
+        vectors = self._vectors
+        ivf = self._ivf
+        best_row, best_score = -1, -np.inf
+
+        scan_from = 0
+        if ivf is not None:
+            centroids, order, offsets, scan_from = ivf
+            if nprobe < len(centroids):
+                probe = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+            else:
+                probe = np.arange(len(centroids))
+            candidates = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+            if candidates.size:
+                scores = vectors[candidates] @ query
+                i = int(np.argmax(scores))
+                best_row, best_score = int(candidates[i]), float(scores[i])
+
+        if n > scan_from:
+            scores = vectors[scan_from:n] @ query
+            i = int(np.argmax(scores))
+            if scores[i] > best_score:
+                best_row, best_score = scan_from + i, float(scores[i])
+
+        if best_row < 0:
+            return None, 0.0
+        return self.ids[best_row], best_score
+
+    def save(self, path: str) -> None:
+        n = len(self.ids)
+        np.save(os.path.join(path, "vectors.npy"), np.asarray(self._vectors[:n]))
+        with open(os.path.join(path, "ids.json"), "w") as f:
+            json.dump(self.ids[:n], f)
+        ivf = self._ivf
+        if ivf is not None:
+            centroids, order, offsets, trained_rows = ivf
+            np.save(os.path.join(path, "centroids.npy"), centroids)
+            np.save(os.path.join(path, "order.npy"), order)
+            np.save(os.path.join(path, "offsets.npy"), offsets)
+            with open(os.path.join(path, "trained_rows"), "w") as f:
+                f.write(str(trained_rows))
+
+    @classmethod
+    def load(cls, path: str) -> "_Partition":
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        with open(os.path.join(path, "ids.json")) as f:
+            ids = json.load(f)
+        partition = cls(vectors.shape[1], vectors, ids)
+        if os.path.exists(os.path.join(path, "trained_rows")):
+            with open(os.path.join(path, "trained_rows")) as f:
+                trained_rows = int(f.read())
+            partition._ivf = (
+                np.load(os.path.join(path, "centroids.npy")),
+                np.load(os.path.join(path, "order.npy"), mmap_mode="r"),
+                np.load(os.path.join(path, "offsets.npy")),
+                trained_rows,
+            )
+        return partition
+
+
+class _Contents:
+    """Partitions plus the bookkeeping for the size limits."""
+
+    def __init__(self, partitions: Optional[Dict[tuple, _Partition]] = None):
+        self.partitions: Dict[tuple, _Partition] = partitions or {}
+        # Slots held; discarded rows keep theirs until the next rebuild
+        self.entries = sum(len(p.ids) for p in self.partitions.values())
+        # Set once a whole partition was left out, after which a partition
+        # that isn't here may still have rows
+        self.truncated = False
+
+
+class SemanticIndex:
+    """Process-wide ANN index over semantic_cache embeddings."""
+
+    def __init__(
+        self,
+        path: str = SEMANTIC_INDEX_DIR,
+        ivf_min_entries: int = SEMANTIC_INDEX_IVF_MIN_ENTRIES,
+        nprobe: int = SEMANTIC_INDEX_NPROBE,
+        max_entries: int = SEMANTIC_INDEX_MAX_ENTRIES,
+        max_partition_entries: int = SEMANTIC_INDEX_MAX_PARTITION_ENTRIES,
+    ):
+        self.path = path
+        self.ivf_min_entries = ivf_min_entries
+        self.nprobe = nprobe
+        self.max_entries = max_entries
+        self.max_partition_entries = max_partition_entries
+        self._contents = _Contents()
+        self._ready = False
+        # True once a full rebuild has loaded; a snapshot alone may be missing
+        # rows saved since it was written
+        self._synced = False
+        self._task: Optional[asyncio.Task] = None
+        self._training: set = set()
+        # Rows saved while a rebuild is running, replayed onto the new
+        # partitions once it finishes
+        self._rebuild_log: Optional[list] = None
+        self._staging: Optional[_Contents] = None
+        self._rebuild_started = 0.0
+        self._lock = threading.Lock()
+        self.searches = 0
+        self.matches = 0
+        self.skipped = 0
+        self.search_seconds = 0.0
+        self.rebuilds = 0
+        self.last_rebuild_seconds = 0.0
+
+    @property
+    def _partitions(self) -> Dict[tuple, _Partition]:
+        return self._contents.partitions
+
+    def is_ready(self) -> bool:
+        """True once a snapshot or a full rebuild has been loaded."""
+        return self._ready
+
+    def settles_miss(self, user_id: str, model: str, scope: Optional[str]) -> bool:
+        """
+        True if a local miss is final: every partition the lookup covers was
+        fully loaded (or has no rows) as of the last refresh. Otherwise the
+        caller asks the RPC.
+        """
+        if not self._synced:
+            return False
+        contents = self._contents
+        for key in get_cache_scope().keys(user_id, model, scope):
+            partition = contents.partitions.get(key)
+            if partition is None:
+                if contents.truncated:
+                    return False
+            elif not partition.complete:
+                return False
+        return True
+
+    def _place(self, contents: _Contents, key: tuple, row_id: str, vector: np.ndarray) -> None:
+        """Add a row to `contents` unless that breaks the size limits."""
+        partition = contents.partitions.get(key)
+        if partition is None:
+            if contents.entries >= self.max_entries:
+                contents.truncated = True
+                self.skipped += 1
+                return
+            partition = contents.partitions[key] = _Partition(len(vector))
+        if len(vector) != partition.dim:
+            logger.warning(f"Embedding dimension changed for model {key[1]}; not indexing row {row_id}")
+            return
+        if row_id not in partition and (
+            len(partition.ids) >= self.max_partition_entries or contents.entries >= self.max_entries
+        ):
+            partition.complete = False
+            self.skipped += 1
+            return
+        contents.entries += partition.add(row_id, vector)
+
+    def _fits(self, contents: _Contents, key: tuple) -> bool:
+        """False if a new row for `key` would certainly be left out (checked before parsing it)."""
+        partition = contents.partitions.get(key)
+        if partition is None:
+            if contents.entries < self.max_entries:
+                return True
+            contents.truncated = True
+        elif len(partition.ids) < self.max_partition_entries and contents.entries < self.max_entries:
+            return True
+        else:
+            partition.complete = False
+        self.skipped += 1
+        return False
+
+    def add(self, user_id: str, model: str, scope: Optional[str], row_id: str, embedding) -> None:
+        """Index a newly saved cache row."""
+        if not SEMANTIC_INDEX_ENABLED:
+            return
+        vector = _normalize(embedding)
+        row_id = str(row_id)
+        key = (user_id, model, scope)
+        with self._lock:
+            if self._rebuild_log is not None:
+                self._rebuild_log.append(("add", key, row_id, vector))
+            self._place(self._contents, key, row_id, vector)
+            partition = self._partitions.get(key)
+        if partition is not None and partition.needs_training(self.ivf_min_entries):
+            self._schedule_training(key, partition)
+
+    def discard(self, user_id: str, model: str, scope: Optional[str], row_id: str) -> None:
+        """Forget a row that no longer exists in semantic_cache."""
+        row_id = str(row_id)
+        # The row may have come from the unscoped partition
+        for key in get_cache_scope().keys(user_id, model, scope):
+            with self._lock:
+                if self._rebuild_log is not None:
+                    self._rebuild_log.append(("discard", key, row_id, None))
+                partition = self._partitions.get(key)
+            if partition is not None:
+                partition.discard(row_id)
+
+    def search(self, user_id: str, model: str, scope: Optional[str], embedding, threshold: float) -> Optional[Tuple[str, float]]:
+        """Return (row_id, similarity) of the closest row at or above threshold."""
+        partitions = [
+            p for p in map(self._partitions.get, get_cache_scope().keys(user_id, model, scope))
+            if p is not None and len(p)
+        ]
+        if not partitions:
+            return None
+        query = _normalize(embedding)
+
+        started = time.perf_counter()
+        row_id, similarity = None, 0.0
+        for partition in partitions:
+            if len(query) != partition.dim:
+                continue
+            found, score = partition.search(query, self.nprobe)
+            if found is not None and (row_id is None or score > similarity):
+                row_id, similarity = found, score
+        self.search_seconds += time.perf_counter() - started
+        self.searches += 1
+        if row_id is None or similarity < threshold:
+            return None
+        self.matches += 1
+        return row_id, similarity
+
+    def _schedule_training(self, key: tuple, partition: _Partition) -> None:
+        if key in self._training:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._training.add(key)
+
+        async def train():
+            try:
+                await asyncio.to_thread(partition.train)
+            except Exception as e:
+                logger.error(f"Semantic index training failed: {e}")
+            finally:
+                self._training.discard(key)
+
+        loop.create_task(train())
+
+    def start(self) -> None:
+        """Load the snapshot and subscribe to the cache feed, which loads the rows."""
+        if SEMANTIC_INDEX_ENABLED and self._task is None:
+            get_cache_feed().subscribe(self)
+            self._task = asyncio.create_task(asyncio.to_thread(self._load_snapshot))
+
+    async def stop(self) -> None:
+        """Write a snapshot."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            if self._ready:
+                await asyncio.to_thread(self.persist)
+
+    # ---- Cache feed ----
+
+    @staticmethod
+    def columns() -> List[str]:
+        return ["embedding"]
+
+    @staticmethod
+    def check_schema_error(e: Exception) -> bool:
+        return False
+
+    def begin_rebuild(self) -> None:
+        with self._lock:
+            self._rebuild_log = []
+        # The old partitions keep serving until the swap, so peak memory is
+        # up to twice the limits
+        self._staging = _Contents()
+        self._rebuild_started = time.monotonic()
+
+    def stage(self, rows: List[dict]) -> None:
+        for row in rows:
+            if not row.get("embedding"):
+                continue
+            key = (row["user_id"], row["model"], row.get("scope"))
+            # Don't parse what can't be kept
+            if self._fits(self._staging, key):
+                self._place(self._staging, key, str(row["id"]), _parse_embedding(row["embedding"]))
+
+    def abort_rebuild(self) -> None:
+        with self._lock:
+            self._rebuild_log = None
+        self._staging = None
+
+    def finish_rebuild(self) -> None:
+        contents, self._staging = self._staging, None
+        for partition in contents.partitions.values():
+            if partition.needs_training(self.ivf_min_entries):
+                partition.train()
+
+        with self._lock:
+            for action, key, row_id, vector in self._rebuild_log:
+                if action == "add":
+                    self._place(contents, key, row_id, vector)
+                elif key in contents.partitions:
+                    contents.partitions[key].discard(row_id)
+            self._rebuild_log = None
+            self._contents = contents
+            self._ready = self._synced = True
+
+        self.rebuilds += 1
+        self.last_rebuild_seconds = time.monotonic() - self._rebuild_started
+        incomplete = sum(1 for p in contents.partitions.values() if not p.complete)
+        logger.info(
+            f"Semantic index rebuilt: {sum(len(p) for p in contents.partitions.values())} rows in "
+            f"{len(contents.partitions)} partitions, {incomplete} incomplete ({self.last_rebuild_seconds:.1f}s)"
+        )
+        try:
+            self.persist()
+        except Exception as e:
+            logger.error(f"Failed to write semantic index snapshot: {e}")
+
+    def apply(self, rows: List[dict]) -> None:
+        """Add rows created since the last pass, e.g. by other gateway instances."""
+        if not self._ready:
+            return
+        touched = set()
+        for row in rows:
+            if not row.get("embedding"):
+                continue
+            key = (row["user_id"], row["model"], row.get("scope"))
+            row_id = str(row["id"])
+            with self._lock:
+                partition = self._partitions.get(key)
+                if partition is not None and row_id in partition:
+                    continue  # Saved by this process
+                if not self._fits(self._contents, key):
+                    continue
+            vector = _parse_embedding(row["embedding"])
+            with self._lock:
+                self._place(self._contents, key, row_id, vector)
+            touched.add(key)
+        for key in touched:
+            partition = self._partitions.get(key)
+            if partition is not None and key not in self._training and partition.needs_training(self.ivf_min_entries):
+                partition.train()
+
+    # ---- Snapshots ----
+
+    @staticmethod
+    def _partition_dir(key: tuple) -> str:
+        return hashlib.sha256(json.dumps(list(key)).encode()).hexdigest()[:32]
+
+    def persist(self) -> None:
+        """Snapshot every partition to disk (atomically replaces the old one)."""
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        contents = self._contents
+        partitions = []
+        for key, partition in list(contents.partitions.items()):
+            name = self._partition_dir(key)
+            os.makedirs(os.path.join(tmp, name))
+            partition.save(os.path.join(tmp, name))
+            partitions.append({"user_id": key[0], "model": key[1], "scope": key[2], "dir": name, "complete": partition.complete})
+        with open(os.path.join(tmp, "manifest.json"), "w") as f:
+            json.dump({"truncated": contents.truncated, "partitions": partitions}, f)
+
+        old = self.path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.rename(self.path, old)
+        os.rename(tmp, self.path)
+        # Loaded memmaps keep their (unlinked) files alive until released
+        shutil.rmtree(old, ignore_errors=True)
+
+    def _load_snapshot(self) -> None:
+        manifest_path = os.path.join(self.path, "manifest.json") if self.path else ""
+        if not manifest_path or not os.path.exists(manifest_path):
+            return
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if isinstance(manifest, list):  # Written before truncation was tracked
+                manifest = {"truncated": False, "partitions": manifest}
+            partitions = {}
+            for entry in manifest["partitions"]:
+                partition = _Partition.load(os.path.join(self.path, entry["dir"]))
+                partition.complete = entry.get("complete", True)
+                partitions[(entry["user_id"], entry["model"], entry.get("scope"))] = partition
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable semantic index snapshot: {e}")
+            return
+        contents = _Contents(partitions)
+        contents.truncated = manifest.get("truncated", False)
+        with self._lock:
+            if self._ready:
+                return  # A rebuild already finished
+            self._contents = contents
+            self._ready = True
+        logger.info(f"Loaded semantic index snapshot with {len(partitions)} partitions")
+
+    def stats(self) -> dict:
+        contents = self._contents
+        partitions = list(contents.partitions.values())
+        return {
+            "enabled": SEMANTIC_INDEX_ENABLED,
+            "ready": self._ready,
+            "synced": self._synced,
+            "partitions": len(partitions),
+            "entries": sum(len(p) for p in partitions),
+            "ivf_partitions": sum(1 for p in partitions if p._ivf is not None),
+            "incomplete_partitions": sum(1 for p in partitions if not p.complete),
+            "truncated": contents.truncated,
+            "max_entries": self.max_entries,
+            "skipped": self.skipped,
+            "searches": self.searches,
+            "matches": self.matches,
+            "avg_search_ms": round(self.search_seconds / self.searches * 1000, 3) if self.searches else 0.0,
+            "rebuilds": self.rebuilds,
+            "last_rebuild_seconds": round(self.last_rebuild_seconds, 2),
+        }
+
+
+_semantic_index = None
+
+
+def get_semantic_index() -> SemanticIndex:
+    """Get or create the process-wide semantic index."""
+    global _semantic_index
+    if _semantic_index is None:
+        _semantic_index = SemanticIndex()
+    return _semantic_index
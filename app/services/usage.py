@@ -0,0 +1,143 @@
+"""
+Batched API key usage counters.
+
+Requests only bump in-memory counters; a background task flushes the
+aggregated deltas to Supabase in one bulk RPC every few seconds.
+"""
+from config import supabase_admin as supabase
+from config import USAGE_FLUSH_INTERVAL, USAGE_MAX_PENDING_KEYS
+from auth.check_key import increment_usage_count, increment_rate_limit_count
+from utils.postgrest import is_missing_function
+from collections import defaultdict
+from typing import Dict, Optional
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UsageCounter:
+    """In-memory aggregator for per-key usage and rate limit counts."""
+
+    def __init__(self, flush_interval: float = USAGE_FLUSH_INTERVAL, max_pending_keys: int = USAGE_MAX_PENDING_KEYS):
+        self.flush_interval = flush_interval
+        self.max_pending_keys = max_pending_keys
+        self._usage: Dict[str, int] = defaultdict(int)
+        self._rate_limits: Dict[str, int] = defaultdict(int)
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._bulk_rpc_available = True
+        self.flushes = 0
+        self.flushed_increments = 0
+        self.dropped_increments = 0
+        self.failed_flushes = 0
+
+    def record_usage(self, api_key_id: str) -> None:
+        """Count one successful request for a key."""
+        self._record(self._usage, api_key_id)
+
+    def record_rate_limit(self, api_key_id: str) -> None:
+        """Count one rate-limited request for a key."""
+        self._record(self._rate_limits, api_key_id)
+
+    def _record(self, counts: Dict[str, int], api_key_id: str) -> None:
+        if api_key_id not in counts and self._pending_keys() >= self.max_pending_keys:
+            # Bounded: flush early instead of growing without limit
+            if self._wakeup is not None:
+                self._wakeup.set()
+            if self._pending_keys() >= self.max_pending_keys * 2:
+                self.dropped_increments += 1
+                return
+        counts[api_key_id] += 1
+
+    def _pending_keys(self) -> int:
+        return len(self._usage) + len(self._rate_limits)
+
+    def start(self) -> None:
+        """Start the periodic flusher. Must be called from the event loop."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flusher and write out whatever is still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Send all pending deltas in a single round trip."""
+        if not self._usage and not self._rate_limits:
+            return
+
+        usage, self._usage = self._usage, defaultdict(int)
+        rate_limits, self._rate_limits = self._rate_limits, defaultdict(int)
+        deltas = [
+            {"key_id": key_id, "usage": usage.get(key_id, 0), "rate_limited": rate_limits.get(key_id, 0)}
+            for key_id in set(usage) | set(rate_limits)
+        ]
+
+        try:
+            await asyncio.to_thread(self._write, deltas)
+            self.flushes += 1
+            self.flushed_increments += sum(usage.values()) + sum(rate_limits.values())
+        except Exception as e:
+            self.failed_flushes += 1
+            logger.error(f"Failed to flush usage counters: {e}")
+            # Put the deltas back so the next flush retries them
+            for key_id, count in usage.items():
+                self._usage[key_id] += count
+            for key_id, count in rate_limits.items():
+                self._rate_limits[key_id] += count
+
+    def _write(self, deltas: list) -> None:
+        if self._bulk_rpc_available:
+            try:
+                supabase.rpc('increment_api_key_usage_bulk', {'deltas': deltas}).execute()
+                return
+            except Exception as e:
+                if not is_missing_function(e):
+                    raise
+                logger.warning("RPC increment_api_key_usage_bulk not found; falling back to per-key RPCs.")
+                self._bulk_rpc_available = False
+
+        for delta in deltas:
+            for _ in range(delta["usage"]):
+                increment_usage_count(delta["key_id"])
+            for _ in range(delta["rate_limited"]):
+                increment_rate_limit_count(delta["key_id"])
+
+    def stats(self) -> dict:
+        return {
+            "pending_keys": self._pending_keys(),
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "flushed_increments": self.flushed_increments,
+            "dropped_increments": self.dropped_increments,
+            "bulk_rpc": self._bulk_rpc_available,
+        }
+
+
+_usage_counter = None
+
+
+def get_usage_counter() -> UsageCounter:
+    """Get or create the process-wide usage counter."""
+    global _usage_counter
+    if _usage_counter is None:
+        _usage_counter = UsageCounter()
+    return _usage_counter
@@ -1,41 +1,30 @@
 import logging
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
 import uuid
 from supabase import Client
 from openai import AsyncOpenAI
-import pypdf
-import docx
 from fastapi import UploadFile
-import io
 
 from config import supabase_admin
-from auth.check_key import fetch_api_keys, get_provider_by_name
+from services.embeddings import get_embedding_client, get_embedding_service
+from providers.client_pool import get_client_pool
+from services.chunker import get_chunker
+from services.ingestion import IngestionProgress, SpooledUpload, spool_upload, iter_document_text
+from services.ingestion_executor import IngestionExecutor
+from utils.postgrest import is_missing_function
 
 logger = logging.getLogger(__name__)
 
 class VaultService:
+    # Cleared when vault_documents has no content_hash column
+    document_hash_column = True
+
     @staticmethod
     async def get_embedding_client(user_id: str) -> AsyncOpenAI:
         """
         Get OpenAI or OpenRouter client for embeddings.
         """
-        # 1. Try OpenAI first
-        provider = get_provider_by_name("openai", user_id)
-        if provider:
-            keys = fetch_api_keys(user_id, provider_id=provider['id'])
-            if keys:
-                return AsyncOpenAI(api_key=keys[0].get('encrypted_key'))
-        
-        # 2. Try OpenRouter as fallback
-        provider = get_provider_by_name("openrouter", user_id)
-        if provider:
-            keys = fetch_api_keys(user_id, provider_id=provider['id'])
-            if keys:
-                # OpenRouter requires base_url
-                base_url = "https://openrouter.ai/api/v1"
-                return AsyncOpenAI(api_key=keys[0].get('encrypted_key'), base_url=base_url)
-
-        raise ValueError("No API keys found for OpenAI or OpenRouter. Please configure one of them to use Knowledge Vault.")
+        return get_embedding_client(user_id)
 
     @staticmethod
     async def create_vault(user_id: str, name: str, description: str = None) -> Dict:
@@ -63,55 +52,113 @@ class VaultService:
         res = supabase_admin.table('vaults').delete().eq("id", vault_id).eq("user_id", user_id).execute()
         return res.data
 
+    @staticmethod
+    async def prepare_upload(vault_id: str, user_id: str, file: UploadFile) -> SpooledUpload:
+        """
+        Check access and the user's embedding provider, then spool the upload
+        to disk. Problems with the request surface here, before ingestion.
+        """
+        # Check if vault belongs to user (Security)
+        # Using admin client, so we must verify manually
+        v_check = supabase_admin.table('vaults').select("id").eq("id", vault_id).eq("user_id", user_id).execute()
+        if not v_check.data:
+            raise ValueError("Vault not found or access denied.")
+
+        # Resolved before anything is written, so there is nothing to clean up
+        await VaultService.get_embedding_client(user_id)
+
+        return await spool_upload(file)
+
     @staticmethod
     async def upload_document(
         vault_id: str, 
         user_id: str, 
         file: UploadFile
     ) -> Dict:
-        content = ""
-        filename = file.filename
-        
-        # Read file into memory
-        file_bytes = await file.read()
-        file_stream = io.BytesIO(file_bytes)
-        
-        if filename.lower().endswith(".pdf"):
-            try:
-                reader = pypdf.PdfReader(file_stream)
-                for page in reader.pages:
-                    text = page.extract_text()
-                    if text:
-                        content += text + "\n"
-            except Exception as e:
-                logger.error(f"Error parsing PDF {filename}: {e}")
-                raise ValueError(f"Failed to parse PDF: {e}")
-                
-        elif filename.lower().endswith(".docx"):
-            try:
-                doc = docx.Document(file_stream)
-                for para in doc.paragraphs:
-                    content += para.text + "\n"
-            except Exception as e:
-                logger.error(f"Error parsing DOCX {filename}: {e}")
-                raise ValueError(f"Failed to parse DOCX: {e}")
-        else:
-            # Assume plain text
-            try:
-                content = file_bytes.decode("utf-8")
-            except UnicodeDecodeError:
-                 raise ValueError("File content must be UTF-8 text.")
-        
-        if not content.strip():
-             raise ValueError("Extracted text is empty.")
+        """
+        Parse, chunk and embed an upload in one go. The HTTP API queues
+        uploads instead (services/ingestion_jobs.py).
+        """
+        upload = await VaultService.prepare_upload(vault_id, user_id, file)
+        try:
+            return await VaultService.ingest(vault_id, user_id, upload)
+        finally:
+            upload.close()
 
-        # Check if vault belongs to user (Security)
-        # Using admin client, so we must verify manually
-        v_check = supabase_admin.table('vaults').select("id").eq("id", vault_id).eq("user_id", user_id).execute()
-        if not v_check.data:
-            raise ValueError("Vault not found or access denied.")
+    @staticmethod
+    async def ingest(
+        vault_id: str,
+        user_id: str,
+        upload: SpooledUpload,
+        progress: Optional[IngestionProgress] = None,
+        on_document: Optional[Callable[[Dict], None]] = None,
+    ) -> Dict:
+        """
+        Parse, chunk and embed a spooled upload. The file is parsed off the
+        event loop; chunks are embedded concurrently as pages come in (see
+        services/ingestion_executor.py).
+
+        A file already in the vault (same SHA-256) is not processed again:
+        the existing document is returned. The result carries an "ingestion"
+        report including how many embeddings were reused instead of computed.
+
+        On failure, cancellation included, the document is deleted so search
+        never sees a partially indexed one. `on_document` is called when the
+        row is created.
+        """
+        filename = upload.filename
+        progress = progress or IngestionProgress()
+        # Held for the whole upload, so evicting it from the pool can't close it
+        client = get_client_pool().retain(await VaultService.get_embedding_client(user_id))
+        document = None
+        executor = None
+        try:
+            existing = VaultService._find_document(vault_id, upload.sha256)
+            if existing is not None:
+                count = VaultService._count_chunks(existing['id'])
+                logger.info(f"{filename} is already in vault {vault_id} as document {existing['id']}")
+                return {**existing, "ingestion": {"duplicate_of": existing['id'], "chunks": count, "embeddings_saved": count}}
+
+            reuse_vault_ids = VaultService._vault_ids(user_id)
+            async for chunk in get_chunker().chunks(iter_document_text(upload, progress)):
+                if not chunk.text.strip():
+                    continue  # Blank stretches carry nothing to retrieve
+                progress.chunks += 1
+                if executor is None:
+                    # The document row is only created once there is text to store
+                    document = VaultService._create_document(vault_id, filename)
+                    if on_document is not None:
+                        on_document(document)
+                    executor = IngestionExecutor(client, vault_id, document['id'], reuse_vault_ids, progress=progress)
+                await executor.add(chunk)
 
-        # Store Document Metadata
+            if executor is None:
+                raise ValueError("Extracted text is empty.")
+            report = await executor.finish()
+            # Only complete documents are matched by hash
+            VaultService._set_document_hash(document['id'], upload.sha256)
+            logger.info(f"Indexed {filename} into vault {vault_id}: {report}")
+            return {**document, "content_hash": upload.sha256, "ingestion": report}
+        except BaseException:
+            if executor is not None:
+                await executor.abort()
+            # Fail hard so search never sees a partially indexed document
+            if document is not None:
+                VaultService._delete_document(document['id'])
+            raise
+        finally:
+            get_client_pool().release(client)
+
+    @staticmethod
+    def _delete_document(document_id: str) -> None:
+        try:
+            supabase_admin.table('vault_documents').delete().eq("id", document_id).execute()
+        except Exception as e:
+            # Don't mask the error that got us here
+            logger.error(f"Failed to delete partial document {document_id}: {e}")
+
+    @staticmethod
+    def _create_document(vault_id: str, filename: str) -> Dict:
         doc_res = supabase_admin.table('vault_documents').insert({
             "vault_id": vault_id,
             "filename": filename,
@@ -119,82 +166,70 @@ class VaultService:
         }).execute()
         if not doc_res.data:
              raise ValueError("Failed to create document record.")
-             
-        document_id = doc_res.data[0]['id']
-        
-        # Chunking strategy: Simple character split with overlap
-        # Ideal: RecursiveCharacterTextSplitter from langchain, but avoiding extra heavy deps for now.
-        chunk_size = 1000
-        overlap = 200
-        chunks = []
-        start = 0
-        while start < len(content):
-            end = start + chunk_size
-            chunk_text = content[start:end]
-            chunks.append(chunk_text)
-            start = end - overlap
-            if start < 0: start = 0 # should not happen
-        
-        # Unique chunks only to save cost/space? No, contexts might differ.
-        if not chunks:
-             # Content was small
-             chunks = [content]
+        return doc_res.data[0]
 
-        # Generate Embeddings & Store
+    @staticmethod
+    def _set_document_hash(document_id: str, content_hash: str) -> None:
+        if not VaultService.document_hash_column:
+            return
         try:
-            client = await VaultService.get_embedding_client(user_id)
-        except ValueError as e:
-            # Clean up document entry if embedding fails
-            supabase_admin.table('vault_documents').delete().eq("id", document_id).execute()
-            raise e
-            
-        # Batch processing
-        batch_size = 20 # OpenAI limits are high but safe batching is good
-        total_chunks = len(chunks)
-        
-        for i in range(0, total_chunks, batch_size):
-            batch = chunks[i : i + batch_size]
-            try:
-                resp = await client.embeddings.create(input=batch, model="text-embedding-3-small")
-                
-                rows = []
-                for j, emb_data in enumerate(resp.data):
-                    rows.append({
-                        "vault_id": vault_id,
-                        "document_id": document_id,
-                        "content": batch[j],
-                        "embedding": emb_data.embedding
-                    })
-                
-                supabase_admin.table('vault_embeddings').insert(rows).execute()
-            except Exception as e:
-                logger.error(f"Embedding generation failed for batch {i}: {e}")
-                # continue or fail? If one batch fails, the search might be incomplete.
-                # Better to fail and cleanup? Or partial?
-                # For now, let's fail hard to ensure consistency
-                supabase_admin.table('vault_documents').delete().eq("id", document_id).execute()
-                raise ValueError(f"Embedding generation failed: {e}")
-            
-        return doc_res.data[0]
+            supabase_admin.table('vault_documents').update({"content_hash": content_hash}).eq("id", document_id).execute()
+        except Exception as e:
+            if not VaultService._check_schema_error(e):
+                raise
+
+    @staticmethod
+    def _find_document(vault_id: str, content_hash: str) -> Optional[Dict]:
+        """A completely indexed document in the vault with exactly this content, if any."""
+        if not VaultService.document_hash_column:
+            return None
+        try:
+            res = supabase_admin.table('vault_documents').select("*").eq("vault_id", vault_id).eq("content_hash", content_hash).limit(1).execute()
+        except Exception as e:
+            if not VaultService._check_schema_error(e):
+                raise
+            return None
+        return res.data[0] if res.data else None
+
+    @staticmethod
+    def _count_chunks(document_id: str) -> Optional[int]:
+        try:
+            return supabase_admin.table('vault_embeddings').select("id", count="exact", head=True).eq("document_id", document_id).execute().count
+        except Exception as e:
+            logger.warning(f"Could not count chunks of document {document_id}: {e}")
+            return None
+
+    @staticmethod
+    def _vault_ids(user_id: str) -> List[str]:
+        """The user's vaults, whose stored embeddings an upload may reuse."""
+        res = supabase_admin.table('vaults').select("id").eq("user_id", user_id).execute()
+        return [row['id'] for row in res.data or []]
+
+    @staticmethod
+    def _check_schema_error(e: Exception) -> bool:
+        """
+        True if `e` means vault_documents.content_hash doesn't exist; uploads
+        are no longer matched by hash and the caller should retry.
+        """
+        if VaultService.document_hash_column and "content_hash" in str(e):
+            logger.warning("vault_documents.content_hash not found; run migrations/add_vault_content_hashes.sql.")
+            VaultService.document_hash_column = False
+            return True
+        return False
 
     @staticmethod
     async def retrieve_context(vault_id: str, user_id: str, query: str, limit: int = 5) -> List[str]:
-        # 1. Get client
+        # 1. Embed query (memoized, repeated queries skip the provider)
         try:
-            client = await VaultService.get_embedding_client(user_id)
+            query_embedding = await get_embedding_service().embed(user_id, query)
         except ValueError:
             logger.warning("Skipping retrieval: OpenAI provider unavailable.")
             return []
-
-        # 2. Embed query
-        try:
-            resp = await client.embeddings.create(input=query, model="text-embedding-3-small")
-            query_embedding = resp.data[0].embedding
         except Exception as e:
             logger.error(f"Query embedding failed: {e}")
             return []
         
-        # 3. Search via RPC
+        # 2. Search via RPC
         try:
              res = supabase_admin.rpc(
                  'match_vault_embeddings',
@@ -211,7 +246,7 @@ class VaultService:
              
         except Exception as e:
             # Check if it is "function not found" error
-            if "function" in str(e) and "does not exist" in str(e):
+            if is_missing_function(e):
                 logger.error("RPC match_vault_embeddings not found in database. Search disabled.")
             else:
                 logger.error(f"Vector search failed: {e}")
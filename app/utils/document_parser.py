@@ -0,0 +1,34 @@
+"""
+Text extraction for vault uploads.
+
+These functions run in the ingestion process pool (services/ingestion.py),
+so they take a path to the spooled upload rather than file objects and
+return plain lists of strings.
+"""
+from typing import List
+import docx
+import pypdf
+
+
+def pdf_page_count(path: str) -> int:
+    return len(pypdf.PdfReader(path).pages)
+
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    """Text of pages [start, stop); pages without text come back empty."""
+    reader = pypdf.PdfReader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def extract_docx_blocks(path: str, block_chars: int) -> List[str]:
+    """Paragraph text, one paragraph per line, grouped into blocks of about block_chars."""
+    blocks, lines, size = [], [], 0
+    for para in docx.Document(path).paragraphs:
+        lines.append(para.text + "\n")
+        size += len(para.text) + 1
+        if size >= block_chars:
+            blocks.append("".join(lines))
+            lines, size = [], 0
+    if lines:
+        blocks.append("".join(lines))
+    return blocks
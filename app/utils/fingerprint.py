@@ -0,0 +1,157 @@
+"""
+Canonical request fingerprint shared by the response cache, request logs
+and in-flight deduplication.
+
+Messages are hashed field by field instead of being dumped to one JSON
+string, so long conversations are never materialized twice. Line endings
+and trailing whitespace are normalized, so prompts that differ only in
+those or in str vs. [text part] content map to the same key; indentation
+is kept, since it matters in code. Tool call ids are random per provider
+response, so calls and results are matched up by position instead. The
+generation parameters that change the output are hashed in as well.
+
+Fingerprints must be taken before RAG context is injected: the retrieved
+text is a function of (vault_id, query), and vault_id is part of the key.
+
+`scope` hashes just the parameters (temperature, reasoning effort, vault,
+tools, tool choice) and is stored in semantic_cache.scope. The semantic
+cache only compares prompts within one scope, since the same question
+asked against another vault or with other tools must not be answered from
+the cache.
+"""
+from typing import Any, List, Optional
+from models.chat import Message
+import hashlib
+import json
+
+# Embedding input is the tail of the conversation, capped well below the
+# embedding model's context window
+EMBED_TEXT_MAX_CHARS = 24000
+
+_FIELD = b"\x1f"
+_RECORD = b"\x1e"
+
+
+def normalize_text(text: str) -> str:
+    """Unify line endings, drop trailing whitespace and surrounding blank lines."""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip("\n")
+
+
+def _dump_model(value: Any) -> Any:
+    # Pydantic models anywhere in the value, e.g. the Tool objects in `tools`
+    if hasattr(value, "model_dump"):
+        return value.model_dump(exclude_none=True)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _canonical_json(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=_dump_model)
+
+
+def _canonical_arguments(arguments: str) -> str:
+    # Tool call arguments are JSON strings; key order and spacing don't matter
+    try:
+        return _canonical_json(json.loads(arguments))
+    except (TypeError, ValueError):
+        return normalize_text(arguments)
+
+
+def _message_text(message: Message) -> str:
+    content = message.content
+    if isinstance(content, str):
+        return normalize_text(content)
+    parts = []
+    for item in content or []:
+        if isinstance(item, str):
+            parts.append(item)
+        elif getattr(item, "type", None) == "text":
+            parts.append(item.text)
+    return normalize_text(" ".join(parts))
+
+
+class RequestFingerprint:
+    """
+    `key` is a hex sha256 over the canonical request. `text` is the
+    normalized conversation used as the semantic-cache embedding input,
+    and `scope` a short hash of the parameters it must be compared under.
+    """
+
+    __slots__ = ("key", "text", "scope")
+
+    def __init__(self, key: str, text: str, scope: str = ""):
+        self.key = key
+        self.text = text
+        self.scope = scope
+
+    def __repr__(self) -> str:
+        return f"RequestFingerprint({self.key[:12]}...)"
+
+
+def fingerprint_request(
+    model: str,
+    messages: List[Message],
+    temperature: Optional[float] = None,
+    tools: Optional[list] = None,
+    tool_choice: Any = None,
+    reasoning_effort: Optional[str] = None,
+    vault_id: Optional[str] = None,
+) -> RequestFingerprint:
+    digest = hashlib.sha256()
+
+    def field(value: str) -> None:
+        digest.update(value.encode("utf-8", "surrogatepass"))
+        digest.update(_FIELD)
+
+    params = [
+        "" if temperature is None else repr(float(temperature)),
+        reasoning_effort or "",
+        vault_id or "",
+        _canonical_json(tools) if tools else "",
+        _canonical_json(tool_choice) if tool_choice is not None else "",
+    ]
+    scope = hashlib.sha256()
+    field(model)
+    for value in params:
+        field(value)
+        scope.update(value.encode("utf-8", "surrogatepass"))
+        scope.update(_FIELD)
+    digest.update(_RECORD)
+
+    lines = []
+    call_numbers = {}  # tool call id -> position in the conversation
+
+    def call_number(call_id: Optional[str]) -> str:
+        if not call_id:
+            return ""
+        return str(call_numbers.setdefault(call_id, len(call_numbers)))
+
+    for message in messages:
+        role = message.role.lower()
+        text = _message_text(message)
+        field(role)
+        field(text)
+        if isinstance(message.content, list):
+            # Images change the answer; their text placeholder doesn't
+            for item in message.content:
+                if getattr(item, "type", None) == "image_url":
+                    field(item.image_url.url)
+        for tool_call in message.tool_calls or []:
+            field(call_number(tool_call.id))
+            field(tool_call.function.name)
+            field(_canonical_arguments(tool_call.function.arguments))
+        field(call_number(message.tool_call_id))
+        digest.update(_RECORD)
+        lines.append(f"{role}: {text}")
+
+    # Keep the most recent turns when the conversation is long
+    text_parts, size = [], 0
+    for line in reversed(lines):
+        if size + len(line) > EMBED_TEXT_MAX_CHARS:
+            if not text_parts:
+                text_parts.append(line[-EMBED_TEXT_MAX_CHARS:])
+            break
+        text_parts.append(line)
+        size += len(line) + 1
+
+    return RequestFingerprint(digest.hexdigest(), "\n".join(reversed(text_parts)), scope.hexdigest()[:16])
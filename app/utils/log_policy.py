@@ -0,0 +1,212 @@
+"""
+Payload policy for request_logs.
+
+Decides how much of each request/response payload is stored: sampling by
+user and status class, per-field size caps, hashing of message bodies and
+optional compression of large payloads.
+"""
+from config import (
+    LOG_PAYLOAD_SAMPLE_RATE, LOG_PAYLOAD_ERROR_SAMPLE_RATE, LOG_PAYLOAD_STATUS_SAMPLE_RATES,
+    LOG_PAYLOAD_USER_SAMPLE_RATES,
+    LOG_PAYLOAD_MAX_FIELD_CHARS, LOG_PAYLOAD_HASH_MESSAGES, LOG_PAYLOAD_COMPRESS_MIN_BYTES
+)
+from typing import Any, Dict, Optional, Union
+import base64
+import hashlib
+import json
+import logging
+import random
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Serialized size of a compressed payload besides its data
+_COMPRESSED_OVERHEAD = len('{"encoding":"zlib+base64","data":""}')
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, default=str, separators=(",", ":"), ensure_ascii=False)
+
+
+def _size(raw: str) -> int:
+    """Stored size in bytes, not characters."""
+    return len(raw.encode())
+
+
+def _status_rate(rates: Dict[str, float], status: int) -> Optional[float]:
+    """Rate for an exact code ("429") or its class ("4xx"), if configured."""
+    rate = rates.get(str(status))
+    if rate is None:
+        rate = rates.get(f"{status // 100}xx")
+    return rate
+
+
+class LogPayloadPolicy:
+    """Shrinks log payloads before they are queued for insertion."""
+
+    def __init__(
+        self,
+        sample_rate: float = LOG_PAYLOAD_SAMPLE_RATE,
+        error_sample_rate: float = LOG_PAYLOAD_ERROR_SAMPLE_RATE,
+        status_sample_rates: Optional[Dict[str, float]] = None,
+        user_sample_rates: Optional[Dict[str, Union[float, Dict[str, float]]]] = None,
+        max_field_chars: int = LOG_PAYLOAD_MAX_FIELD_CHARS,
+        hash_messages: bool = LOG_PAYLOAD_HASH_MESSAGES,
+        compress_min_bytes: int = LOG_PAYLOAD_COMPRESS_MIN_BYTES,
+    ):
+        self.sample_rate = sample_rate
+        self.error_sample_rate = error_sample_rate
+        self.status_sample_rates = status_sample_rates if status_sample_rates is not None else LOG_PAYLOAD_STATUS_SAMPLE_RATES
+        self.user_sample_rates = user_sample_rates if user_sample_rates is not None else LOG_PAYLOAD_USER_SAMPLE_RATES
+        self.max_field_chars = max_field_chars
+        self.hash_messages = hash_messages
+        self.compress_min_bytes = compress_min_bytes
+        self.payloads = 0
+        self.sampled_out = 0
+        self.truncated_fields = 0
+        self.hashed_messages = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def sample_rate_for(self, user_id: str, status: int) -> float:
+        """
+        Most specific configured rate: the user's (one rate for every status,
+        or keyed by code/class), then the status code/class, then the
+        error or success default.
+        """
+        user_rate = self.user_sample_rates.get(user_id)
+        if isinstance(user_rate, dict):
+            user_rate = _status_rate(user_rate, status)
+        if user_rate is not None:
+            return user_rate
+        rate = _status_rate(self.status_sample_rates, status)
+        if rate is not None:
+            return rate
+        return self.error_sample_rate if status >= 400 else self.sample_rate
+
+    def should_store(self, user_id: str, status: int) -> bool:
+        """Sample payload storage. Token counts and metadata are always logged."""
+        rate = self.sample_rate_for(user_id, status)
+        return rate >= 1.0 or random.random() < rate
+
+    def apply(self, payload: Optional[dict], user_id: str, status: int, store: Optional[bool] = None) -> dict:
+        """
+        Return a slimmed copy of `payload`; the original is left untouched.
+        `store` is the sampling decision; pass the same one for the request
+        and response payloads of a row so they are kept or dropped together.
+        """
+        if not payload:
+            return payload or {}
+        if store is None:
+            store = self.should_store(user_id, status)
+
+        self.payloads += 1
+        raw = _dumps(payload)
+        size = _size(raw)
+        self.bytes_in += size
+
+        if not store:
+            self.sampled_out += 1
+            result = {"sampled_out": True, "bytes": size}
+            self.bytes_out += _size(_dumps(result))
+            return result
+
+        result = dict(payload)
+        hashed = {}
+        truncated = self.truncated_fields
+        if self.hash_messages:
+            for field in ("messages", "input"):
+                if field in result:
+                    hashed[field] = self._hash_messages(result.pop(field))
+        if self.max_field_chars:
+            result = self._truncate(result)
+            hashed = self._truncate(hashed)  # tool call arguments etc.
+        result.update(hashed)
+        if hashed or self.truncated_fields != truncated:
+            raw = _dumps(result)
+            size = _size(raw)
+        # Otherwise the payload is stored as is and `raw` still describes it
+        if self.compress_min_bytes and size >= self.compress_min_bytes:
+            result = self._compress(raw)
+            # base64 is ASCII, so characters are bytes here
+            self.bytes_out += len(result["data"]) + _COMPRESSED_OVERHEAD
+        else:
+            self.bytes_out += size
+        return result
+
+    def _hash_messages(self, messages: Any) -> Any:
+        """Replace message bodies with a digest, keeping roles and structure."""
+        if isinstance(messages, str):
+            return self._digest(messages)
+        if not isinstance(messages, list):
+            return messages
+
+        hashed = []
+        for message in messages:
+            if isinstance(message, dict) and isinstance(message.get("content"), (str, list)):
+                message = dict(message)
+                content = message["content"]
+                if isinstance(content, str):
+                    message["content"] = self._digest(content)
+                else:
+                    message["content"] = [
+                        {**part, "text": self._digest(part["text"])}
+                        if isinstance(part, dict) and isinstance(part.get("text"), str) else part
+                        for part in content
+                    ]
+            hashed.append(message)
+        return hashed
+
+    def _digest(self, text: str) -> dict:
+        self.hashed_messages += 1
+        return {"sha256": hashlib.sha256(text.encode()).hexdigest(), "chars": len(text)}
+
+    def _truncate(self, value: Any) -> Any:
+        if isinstance(value, str):
+            if len(value) > self.max_field_chars:
+                self.truncated_fields += 1
+                return value[:self.max_field_chars] + f"...[truncated {len(value) - self.max_field_chars} chars]"
+            return value
+        if isinstance(value, dict):
+            return {k: self._truncate(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._truncate(v) for v in value]
+        return value
+
+    def _compress(self, raw: str) -> dict:
+        self.compressed += 1
+        return {
+            "encoding": "zlib+base64",
+            "data": base64.b64encode(zlib.compress(raw.encode(), 6)).decode("ascii"),
+        }
+
+    def stats(self) -> dict:
+        return {
+            "payloads": self.payloads,
+            "sampled_out": self.sampled_out,
+            "truncated_fields": self.truncated_fields,
+            "hashed_messages": self.hashed_messages,
+            "compressed": self.compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+        }
+
+
+def decompress_payload(payload: dict) -> dict:
+    """Inverse of compression, for tooling that reads request_logs."""
+    if isinstance(payload, dict) and payload.get("encoding") == "zlib+base64":
+        return json.loads(zlib.decompress(base64.b64decode(payload["data"])))
+    return payload
+
+
+_payload_policy = None
+
+
+def get_payload_policy() -> LogPayloadPolicy:
+    """Get or create the process-wide log payload policy."""
+    global _payload_policy
+    if _payload_policy is None:
+        _payload_policy = LogPayloadPolicy()
+    return _payload_policy
@@ -0,0 +1,16 @@
+"""
+Classification of errors raised by PostgREST (supabase-py) calls.
+"""
+
+
+def is_missing_function(e: Exception) -> bool:
+    """
+    True if `e` means the RPC doesn't exist, i.e. its migration hasn't been
+    applied. PostgREST reports an unknown function as PGRST202 ("Could not
+    find the function ... in the schema cache"); Postgres itself says
+    "function ... does not exist".
+    """
+    message = str(e)
+    if getattr(e, "code", None) == "PGRST202" or "Could not find the function" in message:
+        return True
+    return "function" in message and "does not exist" in message
@@ -0,0 +1,47 @@
+"""
+64-bit SimHash signatures of prompt text.
+
+Word unigrams and bigrams of the lowercased text are hashed and summed bit
+by bit, weighted by frequency; prompts that share most of their wording end
+up a few bits apart, unrelated prompts about 32 bits apart.
+"""
+from collections import Counter
+import hashlib
+import re
+import numpy as np
+
+SIMHASH_BITS = 64
+
+_WORD = re.compile(r"\w+")
+
+
+def _features(text: str) -> Counter:
+    words = _WORD.findall(text.lower())
+    features = Counter(words)
+    features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    return features
+
+
+def simhash(text: str) -> int:
+    """Unsigned 64-bit signature of `text` (0 for text without words)."""
+    features = _features(text)
+    if not features:
+        return 0
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(f.encode(), digest_size=8).digest(), "little") for f in features),
+        dtype=np.uint64, count=len(features),
+    )
+    weights = np.fromiter(features.values(), dtype=np.int64, count=len(features))
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    totals = weights @ (2 * bits.astype(np.int64) - 1)
+    packed = np.packbits(totals > 0, bitorder="little")
+    return int.from_bytes(packed.tobytes(), "little")
+
+
+def to_signed(signature: int) -> int:
+    """Map an unsigned signature onto Postgres BIGINT range."""
+    return signature - (1 << 64) if signature >= 1 << 63 else signature
+
+
+def to_unsigned(value: int) -> int:
+    return value & 0xFFFFFFFFFFFFFFFF
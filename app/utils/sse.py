@@ -0,0 +1,159 @@
+"""
+Server-sent event encoding for the streaming endpoints.
+
+Upstream chunks are turned into plain dicts and encoded straight to bytes,
+skipping the pydantic round trip, and empty keep-alive deltas are dropped
+before any serialization happens.
+
+Streaming cache hits are replayed from the cached chat.completion payload:
+content, tool calls, finish reason and usage are re-encoded as a handful of
+frames and sent as a few byte batches, or paced to mimic generation.
+"""
+from config import CACHE_REPLAY_MODE, CACHE_REPLAY_CHUNK_CHARS, CACHE_REPLAY_CHARS_PER_SECOND
+from typing import Any, AsyncIterator, List, Optional
+import asyncio
+import time
+import uuid
+
+try:
+    import orjson
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:  # pragma: no cover - orjson is optional
+    import json
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+DONE_EVENT = b"data: [DONE]\n\n"
+
+
+def encode_event(obj: Any) -> bytes:
+    """Encode one SSE `data:` frame."""
+    return b"data: " + dumps(obj) + b"\n\n"
+
+
+def is_empty_delta(chunk: Any) -> bool:
+    """
+    True for upstream chunks that carry nothing for the client: no usage and
+    a first choice without content, tool calls or finish reason.
+    """
+    if getattr(chunk, "usage", None):
+        return False
+    if not chunk.choices:
+        return False
+    choice = chunk.choices[0]
+    delta = choice.delta
+    return not (delta.content or delta.tool_calls or choice.finish_reason)
+
+
+def chunk_to_dict(chunk: Any, model: str) -> dict:
+    """Build the client-facing chat.completion.chunk payload for an upstream chunk."""
+    choices = []
+    for c in chunk.choices:
+        delta = {}
+        if c.delta.content is not None:
+            delta["content"] = c.delta.content
+        if c.delta.role is not None:
+            delta["role"] = c.delta.role
+        if c.delta.tool_calls:
+            delta["tool_calls"] = [tc.model_dump(exclude_none=True) for tc in c.delta.tool_calls]
+
+        choice = {"index": c.index, "delta": delta}
+        if c.finish_reason is not None:
+            choice["finish_reason"] = c.finish_reason
+        choices.append(choice)
+
+    data = {
+        "id": chunk.id or str(uuid.uuid4()),
+        "object": "chat.completion.chunk",
+        "created": chunk.created or int(time.time()),
+        "model": model,
+        "choices": choices,
+    }
+    usage = getattr(chunk, "usage", None)
+    if usage:
+        data["usage"] = {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.total_tokens,
+        }
+    if chunk.system_fingerprint:
+        data["system_fingerprint"] = chunk.system_fingerprint
+    return data
+
+
+def encode_chunk(chunk: Any, model: str) -> Optional[bytes]:
+    """Encode an upstream chunk as an SSE frame, or None if it should be dropped."""
+    if is_empty_delta(chunk):
+        return None
+    return encode_event(chunk_to_dict(chunk, model))
+
+
+# Upper bound for one write when replaying in burst mode
+REPLAY_BATCH_BYTES = 64 * 1024
+
+
+def cached_response_frames(response: dict, chunk_chars: int = CACHE_REPLAY_CHUNK_CHARS) -> List[bytes]:
+    """
+    Encode a cached chat.completion payload as the SSE frames of an
+    equivalent stream (without the final [DONE]).
+    """
+    base = {
+        "id": response.get("id") or f"chatcmpl-{uuid.uuid4()}",
+        "object": "chat.completion.chunk",
+        "created": response.get("created") or int(time.time()),
+        "model": response.get("model"),
+    }
+
+    def frame(delta: dict, finish_reason: Optional[str] = None) -> bytes:
+        choice = {"index": 0, "delta": delta}
+        if finish_reason is not None:
+            choice["finish_reason"] = finish_reason
+        return encode_event({**base, "choices": [choice]})
+
+    choices = response.get("choices") or [{}]
+    message = choices[0].get("message") or {}
+    content = message.get("content")
+    tool_calls = message.get("tool_calls") or []
+
+    frames = [frame({"role": "assistant", "content": ""})]
+    if isinstance(content, str):
+        step = max(1, chunk_chars)
+        for i in range(0, len(content), step):
+            frames.append(frame({"content": content[i:i + step]}))
+    if tool_calls:
+        frames.append(frame({"tool_calls": [{"index": i, **call} for i, call in enumerate(tool_calls)]}))
+    frames.append(frame({}, choices[0].get("finish_reason") or ("tool_calls" if tool_calls else "stop")))
+
+    if response.get("usage"):
+        frames.append(encode_event({**base, "choices": [], "usage": response["usage"]}))
+    return frames
+
+
+async def replay_cached_response(response: dict, mode: str = CACHE_REPLAY_MODE) -> AsyncIterator[bytes]:
+    """
+    Stream a cached response. "burst" sends the frames in as few writes as
+    possible; "paced" sends one frame at a time at CACHE_REPLAY_CHARS_PER_SECOND.
+    """
+    frames = cached_response_frames(response)
+    frames.append(DONE_EVENT)
+
+    if mode == "paced" and CACHE_REPLAY_CHARS_PER_SECOND > 0:
+        for i, frame in enumerate(frames):
+            yield frame
+            if i + 1 < len(frames):
+                await asyncio.sleep(CACHE_REPLAY_CHUNK_CHARS / CACHE_REPLAY_CHARS_PER_SECOND)
+        return
+
+    batch: List[bytes] = []
+    size = 0
+    for frame in frames:
+        if batch and size + len(frame) > REPLAY_BATCH_BYTES:
+            yield b"".join(batch)
+            batch, size = [], 0
+        batch.append(frame)
+        size += len(frame)
+    yield b"".join(batch)
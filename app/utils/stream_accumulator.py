@@ -0,0 +1,104 @@
+from typing import Any, Dict, List, Optional
+from utils.token_counter import get_encoding_for_model
+import time
+import uuid
+
+
+class StreamAccumulator:
+    """
+    Collects the completion of a streamed response.
+
+    Text is kept as a list of chunks and joined once, on demand, and tokens
+    are counted per delta as they arrive, so long generations avoid both
+    repeated string copies and a full re-encode at the end. One accumulator
+    is created by the provider client and handed to the route layer through
+    the internal metadata, which uses it for caching and logging.
+
+    Tool call deltas are merged per index and the finish reason is kept, so
+    the accumulated completion can be cached and replayed in full.
+    """
+
+    def __init__(self, model: str):
+        self._encoding = get_encoding_for_model(model)
+        self._chunks: List[str] = []
+        self._text: Optional[str] = None
+        self._tool_calls: Dict[int, dict] = {}
+        self.finish_reason: Optional[str] = None
+        self.completion_tokens = 0
+
+    def add_chunk(self, chunk: Any) -> None:
+        """Record the first choice of an upstream chat.completion.chunk."""
+        if not chunk.choices:
+            return
+        choice = chunk.choices[0]
+        if choice.delta.content:
+            self.add_content(choice.delta.content)
+        for delta in choice.delta.tool_calls or []:
+            self._add_tool_call(delta)
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+
+    def _add_tool_call(self, delta: Any) -> None:
+        # The first delta for an index carries id and name; later ones only
+        # append to the arguments
+        call = self._tool_calls.get(delta.index)
+        if call is None:
+            call = self._tool_calls[delta.index] = {"id": None, "type": "function", "name": "", "arguments": []}
+        if delta.id:
+            call["id"] = delta.id
+        if delta.function:
+            if delta.function.name:
+                call["name"] += delta.function.name
+            if delta.function.arguments:
+                call["arguments"].append(delta.function.arguments)
+
+    def add_content(self, content: str) -> None:
+        """Record one content delta."""
+        self._chunks.append(content)
+        self.completion_tokens += len(self._encoding.encode(content))
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        """The full completion text so far."""
+        if self._text is None:
+            self._text = "".join(self._chunks)
+            self._chunks = [self._text] if self._text else []
+        return self._text
+
+    @property
+    def tool_calls(self) -> List[dict]:
+        """Merged tool calls in OpenAI message format."""
+        return [
+            {
+                "id": call["id"] or f"call_{uuid.uuid4().hex[:24]}",
+                "type": call["type"],
+                "function": {"name": call["name"], "arguments": "".join(call["arguments"])},
+            }
+            for _, call in sorted(self._tool_calls.items())
+        ]
+
+    def to_response(self, model: str, prompt_tokens: int, completion_tokens: int) -> dict:
+        """The streamed completion as a chat.completion payload, for the cache."""
+        message: Dict[str, Any] = {"role": "assistant", "content": self.text or None}
+        if self._tool_calls:
+            message["tool_calls"] = self.tool_calls
+        return {
+            "id": f"chatcmpl-{uuid.uuid4()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": message,
+                "finish_reason": self.finish_reason or ("tool_calls" if self._tool_calls else "stop")
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+    def __bool__(self) -> bool:
+        return bool(self._chunks or self._tool_calls)
@@ -1,88 +1,181 @@
 import tiktoken
+import asyncio
+import hashlib
 import json
+from functools import lru_cache
 from typing import List, Dict, Any
 from models.chat import Message, TextContent
+from config import TOKEN_CACHE_MAX_ENTRIES, TOKEN_OFFLOAD_MIN_CHARS
+from utils.ttl_cache import TTLCache
 
+# Map common models to their encodings
+MODEL_ENCODINGS = {
+    "gpt-4": "cl100k_base",
+    "gpt-4-turbo": "cl100k_base",
+    "gpt-4o": "o200k_base",
+    "gpt-4o-mini": "o200k_base",
+    "gpt-3.5-turbo": "cl100k_base",
+    "text-embedding-ada-002": "cl100k_base",
+    "text-davinci-003": "p50k_base",
+    "claude-3": "cl100k_base",  # Approximate for Claude
+    "gemini": "cl100k_base",    # Approximate for Gemini
+}
+
+# Per-message token counts keyed by (encoding, content hash). Entries never
+# go stale since the same text always encodes to the same tokens.
+_message_token_cache = TTLCache(maxsize=TOKEN_CACHE_MAX_ENTRIES, ttl=float("inf"))
+
+
+@lru_cache(maxsize=1024)
 def get_encoding_for_model(model: str):
-    """Get the appropriate tiktoken encoding for a model"""
+    """Get the appropriate tiktoken encoding for a model (cached per model)"""
     try:
         # Remove provider prefix if present
         clean_model = model.split(":", 1)[-1] if ":" in model else model
-        
-        # Map common models to their encodings
-        model_encodings = {
-            "gpt-4": "cl100k_base",
-            "gpt-4-turbo": "cl100k_base", 
-            "gpt-4o": "o200k_base",
-            "gpt-4o-mini": "o200k_base",
-            "gpt-3.5-turbo": "cl100k_base",
-            "text-embedding-ada-002": "cl100k_base",
-            "text-davinci-003": "p50k_base",
-            "claude-3": "cl100k_base",  # Approximate for Claude
-            "gemini": "cl100k_base",    # Approximate for Gemini
-        }
-        
+
         # Find the best match
         encoding_name = "cl100k_base"  # Default
-        for model_name, enc in model_encodings.items():
+        for model_name, enc in MODEL_ENCODINGS.items():
             if model_name in clean_model.lower():
                 encoding_name = enc
                 break
-                
+
         return tiktoken.get_encoding(encoding_name)
     except Exception:
         # Fallback to default encoding
         return tiktoken.get_encoding("cl100k_base")
 
-def count_tokens_in_messages(messages: List[Message], model: str) -> int:
-    """Count tokens in a list of messages"""
-    encoding = get_encoding_for_model(model)
-    
+
+def _message_parts(message: Message):
+    """
+    Split a message into the text segments that need encoding and the fixed
+    token overhead that doesn't.
+    """
+    # Every message follows <|start|>{role/name}\n{content}<|end|>\n
+    overhead = 3
+    texts = []
+
+    # Add tokens for role
+    if hasattr(message, 'role') and message.role:
+        texts.append(message.role)
+
+    # Add tokens for content
+    if hasattr(message, 'content') and message.content:
+        if isinstance(message.content, str):
+            texts.append(message.content)
+        elif isinstance(message.content, list):
+            for content_item in message.content:
+                if isinstance(content_item, str):
+                    texts.append(content_item)
+                elif hasattr(content_item, 'type'):
+                    if content_item.type == 'text' and isinstance(content_item, TextContent):
+                        texts.append(content_item.text)
+                    elif content_item.type == 'image_url':
+                        # Approximate token count for images (varies by size)
+                        overhead += 85  # Base cost for image processing
+
+    # Add tokens for tool calls
+    if hasattr(message, 'tool_calls') and message.tool_calls:
+        for tool_call in message.tool_calls:
+            # Add tokens for tool call structure
+            overhead += 3  # Base overhead for tool call
+
+            # Add tokens for function name and arguments (JSON string)
+            if tool_call.function and tool_call.function.name:
+                texts.append(tool_call.function.name)
+            if tool_call.function and tool_call.function.arguments:
+                texts.append(tool_call.function.arguments)
+
+    # Add tokens for tool_call_id (for tool messages)
+    if hasattr(message, 'tool_call_id') and message.tool_call_id:
+        texts.append(message.tool_call_id)
+
+    return texts, overhead
+
+
+def _cache_key(encoding_name: str, texts: List[str], overhead: int) -> tuple:
+    digest = hashlib.blake2b(digest_size=16)
+    for text in texts:
+        digest.update(text.encode("utf-8", "surrogatepass"))
+        digest.update(b"\x00")
+    return (encoding_name, overhead, digest.digest())
+
+
+def _lookup(messages: List[Message], encoding) -> tuple:
+    """Sum of the memoized message counts, and the messages that still need encoding."""
     num_tokens = 0
+    misses = []
     for message in messages:
-        # Every message follows <|start|>{role/name}\n{content}<|end|>\n
-        num_tokens += 3
-        
-        # Add tokens for role
-        if hasattr(message, 'role') and message.role:
-            num_tokens += len(encoding.encode(message.role))
-        
-        # Add tokens for content
-        if hasattr(message, 'content') and message.content:
-            if isinstance(message.content, str):
-                num_tokens += len(encoding.encode(message.content))
-            elif isinstance(message.content, list):
-                for content_item in message.content:
-                    if isinstance(content_item, str):
-                        num_tokens += len(encoding.encode(content_item))
-                    elif hasattr(content_item, 'type'):
-                        if content_item.type == 'text' and isinstance(content_item, TextContent):
-                            num_tokens += len(encoding.encode(content_item.text))
-                        elif content_item.type == 'image_url':
-                            # Approximate token count for images (varies by size)
-                            num_tokens += 85  # Base cost for image processing
-        
-        # Add tokens for tool calls
-        if hasattr(message, 'tool_calls') and message.tool_calls:
-            for tool_call in message.tool_calls:
-                # Add tokens for tool call structure
-                num_tokens += 3  # Base overhead for tool call
-                
-                # Add tokens for function name
-                if tool_call.function and tool_call.function.name:
-                    num_tokens += len(encoding.encode(tool_call.function.name))
-                
-                # Add tokens for function arguments (JSON string)
-                if tool_call.function and tool_call.function.arguments:
-                    num_tokens += len(encoding.encode(tool_call.function.arguments))
-        
-        # Add tokens for tool_call_id (for tool messages)
-        if hasattr(message, 'tool_call_id') and message.tool_call_id:
-            num_tokens += len(encoding.encode(message.tool_call_id))
-    
+        texts, overhead = _message_parts(message)
+        key = _cache_key(encoding.name, texts, overhead)
+        cached = _message_token_cache.get(key)
+        if cached is None:
+            misses.append((key, texts, overhead))
+        else:
+            num_tokens += cached
+    return num_tokens, misses
+
+
+def _encode(encoding, texts: List[str]) -> List[int]:
+    """
+    Token counts of `texts`. Large inputs are encoded with encode_batch,
+    which starts a thread pool per call, so it is only worth it (and only
+    called) off the event loop; small ones are encoded one by one.
+    """
+    if len(texts) > 1 and sum(map(len, texts)) >= TOKEN_OFFLOAD_MIN_CHARS:
+        return [len(tokens) for tokens in encoding.encode_batch(texts)]
+    return [len(encoding.encode(text)) for text in texts]
+
+
+def _store(misses: list, counts: List[int]) -> int:
+    """Memoize the counts of newly encoded messages and return their sum."""
+    num_tokens = 0
+    position = 0
+    for key, texts, overhead in misses:
+        count = overhead + sum(counts[position:position + len(texts)])
+        position += len(texts)
+        _message_token_cache.set(key, count)
+        num_tokens += count
+    return num_tokens
+
+
+def count_tokens_in_messages(messages: List[Message], model: str) -> int:
+    """
+    Count tokens in a list of messages.
+    Per-message counts are memoized, so only new messages of a conversation
+    are encoded.
+    """
+    encoding = get_encoding_for_model(model)
+    num_tokens, misses = _lookup(messages, encoding)
+    if misses:
+        num_tokens += _store(misses, _encode(encoding, [text for _, texts, _ in misses for text in texts]))
+    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return num_tokens
+
+
+async def count_tokens_in_messages_async(messages: List[Message], model: str) -> int:
+    """
+    Event-loop friendly variant of count_tokens_in_messages.
+    Messages that aren't memoized are encoded in a single worker thread
+    when they add up to at least TOKEN_OFFLOAD_MIN_CHARS characters.
+    """
+    encoding = get_encoding_for_model(model)
+    num_tokens, misses = _lookup(messages, encoding)
+    if misses:
+        texts = [text for _, texts, _ in misses for text in texts]
+        if sum(map(len, texts)) >= TOKEN_OFFLOAD_MIN_CHARS:
+            counts = await asyncio.to_thread(_encode, encoding, texts)
+        else:
+            counts = _encode(encoding, texts)
+        num_tokens += _store(misses, counts)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
+
+def get_token_cache_stats() -> dict:
+    return _message_token_cache.stats()
+
+
 def count_tokens_in_text(text: str, model: str) -> int:
     """Count tokens in a text string"""
     encoding = get_encoding_for_model(model)
@@ -91,18 +184,18 @@ def count_tokens_in_text(text: str, model: str) -> int:
 def count_tokens_in_tools(tools: List[dict], model: str) -> int:
     """Count tokens in tool definitions"""
     encoding = get_encoding_for_model(model)
-    
+
     num_tokens = 0
     for tool in tools:
         # Convert tool to JSON string and count tokens
         tool_json = json.dumps(tool, separators=(',', ':'))
         num_tokens += len(encoding.encode(tool_json))
-        
+
         # Add overhead for tool definition structure
         num_tokens += 3
-    
+
     return num_tokens
 
 def estimate_completion_tokens(content: str, model: str) -> int:
     """Estimate completion tokens from response content"""
-    return count_tokens_in_text(content, model)
\ No newline at end of file
+    return count_tokens_in_text(content, model)
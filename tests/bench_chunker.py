@@ -0,0 +1,128 @@
+"""
+Chunk count, embedding cost and retrieval hit rate of the vault chunkers.
+
+Builds a synthetic multi-page corpus of filler paragraphs with "facts"
+planted in it ("The access code for vault orion-17 is 4821-KX."), chunks it
+with each chunker in services/chunker.py and asks one question per fact.
+Retrieval uses a hashed TF-IDF bag of words as a stand-in for the
+embedding model, so the numbers compare chunkers with each other rather
+than predict real recall. A query is a hit when one of the top-k chunks
+contains the whole fact sentence, i.e. it was not cut in two.
+
+Embedding cost is the number of tokens sent to text-embedding-3-small at
+$0.02 per million. Token counting uses tiktoken's cl100k_base encoding,
+which has to be available locally (it is downloaded and cached on first use).
+
+Usage:
+    cd app && python ../tests/bench_chunker.py [pages] [top_k]
+"""
+import asyncio
+import os
+import random
+import re
+import sys
+import time
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+
+from services.chunker import CharacterChunker, RecursiveTokenChunker
+from utils.token_counter import count_tokens_in_text
+
+PRICE_PER_MILLION = 0.02
+DIM = 4096
+FILLER = (
+    "system report quarter team review budget process customer service market policy "
+    "design network update support result project plan data risk growth value model "
+    "cost product order office staff record schedule meeting account contract"
+).split()
+_WORD = re.compile(r"[\w-]+")
+
+
+def sentence(rng: random.Random) -> str:
+    words = [rng.choice(FILLER) for _ in range(rng.randint(8, 24))]
+    return " ".join(words).capitalize() + "."
+
+
+def make_corpus(num_pages: int, rng: random.Random):
+    """(page, text) segments and a list of (question, fact sentence)."""
+    segments, facts = [], []
+    for page in range(1, num_pages + 1):
+        paragraphs = []
+        for _ in range(rng.randint(3, 7)):
+            sentences = [sentence(rng) for _ in range(rng.randint(2, 8))]
+            if rng.random() < 0.4:
+                name = f"{rng.choice(['orion', 'lyra', 'vega', 'draco', 'hydra'])}-{len(facts)}"
+                code = f"{rng.randint(1000, 9999)}-{rng.choice('ABCDEFGH')}{rng.choice('KLMNPQRS')}"
+                fact = f"The access code for vault {name} is {code}."
+                sentences.insert(rng.randint(0, len(sentences)), fact)
+                facts.append((f"What is the access code for vault {name}?", fact))
+            paragraphs.append(" ".join(sentences))
+        segments.append((page, "\n\n".join(paragraphs) + "\n"))
+    return segments, facts
+
+
+def embed(texts: list, idf: dict) -> np.ndarray:
+    vectors = np.zeros((len(texts), DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in _WORD.findall(text.lower()):
+            vectors[row, zlib.crc32(word.encode()) % DIM] += idf.get(word, 1.0)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+
+async def chunk_all(chunker, segments: list) -> list:
+    async def stream():
+        for segment in segments:
+            yield segment
+    return [c async for c in chunker.chunks(stream()) if c.text.strip()]
+
+
+def bench(name: str, chunks: list, facts: list, top_k: int, seconds: float) -> None:
+    texts = [c.text for c in chunks]
+    tokens = sum(count_tokens_in_text(t, "text-embedding-3-small") for t in texts)
+    chars = sum(len(t) for t in texts)
+
+    documents = [set(_WORD.findall(t.lower())) for t in texts]
+    df = {}
+    for words in documents:
+        for word in words:
+            df[word] = df.get(word, 0) + 1
+    idf = {w: float(np.log(len(texts) / n)) + 1.0 for w, n in df.items()}
+    matrix = embed(texts, idf)
+    queries = embed([q for q, _ in facts], idf)
+    top = np.argsort(-(queries @ matrix.T), axis=1)[:, :top_k]
+    hits = sum(any(fact in texts[i] for i in row) for row, (_, fact) in zip(top, facts))
+    split = sum(not any(fact in t for t in texts) for _, fact in facts)
+
+    print(
+        f"  {name:<22} chunks={len(chunks):>6}  chars={chars:>9}  tokens={tokens:>8}  "
+        f"cost=${tokens * PRICE_PER_MILLION / 1e6:.5f}  facts split={split:>4}  "
+        f"hit@{top_k}={hits / len(facts):.3f}  chunking={seconds * 1000:.0f} ms"
+    )
+
+
+async def main() -> None:
+    num_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    top_k = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    segments, facts = make_corpus(num_pages, random.Random(0))
+    print(f"{num_pages} pages, {sum(len(t) for _, t in segments)} chars, {len(facts)} facts")
+
+    chunkers = [
+        ("character 1000/200", CharacterChunker(1000, 200)),
+        ("recursive 256/0", RecursiveTokenChunker(256, 0)),
+        ("recursive 256/32", RecursiveTokenChunker(256, 32)),
+        ("recursive 400/40", RecursiveTokenChunker(400, 40)),
+    ]
+    for name, chunker in chunkers:
+        started = time.perf_counter()
+        chunks = await chunk_all(chunker, segments)
+        bench(name, chunks, facts, top_k, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
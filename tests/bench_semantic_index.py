@@ -0,0 +1,70 @@
+"""
+Recall / latency benchmark for the local semantic cache index.
+
+Builds one partition of synthetic clustered embeddings per size, then
+compares the IVF search in services/semantic_index.py against an exact
+scan over the same vectors. Recall is the share of queries whose top-1
+matches the exact top-1. Queries are perturbed copies of stored vectors,
+like paraphrased prompts hitting the cache.
+
+Usage:
+    cd app && python ../tests/bench_semantic_index.py [sizes] [dim] [nprobe]
+    e.g. python ../tests/bench_semantic_index.py 10000,100000,1000000 256 8
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+
+from services.semantic_index import _Partition
+
+NUM_QUERIES = 200
+
+
+def make_vectors(n: int, dim: int, rng) -> np.ndarray:
+    centers = rng.normal(size=(max(1, n // 100), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), n)]
+    vectors += rng.normal(scale=0.5, size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def bench(n: int, dim: int, nprobe: int) -> None:
+    rng = np.random.default_rng(0)
+    vectors = make_vectors(n, dim, rng)
+
+    partition = _Partition(dim, vectors, [str(i) for i in range(n)])
+    started = time.perf_counter()
+    partition.train()
+    train_s = time.perf_counter() - started
+
+    targets = rng.choice(n, NUM_QUERIES, replace=False)
+    queries = vectors[targets] + rng.normal(scale=0.02, size=(NUM_QUERIES, dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    started = time.perf_counter()
+    exact = [str(int(np.argmax(vectors @ q))) for q in queries]
+    exact_ms = (time.perf_counter() - started) / NUM_QUERIES * 1000
+
+    started = time.perf_counter()
+    found = [partition.search(q, nprobe)[0] for q in queries]
+    ivf_ms = (time.perf_counter() - started) / NUM_QUERIES * 1000
+
+    recall = sum(a == b for a, b in zip(found, exact)) / NUM_QUERIES
+    print(
+        f"{n:>9} rows  lists={len(partition._ivf[0]):>5}  train={train_s:6.1f}s  "
+        f"exact={exact_ms:7.3f} ms  ivf={ivf_ms:6.3f} ms  recall@1={recall:.3f}"
+    )
+
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in (sys.argv[1] if len(sys.argv) > 1 else "10000,100000,1000000").split(",")]
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    nprobe = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    print(f"dim={dim} nprobe={nprobe} queries={NUM_QUERIES}")
+    for n in sizes:
+        bench(n, dim, nprobe)
@@ -0,0 +1,116 @@
+"""
+Per-chunk CPU benchmark for chat streaming SSE encoding.
+
+Compares the previous path (rebuild pydantic ChatCompletionChunk, dump to a
+JSON string, then json.loads it again to filter empty deltas) with the
+fast path in utils/sse.py (filter on the upstream object, encode once to
+bytes).
+
+Usage:
+    cd app && python ../tests/bench_sse_encoding.py [num_chunks]
+"""
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from openai.types.chat import ChatCompletionChunk as UpstreamChunk
+from models.chat import ChatCompletionChunk, ChoiceChunk, Delta, Usage
+from utils.sse import encode_chunk
+
+
+def make_upstream_chunks(n: int) -> list:
+    chunks = []
+    for i in range(n):
+        # Roughly one keep-alive / empty delta every 10 chunks
+        content = None if i % 10 == 9 else f"token{i} "
+        chunks.append(UpstreamChunk.model_validate({
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": 1700000000,
+            "model": "gpt-4o",
+            "system_fingerprint": "fp_bench",
+            "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+        }))
+    return chunks
+
+
+def is_empty_chunk(chunk) -> bool:
+    """Previous routes/api.py filter: parses the frame that was just serialized."""
+    if not isinstance(chunk, str) or not chunk.startswith("data: "):
+        return False
+    data_str = chunk[6:].strip()
+    if data_str == "[DONE]":
+        return False
+    try:
+        data = json.loads(data_str)
+        if data.get("usage"):
+            return False
+        choices = data.get("choices", [])
+        if not choices:
+            return False
+        choice = choices[0]
+        delta = choice.get("delta", {})
+        if delta.get("content") or delta.get("tool_calls") or choice.get("finish_reason"):
+            return False
+        return True
+    except Exception:
+        return False
+
+
+def old_path(chunk, model: str):
+    chunk_data = ChatCompletionChunk(
+        id=chunk.id or str(uuid.uuid4()),
+        object="chat.completion.chunk",
+        created=chunk.created or int(time.time()),
+        model=model,
+        choices=[ChoiceChunk(
+            index=c.index,
+            delta=Delta(content=c.delta.content, role=c.delta.role, tool_calls=c.delta.tool_calls),
+            finish_reason=c.finish_reason
+        ) for c in chunk.choices],
+        system_fingerprint=chunk.system_fingerprint,
+        usage=Usage(
+            prompt_tokens=chunk.usage.prompt_tokens,
+            completion_tokens=chunk.usage.completion_tokens,
+            total_tokens=chunk.usage.total_tokens
+        ) if chunk.usage else None
+    )
+    frame = f"data: {chunk_data.model_dump_json(exclude_none=True)}\n\n"
+    return None if is_empty_chunk(frame) else frame
+
+
+def new_path(chunk, model: str):
+    return encode_chunk(chunk, model)
+
+
+def bench(fn, chunks, rounds: int = 5) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.process_time()
+        for chunk in chunks:
+            fn(chunk, "openai:gpt-4o")
+        best = min(best, time.process_time() - start)
+    return best / len(chunks) * 1e6  # microseconds per chunk
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    chunks = make_upstream_chunks(n)
+
+    # Both paths must emit the same frames
+    for chunk in chunks[:50]:
+        old, new = old_path(chunk, "m"), new_path(chunk, "m")
+        assert (old is None) == (new is None)
+        if old is not None:
+            assert json.loads(old[6:]) == json.loads(new[6:])
+
+    old_us = bench(old_path, chunks)
+    new_us = bench(new_path, chunks)
+    print(f"chunks: {n}")
+    print(f"old path (pydantic + json.loads filter): {old_us:.2f} us/chunk")
+    print(f"new path (filter upstream + orjson):     {new_us:.2f} us/chunk")
+    print(f"speedup: {old_us / new_us:.1f}x")
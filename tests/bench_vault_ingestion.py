@@ -0,0 +1,160 @@
+"""
+Throughput benchmark (chunks/sec) for vault embedding and storage.
+
+Starts a mock OpenAI embeddings endpoint on localhost with a fixed latency
+per request plus a little per input, and an optional share of 503s. The
+same synthetic corpus is then stored twice: the previous way (sequential
+batches of 20, each inserted before the next is embedded) and through
+services/ingestion_executor.py. Inserts are simulated with a blocking
+sleep, like a round trip to Supabase.
+
+Token counting uses tiktoken's cl100k_base encoding, which has to be
+available locally (it is downloaded and cached on first use).
+
+Usage:
+    cd app && python ../tests/bench_vault_ingestion.py [num_chunks] [latency_ms] [error_rate] [concurrency,...]
+    e.g. python ../tests/bench_vault_ingestion.py 2000 150 0.05 1,4,8
+"""
+import asyncio
+import base64
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from openai import AsyncOpenAI
+
+import services.ingestion_executor as ingestion_executor
+from services.chunker import Chunk
+from services.ingestion_executor import IngestionExecutor
+
+DIM = 1536
+PER_INPUT_MS = 0.5
+INSERT_MS = 30
+WORDS = ["alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel",
+         "india", "juliet", "kilo", "lima", "mike", "november", "oscar", "papa"]
+
+
+def make_server(latency_ms: float, error_rate: float) -> FastAPI:
+    app = FastAPI()
+    vector = base64.b64encode(np.full(DIM, 0.01, dtype=np.float32).tobytes()).decode()
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body["input"]
+        await asyncio.sleep((latency_ms + PER_INPUT_MS * len(inputs)) / 1000)
+        if random.random() < error_rate:
+            return JSONResponse({"error": {"message": "overloaded"}}, status_code=503)
+        return {
+            "object": "list",
+            "model": body["model"],
+            "data": [{"object": "embedding", "index": i, "embedding": vector} for i in range(len(inputs))],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }
+
+    return app
+
+
+def start_server(app: FastAPI) -> str:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}/v1"
+
+
+class _Insert:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self):
+        time.sleep(INSERT_MS / 1000)
+
+
+class _Table:
+    def insert(self, rows):
+        return _Insert(rows)
+
+
+class FakeSupabase:
+    def table(self, name):
+        return _Table()
+
+
+def make_chunks(n: int, rng: random.Random) -> list:
+    # Mostly full 1000-character chunks, some short ones (page ends, headings)
+    chunks = []
+    for _ in range(n):
+        size = 1000 if rng.random() < 0.8 else rng.randint(50, 1000)
+        text = " ".join(rng.choice(WORDS) for _ in range(size // 5))
+        chunks.append(text[:size])
+    return chunks
+
+
+async def sequential(client: AsyncOpenAI, chunks: list) -> float:
+    """The previous upload loop: batches of 20, embed then insert, one at a time."""
+    started = time.perf_counter()
+    for i in range(0, len(chunks), 20):
+        batch = chunks[i:i + 20]
+        for attempt in range(5):
+            try:
+                resp = await client.embeddings.create(input=batch, model="text-embedding-3-small")
+                break
+            except Exception:
+                if attempt == 4:
+                    raise
+        rows = [{"content": text, "embedding": item.embedding} for text, item in zip(batch, resp.data)]
+        FakeSupabase().table("vault_embeddings").insert(rows).execute()
+    return time.perf_counter() - started
+
+
+async def concurrent(client: AsyncOpenAI, chunks: list, concurrency: int) -> dict:
+    executor = IngestionExecutor(client, "bench-vault", "bench-doc", concurrency=concurrency, retry_backoff=0.05)
+    offset = 0
+    for text in chunks:
+        await executor.add(Chunk(text, offset))
+        offset += len(text)
+    return await executor.finish()
+
+
+async def main() -> None:
+    num_chunks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    latency_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 150
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    levels = [int(c) for c in sys.argv[4].split(",")] if len(sys.argv) > 4 else [1, 4, 8]
+
+    base_url = start_server(make_server(latency_ms, error_rate))
+    # Retries are left to the code under test
+    client = AsyncOpenAI(api_key="bench", base_url=base_url, max_retries=0)
+    ingestion_executor.supabase_admin = FakeSupabase()
+    chunks = make_chunks(num_chunks, random.Random(0))
+    print(f"{num_chunks} chunks, {latency_ms:.0f} ms per request, {error_rate:.0%} errors, {INSERT_MS} ms per insert")
+
+    seconds = await sequential(client, chunks)
+    print(f"  sequential (20/batch)   {num_chunks / seconds:8.1f} chunks/s  ({seconds:.1f}s)")
+
+    for concurrency in levels:
+        report = await concurrent(client, chunks, concurrency)
+        print(
+            f"  executor concurrency={concurrency:<2} {report['chunks_per_second']:8.1f} chunks/s  "
+            f"({report['seconds']:.1f}s, {report['requests']} requests, {report['retries']} retries)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
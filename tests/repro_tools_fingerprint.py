@@ -0,0 +1,63 @@
+"""
+Regression check: fingerprinting a request that sends tools.
+
+Tools arrive as a list of pydantic Tool objects, which json.dumps can't
+serialize on its own; this used to raise TypeError and fail every such
+request with a 500. Also checks that requests differing only in vault,
+tools, tool_choice or temperature get different semantic-cache scopes.
+
+Usage:
+    cd app && python ../tests/repro_tools_fingerprint.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+os.environ.setdefault("SUPABASE_KEY", "repro")
+
+from models.chat import ChatRequest
+from utils.fingerprint import fingerprint_request
+
+TOOL = {
+    "type": "function",
+    "function": {
+        "name": "get_weather",
+        "description": "Current weather for a city",
+        "parameters": {"type": "object", "properties": {"city": {"type": "string"}}},
+    },
+}
+
+
+def fingerprint(**overrides):
+    req = ChatRequest(**{
+        "model": "gpt-4o-mini",
+        "messages": [{"role": "user", "content": "What's the weather in Paris?"}],
+        "tools": [TOOL],
+        "tool_choice": "auto",
+        **overrides,
+    })
+    return fingerprint_request(
+        req.model, req.messages,
+        temperature=req.temperature, tools=req.tools, tool_choice=req.tool_choice,
+        reasoning_effort=req.reasoning_effort, vault_id=req.vault_id,
+    )
+
+
+if __name__ == "__main__":
+    base = fingerprint()
+    print(f"Fingerprinted request with tools: {base!r}")
+    assert fingerprint().key == base.key, "fingerprint is not deterministic"
+
+    other_tool = {**TOOL, "function": {**TOOL["function"], "name": "get_time"}}
+    variants = {
+        "vault_id": fingerprint(vault_id="vault-1"),
+        "tools": fingerprint(tools=[other_tool]),
+        "tool_choice": fingerprint(tool_choice="none"),
+        "temperature": fingerprint(temperature=0.2),
+    }
+    for name, variant in variants.items():
+        assert variant.text == base.text
+        assert variant.scope != base.scope, f"{name} does not change the semantic-cache scope"
+        assert variant.key != base.key, f"{name} does not change the cache key"
+    print("Scopes differ by vault_id, tools, tool_choice and temperature")
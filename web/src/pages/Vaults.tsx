@@ -30,6 +30,37 @@ interface Vault {
     created_at: string;
 }
 
+interface IngestionJob {
+    job_id: string;
+    filename: string;
+    status: "queued" | "running" | "completed" | "failed";
+    progress: {
+        pages_total: number | null;
+        pages_parsed: number;
+        chunks: number;
+        chunks_embedded: number;
+        fraction: number | null;
+    };
+    eta_seconds: number | null;
+    error: string | null;
+    resumable: boolean;
+}
+
+const JOB_POLL_MS = 1000;
+
+const describeJob = (job: IngestionJob) => {
+    if (job.status === "queued") return "Queued…";
+    if (job.status === "failed") return `Failed: ${job.error}`;
+    if (job.status === "completed") return "Processed.";
+    const { pages_total, pages_parsed, chunks_embedded, fraction } = job.progress;
+    const parts = [];
+    if (fraction !== null) parts.push(`${Math.round(fraction * 100)}%`);
+    if (pages_total) parts.push(`${pages_parsed}/${pages_total} pages`);
+    parts.push(`${chunks_embedded} chunks embedded`);
+    if (job.eta_seconds !== null) parts.push(`about ${Math.ceil(job.eta_seconds)}s left`);
+    return parts.join(" · ");
+};
+
 export default function Vaults() {
     const { user } = useAuth();
     const [vaults, setVaults] = useState<Vault[]>([]);
@@ -44,6 +75,7 @@ export default function Vaults() {
     const [documents, setDocuments] = useState<any[]>([]);
     const [uploadFile, setUploadFile] = useState<File | null>(null);
     const [uploading, setUploading] = useState(false);
+    const [uploadJob, setUploadJob] = useState<IngestionJob | null>(null);
 
     useEffect(() => {
         if (selectedVault && user) {
@@ -141,9 +173,42 @@ export default function Vaults() {
                 const err = await res.json();
                 throw new Error(err.detail || "Upload failed");
             }
-            alert("Document uploaded successfully!");
             setUploadFile(null);
-            if (selectedVault) fetchDocuments(selectedVault.id);
+            await watchJob(selectedVault.id, await res.json());
+        } catch (e: any) {
+            console.error(e);
+            alert(e.message);
+        } finally {
+            setUploading(false);
+        }
+    };
+
+    // Uploads are processed in the background; poll the job until it settles
+    const watchJob = async (vaultId: string, job: IngestionJob) => {
+        setUploadJob(job);
+        while (job.status === "queued" || job.status === "running") {
+            await new Promise(resolve => setTimeout(resolve, JOB_POLL_MS));
+            const res = await fetch(`${API_BASE}/vaults/${vaultId}/jobs/${job.job_id}?user_id=${user?.id}`);
+            if (!res.ok) throw new Error("Lost track of the upload");
+            job = await res.json();
+            setUploadJob(job);
+        }
+        fetchDocuments(vaultId);
+        if (job.status === "completed") setUploadJob(null);
+    };
+
+    const handleRetry = async () => {
+        if (!uploadJob || !selectedVault) return;
+        setUploading(true);
+        try {
+            const res = await fetch(`${API_BASE}/vaults/${selectedVault.id}/jobs/${uploadJob.job_id}/retry?user_id=${user?.id}`, {
+                method: "POST"
+            });
+            if (!res.ok) {
+                const err = await res.json();
+                throw new Error(err.detail || "Retry failed");
+            }
+            await watchJob(selectedVault.id, await res.json());
         } catch (e: any) {
             console.error(e);
             alert(e.message);
@@ -283,6 +348,16 @@ export default function Vaults() {
                                     <p className="text-xs text-gray-500 mt-2">
                                         Supports PDF, DOCX, TXT. Files are automatically processed and embedded.
                                     </p>
+                                    {uploadJob && (
+                                        <div className="text-xs text-gray-400 mt-2 flex items-center gap-2">
+                                            <span className="truncate">{uploadJob.filename}: {describeJob(uploadJob)}</span>
+                                            {uploadJob.resumable && (
+                                                <Button size="sm" variant="ghost" onClick={handleRetry} disabled={uploading}>
+                                                    Retry
+                                                </Button>
+                                            )}
+                                        </div>
+                                    )}
                                 </div>
 
                                 <div>